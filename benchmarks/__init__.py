@@ -0,0 +1 @@
+"""Benchmarks for the .dat to NIfTI conversion, run with ``python -m benchmarks``."""
@@ -0,0 +1,256 @@
+"""Time and memory-profile the stages of the .dat to NIfTI conversion on synthetic series.
+
+Each stage runs in a fresh process by default, so that the peak RSS it reports is its own.
+Results can be written as JSON with ``--json`` to track them over time.
+"""
+
+import argparse
+import contextlib
+import io
+import json
+import os
+import resource
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
+from pathlib import Path
+
+from benchmarks.synthetic import make_series, write_fake_dcm2niix
+
+# (x, y, z) matrix, echoes and frames of each preset
+PRESETS = {
+    "smoke": ((16, 16, 8), 2, 3),
+    "small": ((64, 64, 40), 4, 100),
+    "realistic": ((104, 104, 72), 5, 400),
+    "large": ((110, 110, 72), 8, 1000),
+}
+
+STAGES = ["startup", "read", "orient", "alte", "save", "end_to_end", "end_to_end_stream"]
+
+# the repository, for the fresh interpreters of the startup stage
+ROOT = Path(__file__).resolve().parent.parent
+
+# number of protocol reads timed by each repeat of the alte stage
+ALTE_CALLS = 100
+
+
+@contextlib.contextmanager
+def fake_dcm2niix_on_path(bin_dir):
+    """Put the directory holding the fake dcm2niix first on the PATH."""
+    path = os.environ.get("PATH", "")
+    os.environ["PATH"] = f"{bin_dir}{os.pathsep}{path}"
+    try:
+        yield
+    finally:
+        os.environ["PATH"] = path
+
+
+def peak_rss_mb():
+    """Peak resident set size of this process so far, in MB."""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # bytes on macOS, KiB elsewhere
+    return peak / 2**20 if sys.platform == "darwin" else peak / 1024
+
+
+def timed(fn, repeat):
+    """Call fn() repeat times, returning the time taken by each call."""
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+    return times
+
+
+def load_series(series):
+    """Assemble a synthetic series and load its first echo, as inputs for the later stages."""
+    from nibabel import Nifti1Image
+
+    from xa30_workaround.dat import dat_to_array
+
+    data = dat_to_array(series["dat_files"], series["shape"], order=series["order"])
+    return data, Nifti1Image.load(series["template"] + ".nii")
+
+
+def bench_startup(series, options, workdir):
+    """Time `dcmdat2niix -h` in a fresh interpreter, which should neither load numpy nor probe dcm2niix twice."""
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join([str(ROOT), os.environ.get("PYTHONPATH", "")]))
+    env["PATH"] = f"{options['bin_dir']}{os.pathsep}{env.get('PATH', '')}"
+    command = [sys.executable, "-m", "xa30_workaround.scripts.dcmdat2niix", "-h"]
+    return timed(lambda: subprocess.run(command, env=env, stdout=subprocess.DEVNULL, check=True), options["repeat"])
+
+
+def bench_read(series, options, workdir):
+    from xa30_workaround.dat import dat_to_array
+
+    return timed(
+        lambda: dat_to_array(series["dat_files"], series["shape"], workers=options["jobs"], order=series["order"]),
+        options["repeat"],
+    )
+
+
+def bench_orient(series, options, workdir):
+    from xa30_workaround.nifti import read_first_volume
+    from xa30_workaround.orientation import match_orientation
+
+    data, nifti = load_series(series)
+    return timed(lambda: match_orientation(data, read_first_volume(nifti)), options["repeat"])
+
+
+def bench_alte(series, options, workdir):
+    from xa30_workaround.protocol import read_protocol
+
+    def scan():
+        for _ in range(ALTE_CALLS):
+            read_protocol(series["dicom"])
+
+    return timed(scan, options["repeat"])
+
+
+def bench_save(series, options, workdir):
+    from xa30_workaround.dat import dat_to_array
+    from xa30_workaround.nifti import cast_output, output_image, read_first_volume, save_nifti
+    from xa30_workaround.orientation import find_orientation
+
+    # the series as convert_series saves it: decoded into the orientation of the nifti, then cast
+    data, nifti = load_series(series)
+    axes = find_orientation(data, read_first_volume(nifti))
+    data = dat_to_array(series["dat_files"], series["shape"], order=series["order"], flip_axes=axes)
+    data, slope_inter = cast_output(data, header=nifti.header)
+    suffix = ".nii.gz" if options["gzip"] else ".nii"
+
+    def save():
+        for i in range(data.shape[3]):
+            echo_img = output_image(data[..., i, :], nifti.affine, nifti.header, slope_inter)
+            save_nifti(echo_img, Path(workdir) / f"echo{i + 1}{suffix}", gzip_threads=options["gzip_threads"])
+
+    return timed(save, options["repeat"])
+
+
+def bench_end_to_end(series, options, workdir, stream=False):
+    # the fake dcm2niix has to be on the PATH before dcm2niix is first run
+    with fake_dcm2niix_on_path(options["bin_dir"]):
+        from xa30_workaround.scripts.dcmdat2niix import main
+
+        argv = ["--force", f"--jobs={options['jobs']}"] + (["--stream"] if stream else [])
+        argv += ["-z", "y" if options["gzip"] else "n"]
+        if options["gzip_threads"] is not None:
+            argv.append(f"--gzip-threads={options['gzip_threads']}")
+        runs = iter(range(options["repeat"]))
+
+        def convert():
+            output_dir = Path(workdir) / f"run{next(runs)}"
+            with contextlib.redirect_stdout(io.StringIO()):
+                main(argv + ["-o", str(output_dir), series["directory"]])
+
+        return timed(convert, options["repeat"])
+
+
+def bench_end_to_end_stream(series, options, workdir):
+    return bench_end_to_end(series, options, workdir, stream=True)
+
+
+def run_stage(stage, series, options):
+    """Run one stage, returning its timings, throughput and peak RSS."""
+    bench = globals()[f"bench_{stage}"]
+    with tempfile.TemporaryDirectory(dir=options["workdir"]) as workdir:
+        times = bench(series, options, workdir)
+    seconds = statistics.median(times)
+    if stage == "startup":
+        frames = megabytes = None
+    elif stage == "alte":
+        frames = None
+        megabytes = os.path.getsize(series["dicom"]) * ALTE_CALLS / 2**20
+    else:
+        frames = series["num_frames"]
+        megabytes = series["dat_bytes"] / 2**20
+    return {
+        "stage": stage,
+        "seconds": seconds,
+        "times": times,
+        "frames_per_second": None if frames is None else frames / seconds,
+        "megabytes_per_second": None if megabytes is None else megabytes / seconds,
+        "peak_rss_mb": peak_rss_mb(),
+    }
+
+
+def run_benchmarks(series, options, stages=STAGES, isolate=True):
+    """Run each stage on a series, in a fresh process per stage if isolate."""
+    results = []
+    for stage in stages:
+        if isolate:
+            with ProcessPoolExecutor(1, mp_context=get_context("spawn")) as pool:
+                results.append(pool.submit(run_stage, stage, series, options).result())
+        else:
+            results.append(run_stage(stage, series, options))
+    return results
+
+
+def format_results(results):
+    """Format benchmark results as a table."""
+    lines = [f"{'stage':<20}{'seconds':>10}{'frames/s':>12}{'MB/s':>10}{'peak RSS MB':>14}"]
+    for result in results:
+        fps = "-" if result["frames_per_second"] is None else f"{result['frames_per_second']:.1f}"
+        mbps = "-" if result["megabytes_per_second"] is None else f"{result['megabytes_per_second']:.1f}"
+        lines.append(
+            f"{result['stage']:<20}{result['seconds']:>10.3f}{fps:>12}{mbps:>10}{result['peak_rss_mb']:>14.1f}"
+        )
+    return "\n".join(lines)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog="python -m benchmarks", description="Benchmark the .dat to NIfTI conversion on synthetic series."
+    )
+    parser.add_argument("--preset", choices=PRESETS, default="small", help="Size of the series (default: small).")
+    parser.add_argument("--matrix", type=int, nargs=3, metavar=("X", "Y", "Z"), help="Override the matrix size.")
+    parser.add_argument("--echoes", type=int, help="Override the number of echoes.")
+    parser.add_argument("--frames", type=int, help="Override the number of frames.")
+    parser.add_argument("--phase", action="store_true", help="Generate phase rather than magnitude data.")
+    parser.add_argument("--stages", nargs="+", choices=STAGES, default=STAGES, help="Stages to run (default: all).")
+    parser.add_argument("--repeat", type=int, default=3, help="Timed runs of each stage, the median is reported.")
+    parser.add_argument("--jobs", type=int, default=1, help="Threads decoding .dat files (default: 1).")
+    parser.add_argument("--gzip", action="store_true", help="Write .nii.gz outputs.")
+    parser.add_argument("--gzip-threads", type=int, dest="gzip_threads", help="Threads compressing outputs.")
+    parser.add_argument("--workdir", type=Path, help="Directory for the synthetic data (default: a temporary one).")
+    parser.add_argument("--json", type=Path, help="Also write the results to this JSON file.")
+    parser.add_argument("--no-isolate", action="store_true", help="Run every stage in this process.")
+    args = parser.parse_args(argv)
+
+    matrix, echoes, frames = PRESETS[args.preset]
+    matrix = tuple(args.matrix) if args.matrix else matrix
+    echoes = args.echoes or echoes
+    frames = args.frames or frames
+
+    with tempfile.TemporaryDirectory(dir=args.workdir) as workdir:
+        print(f"Generating {frames} frames of {echoes} echoes at {matrix}...")
+        series = make_series(Path(workdir) / "session", matrix, echoes, frames, args.phase)
+        options = {
+            "repeat": args.repeat,
+            "jobs": args.jobs,
+            "gzip": args.gzip,
+            "gzip_threads": args.gzip_threads,
+            "workdir": workdir,
+            "bin_dir": str(write_fake_dcm2niix(Path(workdir) / "bin", [series]).parent),
+        }
+        results = run_benchmarks(series, options, args.stages, isolate=not args.no_isolate)
+
+    print(format_results(results))
+    if args.json is not None:
+        from xa30_workaround._version import __version__
+
+        report = {
+            "version": __version__,
+            "matrix": matrix,
+            "echoes": echoes,
+            "frames": frames,
+            "phase": args.phase,
+            "options": {key: value for key, value in options.items() if key not in ("workdir", "bin_dir")},
+            "results": results,
+        }
+        args.json.write_text(json.dumps(report, indent=4))
+    return results
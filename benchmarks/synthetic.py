@@ -0,0 +1,171 @@
+"""Synthetic XA30 sessions: .dat files, the dcm2niix output for their first echo, and a fake dcm2niix."""
+
+import json
+import os
+import stat
+import sys
+from pathlib import Path
+
+import nibabel as nib
+import numpy as np
+import pydicom
+import pydicom.uid
+from pydicom.dataset import Dataset, FileDataset, FileMetaDataset
+
+from xa30_workaround.dat import iter_dat_frames, slice_order
+
+# roughly the size of an XA30 enhanced DICOM header, ahead of the protocol
+HEADER_PADDING = 256 * 1024
+
+FAKE_DCM2NIIX = """#!{python}
+# Stand-in for dcm2niix: copies the pre-generated first echo into the output directory and
+# prints the lines that dcmdat2niix parses, reporting the DICOM files only if run with -v.
+import gzip
+import shutil
+import sys
+
+args = sys.argv[1:]
+if "-h" in args:
+    sys.exit(0)
+output_dir = args[args.index("-o") + 1] if "-o" in args else args[-1]
+compress = "-z" in args and args[args.index("-z") + 1] in ("y", "i")
+verbose = "-v" in args and args[args.index("-v") + 1] != "0"
+for template, name, dicom in {series!r}:
+    out = output_dir + "/" + name
+    if verbose:
+        print(f"Converting {{dicom}}")
+    if compress:
+        with open(template + ".nii", "rb") as src, gzip.open(out + ".nii.gz", "wb", compresslevel=1) as dst:
+            shutil.copyfileobj(src, dst)
+    else:
+        shutil.copyfile(template + ".nii", out + ".nii")
+    shutil.copyfile(template + ".json", out + ".json")
+    print(f"Convert 1 DICOM as {{out}} (x)")
+"""
+
+
+def echo_times(num_echoes):
+    """Echo times in microseconds, spaced like a multi-echo BOLD protocol."""
+    return [14000 + 24000 * i for i in range(num_echoes)]
+
+
+def magnitude_frames(matrix, num_echoes, num_frames, seed=0):
+    """Yield (echo, slice, row, col) magnitude frames: an ellipsoid decaying over echoes, with noise."""
+    rng = np.random.default_rng(seed)
+    x, y, z = matrix
+    grid = np.ogrid[-1 : 1 : z * 1j, -1 : 1 : y * 1j, -1 : 1 : x * 1j]
+    head = np.asarray(sum(axis**2 for axis in grid) < 0.8, dtype=np.float32)
+    # a gradient across the head, so that every flip of the volume is distinguishable
+    head *= 1000 + 500 * grid[0] + 300 * grid[1] + 200 * grid[2]
+    decay = np.exp(-np.asarray(echo_times(num_echoes), dtype=np.float32) / 40000)
+    base = head[np.newaxis] * decay[:, np.newaxis, np.newaxis, np.newaxis]
+    for _ in range(num_frames):
+        yield np.clip(base + rng.normal(0, 20, base.shape).astype(np.float32), 0, 4095).astype(np.uint16)
+
+
+def phase_frames(matrix, num_echoes, num_frames, seed=0):
+    """Yield (echo, slice, row, col) phase frames: wrapped ramps growing with echo time, with noise."""
+    rng = np.random.default_rng(seed)
+    x, y, z = matrix
+    grid = np.ogrid[0:z, 0:y, 0:x]
+    ramp = (7 * grid[0] + 3 * grid[1] + grid[2]).astype(np.float32)
+    scale = np.arange(1, num_echoes + 1, dtype=np.float32)[:, np.newaxis, np.newaxis, np.newaxis]
+    base = ramp[np.newaxis] * scale * 8
+    for _ in range(num_frames):
+        yield (np.mod(base + rng.normal(0, 30, base.shape), 4096)).astype(np.uint16)
+
+
+def write_dicom(path, num_echoes, num_slices, num_frames, series_uid, series_number=1):
+    """Write a stand-in DICOM file: the series tags and a Siemens ASCCONV protocol in a header-sized private element."""
+    lines = ["### ASCCONV BEGIN ###"]
+    lines += [f"alTE[{i}]\t = {te}" for i, te in enumerate(echo_times(num_echoes))]
+    lines += [
+        f"lContrasts\t = {num_echoes}",
+        f"lRepetitions\t = {num_frames - 1}",
+        f"sSliceArray.lSize\t = {num_slices}",
+        "sSliceArray.ucMode\t = 0x4",
+        "### ASCCONV END ###",
+    ]
+    protocol = b"\0" * HEADER_PADDING + "\n".join(lines).encode("latin-1") + b"\0" * 1024
+    # DICOM values have an even length
+    protocol += b"\0" * (len(protocol) % 2)
+    file_meta = FileMetaDataset()
+    file_meta.TransferSyntaxUID = pydicom.uid.ExplicitVRLittleEndian
+    file_meta.MediaStorageSOPClassUID = pydicom.uid.MRImageStorage
+    file_meta.MediaStorageSOPInstanceUID = pydicom.uid.generate_uid()
+    ds = FileDataset(str(path), Dataset(), file_meta=file_meta, preamble=b"\0" * 128)
+    if int(pydicom.__version__.split(".")[0]) < 3:
+        # pydicom 3 takes the encoding from the transfer syntax
+        ds.is_little_endian = True
+        ds.is_implicit_VR = False
+    ds.SeriesInstanceUID = series_uid
+    ds.SeriesNumber = series_number
+    ds.add_new((0x0029, 0x0010), "LO", "SIEMENS CSA HEADER")
+    ds.add_new((0x0029, 0x1020), "OB", protocol)
+    ds.save_as(str(path))
+
+
+def make_series(directory, matrix=(64, 64, 40), num_echoes=4, num_frames=10, phase=False, seed=0):
+    """Write a synthetic series into directory.
+
+    ``matrix`` is the (x, y, z) size of each volume. The directory gets one .dat file per frame, a
+    DICOM file with the protocol, and a ``template`` directory holding the first echo as dcm2niix
+    writes it (a NIfTI and its JSON sidecar), for the fake dcm2niix to copy. Returns a dict
+    describing the series.
+    """
+    directory = Path(directory)
+    template_dir = directory / "template"
+    template_dir.mkdir(parents=True, exist_ok=True)
+    x, y, z = matrix
+    shape = (num_echoes, z, y, x)
+
+    frames = (phase_frames if phase else magnitude_frames)(matrix, num_echoes, num_frames, seed)
+    dat_files = []
+    for i, frame in enumerate(frames):
+        dat_path = directory / f"frame_{i + 1:04d}.dat"
+        frame.tofile(dat_path)
+        dat_files.append(dat_path)
+
+    dicom = directory / "series.dcm"
+    series_uid = pydicom.uid.generate_uid(entropy_srcs=[str(directory.resolve())])
+    write_dicom(dicom, num_echoes, z, num_frames, series_uid)
+
+    # the first echo, decoded the way dcmdat2niix will and flipped like dcm2niix may store it
+    first_echo = np.empty((x, y, z, num_frames), dtype=np.int16)
+    order = slice_order(z, slice_mode="interleaved")
+    for i, frame in enumerate(iter_dat_frames(dat_files, shape, order=order)):
+        first_echo[..., i] = frame[..., 0]
+    first_echo = np.flip(first_echo, 0)
+    template = template_dir / "series"
+    nib.Nifti1Image(first_echo if num_frames > 1 else first_echo[..., 0], np.eye(4)).to_filename(f"{template}.nii")
+    metadata = {
+        "EchoTime": echo_times(num_echoes)[0] / 1e6,
+        "ConversionSoftware": "dcm2niix",
+        "ImageTypeText": ["ORIGINAL", "PRIMARY", "P" if phase else "M", "TE1", "ND"],
+        "SeriesNumber": 1,
+        "SeriesInstanceUID": series_uid,
+    }
+    with open(f"{template}.json", "w") as f:
+        json.dump(metadata, f)
+
+    return {
+        "directory": str(directory),
+        "dicom": str(dicom),
+        "dat_files": [str(path) for path in dat_files],
+        "shape": shape,
+        "order": order.tolist(),
+        "template": str(template),
+        "num_frames": num_frames,
+        "dat_bytes": sum(os.path.getsize(path) for path in dat_files),
+    }
+
+
+def write_fake_dcm2niix(bin_dir, series):
+    """Write a dcm2niix stand-in into bin_dir that "converts" each series to a NIfTI named after it."""
+    bin_dir = Path(bin_dir)
+    bin_dir.mkdir(parents=True, exist_ok=True)
+    path = bin_dir / "dcm2niix"
+    entries = [(info["template"], f"series{i}", info["dicom"]) for i, info in enumerate(series)]
+    path.write_text(FAKE_DCM2NIIX.format(python=sys.executable, series=entries))
+    path.chmod(path.stat().st_mode | stat.S_IXUSR | stat.S_IXGRP | stat.S_IXOTH)
+    return path
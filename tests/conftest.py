@@ -1,6 +1,9 @@
 import numpy as np
+import pydicom
+import pydicom.uid
 import pytest
 from pathlib import Path
+from pydicom.dataset import Dataset, FileDataset, FileMetaDataset
 
 
 @pytest.fixture
@@ -26,3 +29,27 @@ def sample_data(sample_shape):
     """Create sample uint16 data matching sample_shape."""
     np.random.seed(42)
     return np.random.randint(1, 1000, size=sample_shape, dtype=np.uint16)
+
+
+@pytest.fixture
+def dicom_file():
+    """Write minimal DICOM files of a series, with pydicom 2 or 3."""
+
+    def _make_dicom(path: Path, series_uid: str, **attributes) -> Path:
+        file_meta = FileMetaDataset()
+        file_meta.TransferSyntaxUID = pydicom.uid.ExplicitVRLittleEndian
+        file_meta.MediaStorageSOPClassUID = pydicom.uid.MRImageStorage
+        file_meta.MediaStorageSOPInstanceUID = pydicom.uid.generate_uid()
+        ds = FileDataset(str(path), Dataset(), file_meta=file_meta, preamble=b"\x00" * 128)
+        if int(pydicom.__version__.split(".")[0]) < 3:
+            # pydicom 3 takes the encoding from the transfer syntax
+            ds.is_little_endian = True
+            ds.is_implicit_VR = False
+        ds.SeriesInstanceUID = series_uid
+        for keyword, value in attributes.items():
+            setattr(ds, keyword, value)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        ds.save_as(str(path))
+        return path
+
+    return _make_dicom
@@ -0,0 +1,56 @@
+import json
+
+import pytest
+from xa30_workaround.batch import read_sessions, session_argv
+
+
+class TestReadSessions:
+    def test_csv(self, tmp_path):
+        """CSV rows should become sessions, with empty cells left out and args split like a shell."""
+        manifest = tmp_path / "sessions.csv"
+        manifest.write_text("dicom_dir,dat_dir,out_dir,args\ns1,dats,out/s1,-z y --jobs=2\n/data/s2,,,\n")
+        first, second = read_sessions(manifest)
+        assert first == {
+            "dicom_dir": tmp_path / "s1",
+            "dat_dir": tmp_path / "dats",
+            "out_dir": tmp_path / "out" / "s1",
+            "args": ["-z", "y", "--jobs=2"],
+        }
+        assert second == {"dicom_dir": tmp_path / "/data/s2", "dat_dir": None, "out_dir": None, "args": []}
+
+    def test_json(self, tmp_path):
+        """JSON sessions should take args as a list or a string."""
+        manifest = tmp_path / "sessions.json"
+        manifest.write_text(json.dumps([{"dicom_dir": "s1", "args": ["-z", "y"]}, {"dicom_dir": "s2", "args": "-b n"}]))
+        assert [session["args"] for session in read_sessions(manifest)] == [["-z", "y"], ["-b", "n"]]
+
+    @pytest.mark.parametrize(
+        "sessions, match",
+        [([{"dat_dir": "dats"}], "no dicom_dir"), ([{"dicom_dir": "s1", "outdir": "out"}], "unknown fields: outdir")],
+    )
+    def test_bad_session_raises(self, tmp_path, sessions, match):
+        """Sessions without a dicom_dir, or with misspelt fields, should be rejected."""
+        manifest = tmp_path / "sessions.json"
+        manifest.write_text(json.dumps(sessions))
+        with pytest.raises(ValueError, match=match):
+            read_sessions(manifest)
+
+
+def test_session_argv(tmp_path):
+    """The session's arguments should follow the common ones, with the DICOM directory last."""
+    session = {
+        "dicom_dir": tmp_path / "s1",
+        "dat_dir": tmp_path / "dats",
+        "out_dir": tmp_path / "out",
+        "args": ["-z", "y"],
+    }
+    assert session_argv(session, ["--jobs=2"]) == [
+        "--jobs=2",
+        "-z",
+        "y",
+        "--dat-dir",
+        str(tmp_path / "dats"),
+        "-o",
+        str(tmp_path / "out"),
+        str(tmp_path / "s1"),
+    ]
@@ -0,0 +1,23 @@
+import pytest
+
+from benchmarks.run import STAGES, format_results, run_benchmarks
+from benchmarks.synthetic import make_series, write_fake_dcm2niix
+
+
+@pytest.mark.parametrize("phase", [False, True])
+def test_smoke(tmp_path, phase):
+    """Every benchmark stage should run on a tiny synthetic series."""
+    series = make_series(tmp_path / "session", (8, 6, 4), num_echoes=2, num_frames=2, phase=phase)
+    options = {
+        "repeat": 1,
+        "jobs": 1,
+        "gzip": True,
+        "gzip_threads": 2,
+        "workdir": str(tmp_path),
+        "bin_dir": str(write_fake_dcm2niix(tmp_path / "bin", [series]).parent),
+    }
+    results = run_benchmarks(series, options, isolate=False)
+    assert [result["stage"] for result in results] == STAGES
+    for result in results:
+        assert result["seconds"] > 0 and result["peak_rss_mb"] > 0
+    assert "end_to_end_stream" in format_results(results)
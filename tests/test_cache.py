@@ -0,0 +1,64 @@
+import os
+import pickle
+from xa30_workaround.cache import HeaderCache
+
+
+class TestHeaderCache:
+    def test_miss_then_hit(self, tmp_path):
+        """Uncached files should give an empty entry, cached ones their fields."""
+        dicom = tmp_path / "a.dcm"
+        dicom.write_bytes(b"header")
+        cache = HeaderCache(tmp_path / "cache")
+        assert cache.get(dicom) == {}
+        cache.update(dicom, series_uid="1.2.3", echo_times=[0.01, 0.02])
+        assert cache.get(dicom) == {"series_uid": "1.2.3", "echo_times": [0.01, 0.02]}
+
+    def test_update_merges_fields(self, tmp_path):
+        """Updating should add to the existing entry rather than replace it."""
+        dicom = tmp_path / "a.dcm"
+        dicom.write_bytes(b"header")
+        cache = HeaderCache(tmp_path / "cache")
+        cache.update(dicom, echo_times=[0.01])
+        assert cache.update(dicom, series_uid="1.2.3") == {"echo_times": [0.01], "series_uid": "1.2.3"}
+
+    def test_persists_between_instances(self, tmp_path):
+        """A new cache over the same directory should see earlier entries."""
+        dicom = tmp_path / "a.dcm"
+        dicom.write_bytes(b"header")
+        HeaderCache(tmp_path / "cache").update(dicom, series_uid="1.2.3")
+        assert HeaderCache(tmp_path / "cache").get(dicom) == {"series_uid": "1.2.3"}
+
+    def test_changed_file_is_a_miss(self, tmp_path):
+        """Modifying a file should invalidate its entry."""
+        dicom = tmp_path / "a.dcm"
+        dicom.write_bytes(b"header")
+        cache = HeaderCache(tmp_path / "cache")
+        cache.update(dicom, series_uid="1.2.3")
+        dicom.write_bytes(b"a different header")
+        assert cache.get(dicom) == {}
+
+    def test_evicts_least_recently_used(self, tmp_path):
+        """Entries beyond max_entries should be evicted, least recently used first."""
+        cache = HeaderCache(tmp_path / "cache", max_entries=2)
+        dicoms = []
+        for i, name in enumerate(["a.dcm", "b.dcm", "c.dcm"]):
+            dicom = tmp_path / name
+            dicom.write_bytes(b"header")
+            os.utime(dicom, ns=(i, i))
+            dicoms.append(dicom)
+        cache.update(dicoms[0], series_uid="a")
+        cache.update(dicoms[1], series_uid="b")
+        # use a so that b is the least recently used
+        assert cache.get(dicoms[0]) == {"series_uid": "a"}
+        cache.update(dicoms[2], series_uid="c")
+        assert cache.get(dicoms[0]) == {"series_uid": "a"}
+        assert cache.get(dicoms[1]) == {}
+        assert cache.get(dicoms[2]) == {"series_uid": "c"}
+
+    def test_picklable(self, tmp_path):
+        """The cache should be picklable so that it can be shared with worker processes."""
+        dicom = tmp_path / "a.dcm"
+        dicom.write_bytes(b"header")
+        cache = HeaderCache(tmp_path / "cache")
+        cache.update(dicom, series_uid="1.2.3")
+        assert pickle.loads(pickle.dumps(cache)).get(dicom) == {"series_uid": "1.2.3"}
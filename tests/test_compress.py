@@ -0,0 +1,94 @@
+import gzip
+import io
+import random
+from unittest.mock import patch
+
+import pytest
+from xa30_workaround.compress import BLOCK_SIZE, ParallelGzipWriter, PigzWriter, default_threads, open_output
+
+
+def _data(size):
+    """Compressible but not trivial bytes."""
+    return bytes((i * 7 + i // 1000) % 251 for i in range(size))
+
+
+class TestParallelGzipWriter:
+    @pytest.mark.parametrize("threads", [1, 2, 4])
+    @pytest.mark.parametrize("size", [0, 10, BLOCK_SIZE, 3 * BLOCK_SIZE + 17])
+    def test_round_trip(self, tmp_path, threads, size):
+        """The output should be a standard gzip file holding exactly what was written."""
+        data = _data(size)
+        path = tmp_path / "out.gz"
+        with ParallelGzipWriter(path, level=6, threads=threads) as f:
+            # write in uneven pieces to cross block boundaries
+            for start in range(0, size, 50000):
+                f.write(data[start : start + 50000])
+            assert f.tell() == size
+        assert gzip.decompress(path.read_bytes()) == data
+
+    def test_dictionary_keeps_compression(self, tmp_path):
+        """Priming each block with the previous input should compress repeats across block boundaries."""
+        pattern = bytes(random.Random(0).randrange(256) for _ in range(20000))
+        path = tmp_path / "out.gz"
+        with ParallelGzipWriter(path, threads=2) as f:
+            f.write(pattern * (4 * BLOCK_SIZE // len(pattern)))
+        # without the dictionary each block would start with the whole pattern as literals
+        assert path.stat().st_size < 1.5 * len(pattern)
+
+    def test_only_sequential_seeks(self, tmp_path):
+        """Seeking anywhere but the current position is unsupported."""
+        with ParallelGzipWriter(tmp_path / "out.gz", threads=2) as f:
+            f.write(b"abc")
+            assert f.seek(3) == 3
+            with pytest.raises(io.UnsupportedOperation):
+                f.seek(0)
+
+
+class TestPigzWriter:
+    def test_round_trip(self, tmp_path):
+        """Data should be piped through the external compressor."""
+        data = _data(BLOCK_SIZE + 5)
+        path = tmp_path / "out.gz"
+        # gzip takes the same arguments as pigz, apart from the thread count
+        with PigzWriter(path, level=6, pigz="gzip") as f:
+            f.write(data)
+        assert gzip.decompress(path.read_bytes()) == data
+
+    def test_failure_raises(self, tmp_path):
+        """A failing compressor should raise."""
+        with pytest.raises(RuntimeError, match="pigz failed"):
+            with PigzWriter(tmp_path / "out.gz", pigz="false") as f:
+                f.write(b"abc")
+
+
+class TestOpenOutput:
+    def test_uncompressed(self, tmp_path):
+        """Files without .gz should be opened as plain files."""
+        with open_output(tmp_path / "out.nii") as f:
+            assert not isinstance(f, (ParallelGzipWriter, PigzWriter, gzip.GzipFile))
+
+    def test_single_thread_uses_gzip(self, tmp_path):
+        """One thread should use plain gzip."""
+        with open_output(tmp_path / "out.nii.gz", threads=1) as f:
+            assert isinstance(f, gzip.GzipFile)
+
+    def test_prefers_pigz(self, tmp_path):
+        """pigz should be used when it is on the PATH."""
+        with patch("xa30_workaround.compress.shutil.which", return_value="gzip"):
+            with patch("xa30_workaround.compress.PigzWriter") as writer:
+                open_output(tmp_path / "out.nii.gz", threads=2)
+        writer.assert_called_once()
+
+    def test_falls_back_to_threads(self, tmp_path):
+        """Without pigz, blocks should be compressed on a thread pool."""
+        with patch("xa30_workaround.compress.shutil.which", return_value=None):
+            with open_output(tmp_path / "out.nii.gz", threads=2) as f:
+                assert isinstance(f, ParallelGzipWriter)
+
+
+class TestDefaultThreads:
+    @pytest.mark.parametrize("writers, expected", [(1, 8), (2, 4), (3, 2), (8, 1), (16, 1)])
+    def test_shares_cpus_between_writers(self, writers, expected):
+        """The available CPUs should be split between the outputs written at once, leaving each at least one."""
+        with patch("xa30_workaround.compress.available_cpus", return_value=8):
+            assert default_threads(writers) == expected
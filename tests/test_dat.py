@@ -1,6 +1,16 @@
+from unittest.mock import patch
+
 import numpy as np
 import pytest
-from xa30_workaround.dat import dat_to_array
+from xa30_workaround.dat import (
+    DatIndex,
+    DatSeries,
+    check_dat_sizes,
+    dat_to_array,
+    iter_dat_frames,
+    slice_order,
+    slice_slots,
+)
 
 
 class TestDatToArray:
@@ -71,3 +81,308 @@ class TestDatToArray:
         dat_path = tmp_dat_file(data, "bad.dat")
         with pytest.raises(ValueError):
             dat_to_array([dat_path], (3, 3, 3, 3))
+
+
+def _reference_dat_to_array(dat_files, shape):
+    """The original read/reindex/stack implementation, used as an oracle."""
+    frame_list = []
+    for dat_path in sorted(dat_files):
+        data = np.fromfile(dat_path, dtype=np.uint16).reshape(*shape)
+        num_slices = data.shape[1]
+        indices = np.argsort(np.concatenate((np.arange(1, num_slices, 2), np.arange(0, num_slices, 2))))
+        data = np.flip(np.moveaxis(data[:, indices, :, :], [0, 1, 2, 3], [3, 2, 1, 0]), 1)
+        frame_list.append(data)
+    return np.stack(frame_list, axis=-1)
+
+
+class TestPreallocatedAssembly:
+    def _make_frames(self, tmp_dat_file, shape, num_frames=3):
+        rng = np.random.RandomState(4)
+        return [
+            tmp_dat_file(rng.randint(1, 1000, size=shape, dtype=np.uint16), f"frame_{i:03d}.dat")
+            for i in range(num_frames)
+        ]
+
+    def test_matches_reference(self, tmp_dat_file):
+        """The preallocated path should produce exactly what read/reindex/stack produced."""
+        shape = (2, 5, 3, 4)
+        paths = self._make_frames(tmp_dat_file, shape)
+        assert np.array_equal(dat_to_array(paths, shape), _reference_dat_to_array(paths, shape))
+
+    def test_mmap_matches_reference(self, tmp_dat_file):
+        """Memory-mapped input should give the same result as buffered reads."""
+        shape = (2, 5, 3, 4)
+        paths = self._make_frames(tmp_dat_file, shape)
+        assert np.array_equal(dat_to_array(paths, shape, mmap=True), _reference_dat_to_array(paths, shape))
+
+    def test_writes_into_out(self, tmp_dat_file, tmp_path):
+        """A supplied output array (e.g. a memmap) should be filled in place and returned."""
+        shape = (2, 4, 3, 3)
+        paths = self._make_frames(tmp_dat_file, shape)
+        out = np.memmap(tmp_path / "out.bin", dtype=np.uint16, mode="w+", shape=(3, 3, 4, 2, 3))
+        result = dat_to_array(paths, shape, out=out)
+        assert result is out
+        assert np.array_equal(out, _reference_dat_to_array(paths, shape))
+
+    def test_echoes_are_contiguous(self, tmp_dat_file):
+        """Each echo should be a single Fortran-contiguous block, ready to be written as a NIfTI."""
+        shape = (3, 4, 3, 5)
+        paths = self._make_frames(tmp_dat_file, shape)
+        result = dat_to_array(paths, shape)
+        for echo in range(3):
+            assert result[..., echo, :].flags.f_contiguous
+        for frame in iter_dat_frames(paths, shape):
+            assert all(frame[..., echo].flags.f_contiguous for echo in range(3))
+
+    @pytest.mark.parametrize("axes", [(0,), (1, 2), (0, 1, 2)])
+    def test_flip_axes_decoded_in_place(self, tmp_dat_file, axes):
+        """Flipped frames should be decoded straight into a flipped layout, keeping each echo contiguous."""
+        shape = (3, 4, 3, 5)
+        paths = self._make_frames(tmp_dat_file, shape)
+        result = dat_to_array(paths, shape, flip_axes=axes)
+        assert np.array_equal(result, np.flip(_reference_dat_to_array(paths, shape), axes))
+        for echo in range(3):
+            assert result[..., echo, :].flags.f_contiguous
+
+    def test_empty_file_raises_with_mmap(self, tmp_path):
+        """An empty .dat file should raise RuntimeError when memory-mapping too."""
+        empty_path = tmp_path / "empty.dat"
+        empty_path.write_bytes(b"")
+        with pytest.raises(RuntimeError, match="contains no data"):
+            dat_to_array([empty_path], (2, 4, 3, 3), mmap=True)
+
+
+class TestSliceOrder:
+    def test_default_is_interleaved(self):
+        """Without timing or protocol, slices should be taken as interleaved, odd slices first."""
+        assert slice_order(6).tolist() == [1, 3, 5, 0, 2, 4]
+
+    @pytest.mark.parametrize(
+        "mode, expected",
+        [("ascending", [0, 1, 2, 3, 4]), ("descending", [4, 3, 2, 1, 0]), ("interleaved", [1, 3, 0, 2, 4])],
+    )
+    def test_protocol_modes(self, mode, expected):
+        """The protocol's slice mode should give the acquisition order."""
+        assert slice_order(5, slice_mode=mode).tolist() == expected
+
+    def test_multiband_packages(self):
+        """Each multiband package should repeat the order, with simultaneous slices together."""
+        assert slice_order(8, slice_mode="interleaved", multiband_factor=2).tolist() == [1, 5, 3, 7, 0, 4, 2, 6]
+
+    def test_slice_timing(self):
+        """Slices should be ordered by their acquisition time, simultaneous slices in spatial order."""
+        assert slice_order(4, [0.5, 0.0, 0.5, 0.0]).tolist() == [1, 3, 0, 2]
+
+    def test_slice_timing_length_mismatch_raises(self):
+        """Slice timing for a different number of slices is an error."""
+        with pytest.raises(ValueError, match="slice timing"):
+            slice_order(4, [0.0, 0.5])
+
+    @pytest.mark.parametrize("order", [[0, 1, 2, 3], [3, 2, 1, 0], [1, 3, 0, 2]])
+    def test_slots_match_order(self, order):
+        """Regular orders should become basic slices that select the same slots."""
+        slots = slice_slots(order)
+        assert isinstance(slots, slice) == (order != [1, 3, 0, 2])
+        assert np.arange(4)[slots].tolist() == order
+
+    @pytest.mark.parametrize("mode", ["ascending", "descending"])
+    def test_dat_to_array_order(self, tmp_dat_file, mode):
+        """Raw slices should land in the slots given by the order."""
+        shape = (2, 5, 3, 4)
+        data = np.random.RandomState(6).randint(1, 1000, size=shape, dtype=np.uint16)
+        order = slice_order(5, slice_mode=mode)
+        result = dat_to_array([tmp_dat_file(data, "frame_001.dat")], shape, order=order)
+        frames = list(iter_dat_frames([tmp_dat_file(data, "frame_001.dat")], shape, order=order))
+        expected = np.empty_like(data)
+        expected[:, order] = data
+        expected = np.flip(np.moveaxis(expected, [0, 1, 2, 3], [3, 2, 1, 0]), 1)
+        assert np.array_equal(result[..., 0], expected)
+        assert np.array_equal(frames[0], expected)
+
+
+class TestDatSeries:
+    shape = (3, 5, 4, 6)
+
+    def _make_series(self, tmp_dat_file, num_frames=4):
+        rng = np.random.RandomState(8)
+        paths = [
+            tmp_dat_file(rng.randint(1, 1000, size=self.shape, dtype=np.uint16), f"frame_{i:03d}.dat")
+            for i in range(num_frames)
+        ]
+        return paths, dat_to_array(paths, self.shape)
+
+    def test_shape(self, tmp_dat_file):
+        """The series should have the (x, y, z, echo, frame) shape of dat_to_array."""
+        paths, expected = self._make_series(tmp_dat_file)
+        series = DatSeries(paths, self.shape)
+        assert series.shape == expected.shape
+        assert series.dtype == expected.dtype
+
+    def test_asarray_matches_dat_to_array(self, tmp_dat_file):
+        """Reading the whole series should match dat_to_array."""
+        paths, expected = self._make_series(tmp_dat_file)
+        assert np.array_equal(np.asarray(DatSeries(paths, self.shape)), expected)
+
+    @pytest.mark.parametrize(
+        "key",
+        [
+            (..., 0, slice(1, 3)),
+            (..., 1, 2),
+            (..., slice(None, None, 2), -1),
+            (slice(1, 4), 2, ..., [0, 2], slice(None)),
+            (0,),
+            (...,),
+        ],
+    )
+    def test_slicing_matches_array(self, tmp_dat_file, key):
+        """Lazy slicing should match slicing the assembled array."""
+        paths, expected = self._make_series(tmp_dat_file)
+        assert np.array_equal(DatSeries(paths, self.shape)[key], expected[key])
+
+    def test_reads_only_requested_frames(self, tmp_dat_file):
+        """Frames outside the index should never be opened."""
+        paths, expected = self._make_series(tmp_dat_file)
+        series = DatSeries(paths, self.shape)
+        for path in paths[1:]:
+            path.unlink()
+        assert np.array_equal(series[..., 0, 0], expected[..., 0, 0])
+        assert np.array_equal(series[..., 0], expected[..., 0])
+
+    def test_flip_axes(self, tmp_dat_file):
+        """The orientation flip should be applied to the spatial axes."""
+        paths, expected = self._make_series(tmp_dat_file)
+        series = DatSeries(paths, self.shape, flip_axes=(0, 2))
+        assert np.array_equal(series[1:3, ..., 1, :2], np.flip(expected, (0, 2))[1:3, ..., 1, :2])
+
+    def test_order(self, tmp_dat_file):
+        """The slice order should be applied like dat_to_array."""
+        paths, _ = self._make_series(tmp_dat_file)
+        order = slice_order(5, slice_mode="ascending")
+        expected = dat_to_array(paths, self.shape, order=order)
+        assert np.array_equal(DatSeries(paths, self.shape, order=order)[..., 2, :], expected[..., 2, :])
+
+    def test_too_many_indices_raises(self, tmp_dat_file):
+        """More indices than dimensions is an error."""
+        paths, _ = self._make_series(tmp_dat_file)
+        with pytest.raises(IndexError, match="too many indices"):
+            DatSeries(paths, self.shape)[0, 0, 0, 0, 0, 0]
+
+
+class TestCheckDatSizes:
+    def test_valid_files(self, tmp_dat_file):
+        """Files holding exactly one frame should pass."""
+        shape = (2, 3, 4, 5)
+        paths = [tmp_dat_file(np.ones(shape, dtype=np.uint16), f"frame_{i}.dat") for i in range(2)]
+        assert check_dat_sizes(paths, shape) == []
+
+    def test_reports_every_problem(self, tmp_dat_file, tmp_path):
+        """Empty, truncated, oversized and missing files should all be reported."""
+        shape = (2, 3, 4, 5)
+        paths = [
+            tmp_dat_file(np.ones(0, dtype=np.uint16), "empty.dat"),
+            tmp_dat_file(np.ones(10, dtype=np.uint16), "short.dat"),
+            tmp_dat_file(np.ones(200, dtype=np.uint16), "long.dat"),
+            tmp_path / "missing.dat",
+        ]
+        problems = check_dat_sizes(paths, shape)
+        assert len(problems) == 4
+        assert "contains no data" in problems[0]
+        assert "truncated: 20 bytes, expected 240" in problems[1]
+        assert "too large: 400 bytes" in problems[2]
+        assert "could not be read" in problems[3]
+
+    def test_reads_nothing(self, tmp_dat_file):
+        """Only the file sizes should be checked."""
+        path = tmp_dat_file(np.ones(10, dtype=np.uint16), "short.dat")
+        with patch("numpy.fromfile", side_effect=AssertionError("read")):
+            assert check_dat_sizes([path], (1, 1, 2, 5)) == []
+
+
+class TestParallelDecode:
+    def _make_frames(self, tmp_dat_file, shape, num_frames=7):
+        rng = np.random.RandomState(5)
+        # write the files out of order to check that frame ordering is deterministic
+        return [
+            tmp_dat_file(rng.randint(1, 1000, size=shape, dtype=np.uint16), f"frame_{i:03d}.dat")
+            for i in reversed(range(num_frames))
+        ]
+
+    @pytest.mark.parametrize("workers", [2, 4])
+    def test_dat_to_array_matches_serial(self, tmp_dat_file, workers):
+        """Decoding on a thread pool should give the same array as decoding serially."""
+        shape = (2, 5, 3, 4)
+        paths = self._make_frames(tmp_dat_file, shape)
+        assert np.array_equal(dat_to_array(paths, shape, workers=workers), _reference_dat_to_array(paths, shape))
+
+    @pytest.mark.parametrize("workers", [1, 2, 3])
+    def test_iter_dat_frames_matches_serial(self, tmp_dat_file, workers):
+        """Frames should come out in sorted order whether or not they are decoded ahead."""
+        shape = (2, 5, 3, 4)
+        paths = self._make_frames(tmp_dat_file, shape)
+        frames = [frame.copy() for frame in iter_dat_frames(paths, shape, workers=workers)]
+        assert np.array_equal(np.stack(frames, axis=-1), _reference_dat_to_array(paths, shape))
+
+    @pytest.mark.parametrize("workers", [1, 2])
+    def test_errors_propagate(self, tmp_dat_file, tmp_path, workers):
+        """An error decoding any frame should be raised to the caller."""
+        shape = (2, 5, 3, 4)
+        paths = self._make_frames(tmp_dat_file, shape, num_frames=3)
+        empty_path = tmp_path / "frame_001.dat"
+        empty_path.write_bytes(b"")
+        with pytest.raises(RuntimeError, match="contains no data"):
+            dat_to_array(paths, shape, workers=workers)
+        with pytest.raises(RuntimeError, match="contains no data"):
+            list(iter_dat_frames(paths, shape, workers=workers))
+
+
+class TestDatIndex:
+    SID = "1.3.12.2.1107.5.2.43.166158.2023072109355378899049069"
+    OTHER_SID = "1.3.12.2.1107.5.2.43.166158.2023072110111122233344455"
+
+    def _touch(self, directory, names):
+        for name in names:
+            (directory / name).write_bytes(b"\x00\x00")
+
+    def test_finds_series_files_sorted(self, tmp_path):
+        """Files should be grouped by the UID in their name and sorted."""
+        self._touch(
+            tmp_path,
+            [f"img_{self.SID}_002.dat", f"img_{self.SID}_001.dat", f"img_{self.OTHER_SID}_001.dat", "notes.txt"],
+        )
+        index = DatIndex(tmp_path)
+        assert [p.name for p in index.find(self.SID)] == [f"img_{self.SID}_001.dat", f"img_{self.SID}_002.dat"]
+        assert len(index.find(self.OTHER_SID)) == 1
+        assert index.find("1.2.3") == []
+
+    def test_matches_glob(self, tmp_path):
+        """Lookups should find the same files as globbing for the UID, skipping hidden files."""
+        self._touch(
+            tmp_path,
+            [
+                f"img_{self.SID}_001.dat",
+                f"MR.{self.SID}.0.0.0.dat",
+                f".img_{self.SID}_001.dat",
+                f"img_{self.OTHER_SID}_001.dat",
+            ],
+        )
+        index = DatIndex(tmp_path)
+        assert index.find(self.SID) == sorted(tmp_path.glob(f"[!.]*{self.SID}*.dat"))
+
+    def test_longer_uid_is_a_different_series(self, tmp_path):
+        """A UID that only starts with the series UID belongs to another series."""
+        self._touch(tmp_path, [f"img_{self.SID}_001.dat", f"img_{self.SID}5_001.dat"])
+        assert [p.name for p in DatIndex(tmp_path).find(self.SID)] == [f"img_{self.SID}_001.dat"]
+
+    def test_files_lists_every_dat(self, tmp_path):
+        """All .dat files should be listed, like globbing for *.dat."""
+        self._touch(tmp_path, ["frame_001.dat", "frame_000.dat", "scan.dcm"])
+        (tmp_path / "subdir.dat").mkdir()
+        assert DatIndex(tmp_path).files == [tmp_path / "frame_000.dat", tmp_path / "frame_001.dat"]
+
+    def test_lists_directory_once(self, tmp_path):
+        """Lookups should not list the directory again."""
+        self._touch(tmp_path, [f"img_{self.SID}_001.dat"])
+        index = DatIndex(tmp_path)
+        with patch("os.scandir", side_effect=AssertionError("listed again")):
+            assert len(index.find(self.SID)) == 1
+            assert index.find(self.OTHER_SID) == []
@@ -1,4 +1,7 @@
 import json
+import os
+import threading
+import time
 import numpy as np
 import nibabel as nib
 import pytest
@@ -6,9 +9,23 @@ import argparse
 from pathlib import Path
 from unittest.mock import patch, MagicMock  # noqa: F401 - used for import-time patching
 
+from xa30_workaround.dat import dat_to_array
+from xa30_workaround.nifti import output_image
+from xa30_workaround.orientation import match_orientation, normalize
+
 # Patch dcm2niix check that runs at dicom.py import time
 with patch("subprocess.run"):
-    from xa30_workaround.scripts.dcmdat2niix import normalize, match_orientation, dir_path, main
+    from xa30_workaround.scripts.dcmdat2niix import (
+        dir_path,
+        main,
+        parse_args,
+        positive_int,
+        memory_size,
+        compression_level,
+        estimate_series_memory,
+        series_slice_orders,
+        session_complete,
+    )
 
 
 class TestNormalize:
@@ -132,6 +149,47 @@ class TestDirPath:
         assert dir_path(None) is None
 
 
+class TestPositiveInt:
+    def test_valid(self):
+        """Should return the integer for a positive integer string."""
+        assert positive_int("4") == 4
+
+    @pytest.mark.parametrize("value", ["0", "-2", "four"])
+    def test_invalid_raises(self, value):
+        """Should raise ArgumentTypeError for anything but a positive integer."""
+        with pytest.raises(argparse.ArgumentTypeError, match="Expected a positive integer"):
+            positive_int(value)
+
+
+class TestMemorySize:
+    @pytest.mark.parametrize("value, expected", [("512M", 512 * 1024**2), ("16G", 16 * 1024**3), ("2gb", 2 * 1024**3)])
+    def test_valid(self, value, expected):
+        """Should parse sizes with unit suffixes into bytes."""
+        assert memory_size(value) == expected
+
+    def test_plain_bytes(self):
+        """A number without a unit should be taken as bytes."""
+        assert memory_size("4096") == 4096
+
+    @pytest.mark.parametrize("value", ["0", "-1G", "lots"])
+    def test_invalid_raises(self, value):
+        """Should raise ArgumentTypeError for anything but a positive size."""
+        with pytest.raises(argparse.ArgumentTypeError, match="Expected a memory size"):
+            memory_size(value)
+
+
+class TestCompressionLevel:
+    def test_valid(self):
+        """Levels 1 to 9 should be accepted."""
+        assert compression_level("9") == 9
+
+    @pytest.mark.parametrize("value", ["0", "10", "fast"])
+    def test_invalid_raises(self, value):
+        """Should raise ArgumentTypeError outside 1 to 9."""
+        with pytest.raises(argparse.ArgumentTypeError, match="compression level"):
+            compression_level(value)
+
+
 def _make_fake_dicom(path, te_values):
     """Create a fake DICOM-like binary file with an alTE section."""
     lines = [b"some binary header data\n"]
@@ -208,19 +266,16 @@ def main_workspace(tmp_path):
 class TestMain:
     """Tests for the main() entry point."""
 
-    @patch("xa30_workaround.scripts.dcmdat2niix.dicom2nifti")
-    @patch("xa30_workaround.scripts.dcmdat2niix.match_orientation")
+    @patch("xa30_workaround.scripts.dcmdat2niix.iter_dicom2nifti")
+    @patch("xa30_workaround.scripts.dcmdat2niix.resolve_orientation")
     def test_basic_run(self, mock_orient, mock_dcm2nii, main_workspace):
         """main() should produce echo NIFTI files for each TE."""
         ws = main_workspace
-        # dicom2nifti returns map of nifti stem -> dicom path
-        mock_dcm2nii.return_value = {ws["nifti_stem"]: ws["dicom_path"]}
-
-        # match_orientation just passes data through
-        def passthrough(dat, nifti_data):
-            return dat
+        # iter_dicom2nifti yields pairs of nifti stem and dicom path
+        mock_dcm2nii.return_value = {ws["nifti_stem"]: ws["dicom_path"]}.items()
 
-        mock_orient.side_effect = passthrough
+        # the .dat data is taken as it is, without a flip
+        mock_orient.return_value = ()
 
         with patch("sys.argv", ["dcmdat2niix", str(ws["dicom_dir"])]):
             main()
@@ -238,13 +293,26 @@ class TestMain:
         assert meta["ConversionSoftware"] == "dcmdat2niix"
         assert "TE2" in meta["ImageTypeText"]
 
-    @patch("xa30_workaround.scripts.dcmdat2niix.dicom2nifti")
-    @patch("xa30_workaround.scripts.dcmdat2niix.match_orientation")
+    def test_echo_label_only_replaced_in_filename(self, tmp_path):
+        """An "e1" in a directory name should be left alone."""
+        dicom_dir = tmp_path / "site1"
+        dicom_dir.mkdir()
+        nifti_stem, dicom_path, _ = _make_matching_series(dicom_dir, "scan", 2)
+        with patch(
+            "xa30_workaround.scripts.dcmdat2niix.iter_dicom2nifti", return_value={nifti_stem: dicom_path}.items()
+        ):
+            with patch("sys.argv", ["dcmdat2niix", str(dicom_dir)]):
+                main()
+        assert (dicom_dir / "scan_e2.nii").exists()
+        assert (dicom_dir / "scan_e2.json").exists()
+
+    @patch("xa30_workaround.scripts.dcmdat2niix.iter_dicom2nifti")
+    @patch("xa30_workaround.scripts.dcmdat2niix.resolve_orientation")
     def test_renames_first_echo(self, mock_orient, mock_dcm2nii, main_workspace):
         """First echo should be renamed to include _e1 if not present."""
         ws = main_workspace
-        mock_dcm2nii.return_value = {ws["nifti_stem"]: ws["dicom_path"]}
-        mock_orient.side_effect = lambda dat, nifti_data: dat
+        mock_dcm2nii.return_value = {ws["nifti_stem"]: ws["dicom_path"]}.items()
+        mock_orient.return_value = ()
 
         with patch("sys.argv", ["dcmdat2niix", str(ws["dicom_dir"])]):
             main()
@@ -253,11 +321,11 @@ class TestMain:
         e1_nii = Path(ws["nifti_stem"].replace("test_scan", "test_scan_e1") + ".nii")
         assert e1_nii.exists()
 
-    @patch("xa30_workaround.scripts.dcmdat2niix.dicom2nifti")
+    @patch("xa30_workaround.scripts.dcmdat2niix.iter_dicom2nifti")
     def test_no_dat_files_skips(self, mock_dcm2nii, main_workspace, capsys):
         """If no .dat files found, the nifti should be skipped."""
         ws = main_workspace
-        mock_dcm2nii.return_value = {ws["nifti_stem"]: ws["dicom_path"]}
+        mock_dcm2nii.return_value = {ws["nifti_stem"]: ws["dicom_path"]}.items()
 
         # Remove the .dat file
         ws["dat_file"].unlink()
@@ -268,11 +336,11 @@ class TestMain:
         captured = capsys.readouterr()
         assert "Could not find any .dat files" in captured.out
 
-    @patch("xa30_workaround.scripts.dcmdat2niix.dicom2nifti")
+    @patch("xa30_workaround.scripts.dcmdat2niix.iter_dicom2nifti")
     def test_missing_alte_raises(self, mock_dcm2nii, main_workspace):
         """Should raise ValueError if DICOM has no alTE tag."""
         ws = main_workspace
-        mock_dcm2nii.return_value = {ws["nifti_stem"]: ws["dicom_path"]}
+        mock_dcm2nii.return_value = {ws["nifti_stem"]: ws["dicom_path"]}.items()
 
         # Overwrite dicom with no alTE
         ws["dicom_path"].write_bytes(b"no echo time info here\n")
@@ -281,11 +349,11 @@ class TestMain:
             with pytest.raises(ValueError, match="Could not find alTE tag"):
                 main()
 
-    @patch("xa30_workaround.scripts.dcmdat2niix.dicom2nifti")
+    @patch("xa30_workaround.scripts.dcmdat2niix.iter_dicom2nifti")
     def test_missing_json_raises(self, mock_dcm2nii, main_workspace):
         """Should raise ValueError if JSON sidecar is missing."""
         ws = main_workspace
-        mock_dcm2nii.return_value = {ws["nifti_stem"]: ws["dicom_path"]}
+        mock_dcm2nii.return_value = {ws["nifti_stem"]: ws["dicom_path"]}.items()
 
         # Remove the JSON file
         Path(ws["nifti_stem"] + ".json").unlink()
@@ -294,11 +362,11 @@ class TestMain:
             with pytest.raises(ValueError, match="Could not find json file"):
                 main()
 
-    @patch("xa30_workaround.scripts.dcmdat2niix.dicom2nifti")
+    @patch("xa30_workaround.scripts.dcmdat2niix.iter_dicom2nifti")
     def test_missing_nifti_raises(self, mock_dcm2nii, main_workspace):
         """Should raise ValueError if NIFTI image file is missing."""
         ws = main_workspace
-        mock_dcm2nii.return_value = {ws["nifti_stem"]: ws["dicom_path"]}
+        mock_dcm2nii.return_value = {ws["nifti_stem"]: ws["dicom_path"]}.items()
 
         # Remove the nifti file
         Path(ws["nifti_stem"] + ".nii").unlink()
@@ -307,42 +375,48 @@ class TestMain:
             with pytest.raises(ValueError, match="Could not find nifti file"):
                 main()
 
-    @patch("xa30_workaround.scripts.dcmdat2niix.dicom2nifti")
-    def test_verbose_flag_conflict_raises(self, mock_dcm2nii, main_workspace):
-        """Should raise ValueError if -v is already in args."""
+    @patch("xa30_workaround.scripts.dcmdat2niix.iter_dicom2nifti")
+    def test_dcm2niix_arguments_passed_unchanged(self, mock_dcm2nii, main_workspace):
+        """dcm2niix should get the arguments as given, without a verbose flag added and with -v allowed."""
         ws = main_workspace
+        mock_dcm2nii.return_value = iter([])
+
+        with patch("sys.argv", ["dcmdat2niix", "-z", "y", str(ws["dicom_dir"])]):
+            main()
+        mock_dcm2nii.assert_called_with("-z", "y", str(ws["dicom_dir"]))
 
         with patch("sys.argv", ["dcmdat2niix", "-v", "1", str(ws["dicom_dir"])]):
-            with pytest.raises(ValueError, match="Turn off verbose output"):
-                main()
+            main()
+        mock_dcm2nii.assert_called_with("-v", "1", str(ws["dicom_dir"]))
 
     def test_help_flag_exits(self, capsys):
         """--help should print help and exit."""
         with patch("sys.argv", ["dcmdat2niix", "--help"]):
-            with patch("xa30_workaround.scripts.dcmdat2niix.dicom2nifti"):
+            with patch("xa30_workaround.scripts.dcmdat2niix.dcm2niix_help", return_value="dcm2niix help\n"):
                 with pytest.raises(SystemExit) as exc_info:
                     main()
                 assert exc_info.value.code == 0
 
         captured = capsys.readouterr()
         assert "dcmdat2niix Version" in captured.out
+        assert captured.out.endswith("dcm2niix help\n")
 
-    @patch("xa30_workaround.scripts.dcmdat2niix.dicom2nifti")
-    @patch("xa30_workaround.scripts.dcmdat2niix.match_orientation")
+    @patch("xa30_workaround.scripts.dcmdat2niix.iter_dicom2nifti")
+    @patch("xa30_workaround.scripts.dcmdat2niix.resolve_orientation")
     def test_output_dir_created(self, mock_orient, mock_dcm2nii, main_workspace):
         """If -o is specified, the output directory should be created."""
         ws = main_workspace
         out_dir = ws["tmp_path"] / "output" / "nested"
-        mock_dcm2nii.return_value = {ws["nifti_stem"]: ws["dicom_path"]}
-        mock_orient.side_effect = lambda dat, nifti_data: dat
+        mock_dcm2nii.return_value = {ws["nifti_stem"]: ws["dicom_path"]}.items()
+        mock_orient.return_value = ()
 
         with patch("sys.argv", ["dcmdat2niix", "-o", str(out_dir), str(ws["dicom_dir"])]):
             main()
 
         assert out_dir.exists()
 
-    @patch("xa30_workaround.scripts.dcmdat2niix.dicom2nifti")
-    @patch("xa30_workaround.scripts.dcmdat2niix.match_orientation")
+    @patch("xa30_workaround.scripts.dcmdat2niix.iter_dicom2nifti")
+    @patch("xa30_workaround.scripts.dcmdat2niix.resolve_orientation")
     def test_echo_prefix_for_complex_images(self, mock_orient, mock_dcm2nii, tmp_path):
         """Phase images (_ph) should be handled with echo prefix insertion."""
         dicom_dir = tmp_path / "dcm"
@@ -367,8 +441,8 @@ class TestMain:
         dat_data = rng.randint(10, 1000, size=(2 * 6 * 5 * 4,), dtype=np.uint16)
         (dicom_dir / "frame_001.dat").write_bytes(dat_data.tobytes())
 
-        mock_dcm2nii.return_value = {nifti_stem: dicom_path}
-        mock_orient.side_effect = lambda dat, nifti_data: dat
+        mock_dcm2nii.return_value = {nifti_stem: dicom_path}.items()
+        mock_orient.return_value = ()
 
         with patch("sys.argv", ["dcmdat2niix", str(dicom_dir)]):
             main()
@@ -377,8 +451,8 @@ class TestMain:
         e1_ph = dicom_dir / "scan_e1_ph.nii"
         assert e1_ph.exists()
 
-    @patch("xa30_workaround.scripts.dcmdat2niix.dicom2nifti")
-    @patch("xa30_workaround.scripts.dcmdat2niix.match_orientation")
+    @patch("xa30_workaround.scripts.dcmdat2niix.iter_dicom2nifti")
+    @patch("xa30_workaround.scripts.dcmdat2niix.resolve_orientation")
     def test_multiframe_nifti(self, mock_orient, mock_dcm2nii, tmp_path):
         """4D nifti (with time points) should process correctly."""
         dicom_dir = tmp_path / "dicom"
@@ -406,8 +480,8 @@ class TestMain:
             dat_data = rng.randint(10, 1000, size=(2 * 6 * 5 * 4,), dtype=np.uint16)
             (dicom_dir / f"frame_{i + 1:03d}.dat").write_bytes(dat_data.tobytes())
 
-        mock_dcm2nii.return_value = {nifti_stem: dicom_path}
-        mock_orient.side_effect = lambda dat, nifti_data: dat
+        mock_dcm2nii.return_value = {nifti_stem: dicom_path}.items()
+        mock_orient.return_value = ()
 
         with patch("sys.argv", ["dcmdat2niix", str(dicom_dir)]):
             main()
@@ -416,8 +490,8 @@ class TestMain:
         e2_nii = dicom_dir / "test_scan_e2.nii"
         assert e2_nii.exists()
 
-    @patch("xa30_workaround.scripts.dcmdat2niix.dicom2nifti")
-    @patch("xa30_workaround.scripts.dcmdat2niix.match_orientation")
+    @patch("xa30_workaround.scripts.dcmdat2niix.iter_dicom2nifti")
+    @patch("xa30_workaround.scripts.dcmdat2niix.resolve_orientation")
     def test_dat_dir_option(self, mock_orient, mock_dcm2nii, tmp_path):
         """--dat-dir should search for dat files in the specified directory."""
         dicom_dir = tmp_path / "dicom"
@@ -466,8 +540,8 @@ class TestMain:
         dat_data = rng.randint(10, 1000, size=(2 * 6 * 5 * 4,), dtype=np.uint16)
         (dat_dir / f"img_{sid_prefix}_001.dat").write_bytes(dat_data.tobytes())
 
-        mock_dcm2nii.return_value = {nifti_stem: dicom_path}
-        mock_orient.side_effect = lambda dat, nifti_data: dat
+        mock_dcm2nii.return_value = {nifti_stem: dicom_path}.items()
+        mock_orient.return_value = ()
 
         with patch("sys.argv", ["dcmdat2niix", f"--dat-dir={str(dat_dir)}", str(dicom_dir)]):
             main()
@@ -476,11 +550,11 @@ class TestMain:
         e2_nii = dicom_dir / "test_scan_e2.nii"
         assert e2_nii.exists()
 
-    @patch("xa30_workaround.scripts.dcmdat2niix.dicom2nifti")
+    @patch("xa30_workaround.scripts.dcmdat2niix.iter_dicom2nifti")
     def test_frame_count_mismatch_raises(self, mock_dcm2nii, main_workspace):
         """Should raise if dat has more frames than nifti (single frame nifti)."""
         ws = main_workspace
-        mock_dcm2nii.return_value = {ws["nifti_stem"]: ws["dicom_path"]}
+        mock_dcm2nii.return_value = {ws["nifti_stem"]: ws["dicom_path"]}.items()
 
         # Add a second dat file -> 2 frames but nifti is 3D (1 frame)
         rng = np.random.RandomState(99)
@@ -490,3 +564,624 @@ class TestMain:
         with patch("sys.argv", ["dcmdat2niix", str(ws["dicom_dir"])]):
             with pytest.raises(ValueError, match="one frame in nifti"):
                 main()
+
+
+def _make_matching_series(dicom_dir, stem, num_frames, suffix=".nii", image_orientation=None, slice_timing=None):
+    """Create a series whose nifti holds the first echo of its .dat files, so orientation really matches."""
+    rng = np.random.RandomState(7)
+    dat_paths = []
+    for i in range(num_frames):
+        dat_path = dicom_dir / f"frame_{i + 1:03d}.dat"
+        _make_dat_file(dat_path, rng.randint(10, 1000, size=(2, 6, 5, 4)))
+        dat_paths.append(dat_path)
+    data = dat_to_array(dat_paths, (2, 6, 5, 4))
+    nifti_data = data[..., 0, 0] if num_frames == 1 else data[..., 0, :]
+    # store flipped, like dcm2niix may
+    nifti_data = np.flip(nifti_data, 0)
+
+    nifti_stem = str(dicom_dir / stem)
+    img = nib.Nifti1Image(nifti_data.astype(np.int16), np.eye(4))
+    img.to_filename(nifti_stem + suffix)
+    metadata = {
+        "EchoTime": 0.02,
+        "ConversionSoftware": "dcm2niix",
+        "ImageTypeText": ["ORIGINAL", "PRIMARY", "TE1", "ND"],
+    }
+    if image_orientation is not None:
+        metadata["ImageOrientationPatientDICOM"] = image_orientation
+    if slice_timing is not None:
+        metadata["SliceTiming"] = slice_timing
+    with open(nifti_stem + ".json", "w") as f:
+        json.dump(metadata, f)
+    dicom_path = dicom_dir / "test.dcm"
+    _make_fake_dicom(dicom_path, [20000, 40000, 0, 0, 0, 0, 0, 0])
+    return nifti_stem, dicom_path, data
+
+
+class TestStreamingMain:
+    @pytest.mark.parametrize("num_frames", [1, 3])
+    @pytest.mark.parametrize("stem", ["scan", "scan_ph"])
+    def test_stream_matches_in_memory(self, tmp_path, num_frames, stem):
+        """--stream should write the same echoes as the in-memory conversion."""
+        results = {}
+        for mode in ["memory", "stream"]:
+            dicom_dir = tmp_path / mode
+            dicom_dir.mkdir()
+            nifti_stem, dicom_path, data = _make_matching_series(dicom_dir, stem, num_frames)
+            argv = ["dcmdat2niix", str(dicom_dir)] + (["--stream"] if mode == "stream" else [])
+            with patch(
+                "xa30_workaround.scripts.dcmdat2niix.iter_dicom2nifti", return_value={nifti_stem: dicom_path}.items()
+            ):
+                with patch("sys.argv", argv):
+                    main()
+            results[mode] = {p.name: np.asarray(nib.Nifti1Image.load(p).dataobj) for p in sorted(dicom_dir.glob("*.nii"))}
+
+        assert results["memory"].keys() == results["stream"].keys()
+        assert len(results["stream"]) == 2
+        for name in results["memory"]:
+            assert np.array_equal(results["memory"][name], results["stream"][name])
+        # the second echo should be the flipped .dat data
+        e2 = [name for name in results["stream"] if "e2" in name][0]
+        expected = np.flip(data[..., 1, 0] if num_frames == 1 else data[..., 1, :], 0)
+        assert np.array_equal(results["stream"][e2], expected)
+
+    @pytest.mark.parametrize("stream", [False, True])
+    @pytest.mark.parametrize("stem", ["scan", "scan_ph"])
+    @pytest.mark.parametrize("out_dtype", ["header", "native", "int16", "float32"])
+    def test_out_dtype_round_trip(self, tmp_path, stream, stem, out_dtype):
+        """Every echo, phase images included, should be stored as the chosen dtype and read back exactly."""
+        nifti_stem, dicom_path, data = _make_matching_series(tmp_path, stem, 3)
+        argv = [f"--out-dtype={out_dtype}", str(tmp_path)] + (["--stream"] if stream else [])
+        with patch(
+            "xa30_workaround.scripts.dcmdat2niix.iter_dicom2nifti", return_value={nifti_stem: dicom_path}.items()
+        ):
+            main(argv)
+        outputs = sorted(tmp_path.glob("*.nii"))
+        assert len(outputs) == 2
+        # the dcm2niix output of the series is int16
+        dtype = {"header": np.int16, "native": np.uint16, "int16": np.int16, "float32": np.float32}[out_dtype]
+        for echo, path in enumerate(outputs):
+            img = nib.Nifti1Image.load(path)
+            # the first echo of a magnitude image is the one dcm2niix wrote
+            if echo > 0 or stem == "scan_ph":
+                assert img.get_data_dtype() == dtype
+            assert np.array_equal(img.get_fdata(), np.flip(data[..., echo, :], 0))
+
+    @pytest.mark.parametrize("stream", [False, True])
+    @pytest.mark.parametrize("options", [["--out-dtype=int16"], []])
+    def test_int16_above_range_round_trip(self, tmp_path, stream, options):
+        """int16 output, the default for an int16 nifti, should hold values above 32767 with or without --stream."""
+        nifti_stem, dicom_path, data = _make_matching_series(tmp_path, "scan", 3)
+        # raise the second echo above the int16 range, leaving the first echo to match the nifti
+        for dat_path in sorted(tmp_path.glob("*.dat")):
+            frame = np.fromfile(dat_path, dtype=np.uint16).reshape(2, 6, 5, 4)
+            frame[1] += 39000
+            frame.tofile(dat_path)
+        with patch(
+            "xa30_workaround.scripts.dcmdat2niix.iter_dicom2nifti", return_value={nifti_stem: dicom_path}.items()
+        ):
+            main(options + [str(tmp_path)] + (["--stream"] if stream else []))
+        first, second = sorted(tmp_path.glob("*.nii"))
+        assert nib.Nifti1Image.load(first).get_data_dtype() == np.int16
+        img = nib.Nifti1Image.load(second)
+        assert img.get_data_dtype() == np.int16
+        assert np.array_equal(img.get_fdata(), np.flip(data[..., 1, :], 0) + 39000)
+
+    @pytest.mark.parametrize("stream", [False, True])
+    def test_jobs_matches_serial(self, tmp_path, stream):
+        """--jobs should decode on several threads without changing the output."""
+        results = {}
+        for jobs in [1, 3]:
+            dicom_dir = tmp_path / f"jobs{jobs}"
+            dicom_dir.mkdir()
+            nifti_stem, dicom_path, _ = _make_matching_series(dicom_dir, "scan", 5)
+            argv = ["dcmdat2niix", f"--jobs={jobs}", str(dicom_dir)] + (["--stream"] if stream else [])
+            with patch(
+                "xa30_workaround.scripts.dcmdat2niix.iter_dicom2nifti", return_value={nifti_stem: dicom_path}.items()
+            ):
+                with patch("sys.argv", argv):
+                    main()
+            results[jobs] = np.asarray(nib.Nifti1Image.load(dicom_dir / "scan_e2.nii").dataobj)
+        assert np.array_equal(results[1], results[3])
+
+    @pytest.mark.parametrize("stream", [False, True])
+    def test_parallel_gzip_outputs(self, tmp_path, stream):
+        """.nii.gz outputs should be compressed in parallel and read back unchanged."""
+        nifti_stem, dicom_path, data = _make_matching_series(tmp_path, "scan", 2, suffix=".nii.gz")
+        argv = ["dcmdat2niix", "--gzip-threads=2", "--gzip-level=6", str(tmp_path)] + (["--stream"] if stream else [])
+        with patch(
+            "xa30_workaround.scripts.dcmdat2niix.iter_dicom2nifti", return_value={nifti_stem: dicom_path}.items()
+        ):
+            with patch("xa30_workaround.compress.shutil.which", return_value=None):
+                with patch("sys.argv", argv):
+                    main()
+        result = np.asarray(nib.Nifti1Image.load(tmp_path / "scan_e2.nii.gz").dataobj)
+        assert np.array_equal(result, np.flip(data[..., 1, :], 0))
+
+    def test_default_gzip_threads_share_cpus(self):
+        """Without --gzip-threads, the CPUs should be shared between every output written at once."""
+        with patch("xa30_workaround.compress.available_cpus", return_value=16):
+            args, _ = parse_args(["--write-jobs=2", "--series-jobs=4", "/data"])
+            assert args.gzip_threads == 2
+            args, _ = parse_args(["--write-jobs=2", "--series-jobs=4", "--gzip-threads=3", "/data"])
+            assert args.gzip_threads == 3
+
+    def test_stream_frame_count_mismatch_raises(self, tmp_path):
+        """--stream should check the frame count before writing anything."""
+        nifti_stem, dicom_path, _ = _make_matching_series(tmp_path, "scan", 1)
+        _make_dat_file(tmp_path / "frame_002.dat", np.ones(2 * 6 * 5 * 4))
+        with patch(
+            "xa30_workaround.scripts.dcmdat2niix.iter_dicom2nifti", return_value={nifti_stem: dicom_path}.items()
+        ):
+            with patch("sys.argv", ["dcmdat2niix", str(tmp_path), "--stream"]):
+                with pytest.raises(ValueError, match="one frame in nifti"):
+                    main()
+        assert not (tmp_path / "scan_e2.nii").exists()
+
+    @pytest.mark.parametrize("stream", [False, True])
+    def test_bad_files_reported_before_decoding(self, tmp_path, stream):
+        """Every bad .dat file and the frame count should be reported before anything is decoded."""
+        nifti_stem, dicom_path, _ = _make_matching_series(tmp_path, "scan", 1)
+        (tmp_path / "frame_001.dat").write_bytes(b"\x00" * 10)
+        (tmp_path / "frame_002.dat").write_bytes(b"")
+        argv = ["dcmdat2niix", str(tmp_path)] + (["--stream"] if stream else [])
+        with patch(
+            "xa30_workaround.scripts.dcmdat2niix.iter_dicom2nifti", return_value={nifti_stem: dicom_path}.items()
+        ):
+            with patch("xa30_workaround.dat.read_dat", side_effect=AssertionError("decoded")):
+                with patch("sys.argv", argv):
+                    with pytest.raises(ValueError) as exc_info:
+                        main()
+        message = str(exc_info.value)
+        assert "one frame in nifti but 2 frames" in message
+        assert "frame_001.dat is truncated" in message
+        assert "frame_002.dat contains no data" in message
+        assert not (tmp_path / "scan_e2.nii").exists()
+
+
+class TestGeometryOrientationMain:
+    @pytest.mark.parametrize("stream", [False, True])
+    def test_orients_from_geometry_alone(self, tmp_path, stream):
+        """--orientation=geometry should orient the series from its ImageOrientationPatientDICOM alone."""
+        nifti_stem, dicom_path, data = _make_matching_series(tmp_path, "scan", 2, image_orientation=[1, 0, 0, 0, 1, 0])
+        argv = ["dcmdat2niix", "--orientation=geometry", str(tmp_path)] + (["--stream"] if stream else [])
+        with patch(
+            "xa30_workaround.scripts.dcmdat2niix.iter_dicom2nifti", return_value={nifti_stem: dicom_path}.items()
+        ):
+            with patch("xa30_workaround.orientation.find_orientation", side_effect=AssertionError("searched")):
+                with patch("sys.argv", argv):
+                    main()
+        result = np.asarray(nib.Nifti1Image.load(tmp_path / "scan_e2.nii").dataobj)
+        assert np.array_equal(result, np.flip(data[..., 1, :], 0))
+
+    def test_geometry_without_orientation_raises(self, tmp_path):
+        """--orientation=geometry should fail if the sidecar has no geometry."""
+        nifti_stem, dicom_path, _ = _make_matching_series(tmp_path, "scan", 2)
+        with patch(
+            "xa30_workaround.scripts.dcmdat2niix.iter_dicom2nifti", return_value={nifti_stem: dicom_path}.items()
+        ):
+            with patch("sys.argv", ["dcmdat2niix", "--orientation=geometry", str(tmp_path)]):
+                with pytest.raises(ValueError, match="scan geometry"):
+                    main()
+
+
+class TestSeriesSliceOrders:
+    def test_slice_timing(self):
+        """SliceTiming in the sidecar should drive the order, with the alternatives after it."""
+        img = nib.Nifti1Image(np.zeros((2, 2, 4), dtype=np.int16), np.eye(4))
+        metadata = {"SliceTiming": [0.0, 0.5, 1.0, 1.5]}
+        orders = series_slice_orders(4, img, metadata, {"slice_mode": "interleaved"})
+        assert [order.tolist() for order in orders] == [[0, 1, 2, 3], [3, 2, 1, 0], [1, 3, 0, 2]]
+
+    def test_slice_timing_reversed_with_slice_axis(self):
+        """SliceTiming should be reversed when the nifti slices run against the .dat slices."""
+        affine = np.diag([-1.0, 1.0, -1.0, 1.0])
+        img = nib.Nifti1Image(np.zeros((2, 2, 4), dtype=np.int16), affine)
+        metadata = {"SliceTiming": [0.0, 0.5, 1.0, 1.5], "ImageOrientationPatientDICOM": [1, 0, 0, 0, 1, 0]}
+        assert series_slice_orders(4, img, metadata, {})[0].tolist() == [3, 2, 1, 0]
+        assert [order.tolist() for order in series_slice_orders(4, img, metadata, {}, "geometry")] == [[3, 2, 1, 0]]
+        # the geometry isn't used to order the slices when orienting by content
+        assert series_slice_orders(4, img, metadata, {}, "content")[0].tolist() == [0, 1, 2, 3]
+
+    def test_protocol_fallback(self):
+        """Without SliceTiming, the protocol's slice mode should drive the order."""
+        img = nib.Nifti1Image(np.zeros((2, 2, 4), dtype=np.int16), np.eye(4))
+        protocol = {"slice_mode": "descending", "multiband_factor": 1}
+        assert [order.tolist() for order in series_slice_orders(4, img, {}, protocol)] == [[3, 2, 1, 0]]
+
+    @pytest.mark.parametrize("stream", [False, True])
+    def test_mismatched_slice_timing_falls_back(self, tmp_path, stream, capsys):
+        """If the .dat files don't match the nifti in the SliceTiming order, the other orders should be tried."""
+        # the .dat files are interleaved, as the protocol says, but the sidecar claims ascending slices
+        nifti_stem, dicom_path, data = _make_matching_series(tmp_path, "scan", 3, slice_timing=[0, 1, 2, 3, 4, 5])
+        with patch(
+            "xa30_workaround.scripts.dcmdat2niix.iter_dicom2nifti", return_value={nifti_stem: dicom_path}.items()
+        ):
+            main([str(tmp_path)] + (["--stream"] if stream else []))
+        assert "trying another slice order" in capsys.readouterr().out
+        e2 = nib.Nifti1Image.load(next(tmp_path.glob("*e2.nii")))
+        assert np.array_equal(np.asarray(e2.dataobj), np.flip(data[..., 1, :], 0))
+
+    def test_series_decoded_once(self, tmp_path):
+        """Each slice order should be tried on the first frame only, and the other frames decoded once in the one that matched."""
+        nifti_stem, dicom_path, data = _make_matching_series(tmp_path, "scan", 3, slice_timing=[0, 1, 2, 3, 4, 5])
+        decoded = []
+
+        def counting_dat_to_array(dat_files, *args, **kwargs):
+            decoded.append(len(dat_files))
+            return dat_to_array(dat_files, *args, **kwargs)
+
+        with patch(
+            "xa30_workaround.scripts.dcmdat2niix.iter_dicom2nifti", return_value={nifti_stem: dicom_path}.items()
+        ):
+            with patch("xa30_workaround.scripts.dcmdat2niix.dat_to_array", side_effect=counting_dat_to_array):
+                main([str(tmp_path)])
+        # the first frame for each order tried, then the other frames
+        assert len(decoded) > 2
+        assert decoded[:-1] == [1] * (len(decoded) - 1)
+        assert decoded[-1] == 2
+        e2 = nib.Nifti1Image.load(next(tmp_path.glob("*e2.nii")))
+        assert np.array_equal(np.asarray(e2.dataobj), np.flip(data[..., 1, :], 0))
+
+
+    def test_flipped_echoes_saved_contiguous(self, tmp_path):
+        """Echoes flipped to match the nifti should be saved from contiguous data, not a flipped view."""
+        nifti_stem, dicom_path, data = _make_matching_series(tmp_path, "scan", 3)
+        saved = []
+
+        def checking_output_image(echo, *args):
+            saved.append(echo.flags.f_contiguous)
+            return output_image(echo, *args)
+
+        with patch(
+            "xa30_workaround.scripts.dcmdat2niix.iter_dicom2nifti", return_value={nifti_stem: dicom_path}.items()
+        ):
+            with patch("xa30_workaround.scripts.dcmdat2niix.output_image", side_effect=checking_output_image):
+                main([str(tmp_path)])
+        assert saved == [True]
+        e2 = nib.Nifti1Image.load(next(tmp_path.glob("*e2.nii")))
+        assert np.array_equal(np.asarray(e2.dataobj), np.flip(data[..., 1, :], 0))
+
+class TestWriteJobsMain:
+    def test_failed_write_raises_and_cleans_up(self, tmp_path):
+        """An error writing an echo should stop the run and remove the partial file."""
+
+        def failing_save(img, path, *args):
+            with open(path, "wb") as f:
+                f.write(b"partial")
+            raise OSError("disk full")
+
+        nifti_stem, dicom_path, _ = _make_matching_series(tmp_path, "scan", 2)
+        with patch(
+            "xa30_workaround.scripts.dcmdat2niix.iter_dicom2nifti", return_value={nifti_stem: dicom_path}.items()
+        ):
+            with patch("xa30_workaround.scripts.dcmdat2niix.save_nifti", side_effect=failing_save):
+                with patch("sys.argv", ["dcmdat2niix", "--write-jobs=2", str(tmp_path)]):
+                    with pytest.raises(OSError, match="disk full"):
+                        main()
+        assert not (tmp_path / "scan_e2.nii").exists()
+        assert (tmp_path / "scan_e2.json").exists()
+
+    def test_one_series_queued_at_a_time(self, tmp_path):
+        """The echoes of a series should only be queued once those of the previous series are written."""
+        pairs = {}
+        for name in ["a", "b", "c"]:
+            (tmp_path / name).mkdir()
+            nifti_stem, dicom_path, _ = _make_matching_series(tmp_path / name, "scan", 2)
+            pairs[nifti_stem] = dicom_path
+        writing = []
+        most = [0]
+        lock = threading.Lock()
+
+        def slow_save(img, path, *args):
+            with lock:
+                writing.append(Path(path).parent.name)
+                most[0] = max(most[0], len(set(writing)))
+            time.sleep(0.1)
+            img.to_filename(str(path))
+            with lock:
+                writing.remove(Path(path).parent.name)
+
+        with patch("xa30_workaround.scripts.dcmdat2niix.iter_dicom2nifti", return_value=pairs.items()):
+            with patch("xa30_workaround.scripts.dcmdat2niix.save_nifti", side_effect=slow_save):
+                main(["--write-jobs=4", str(tmp_path)])
+        assert most[0] == 1
+        assert all((tmp_path / name / "scan_e2.nii").exists() for name in ["a", "b", "c"])
+
+
+class TestManifestMain:
+    def _run(self, tmp_path, nifti_stem, dicom_path, *options):
+        with patch(
+            "xa30_workaround.scripts.dcmdat2niix.iter_dicom2nifti", return_value={nifti_stem: dicom_path}.items()
+        ) as dcm2niix:
+            with patch("sys.argv", ["dcmdat2niix", *options, str(tmp_path)]):
+                main()
+        return dcm2niix
+
+    def _rerun_dcm2niix(self, tmp_path):
+        """Recreate the first echo as dcm2niix writes it on a rerun."""
+        for suffix in [".nii", ".json"]:
+            (tmp_path / f"scan{suffix}").write_bytes((tmp_path / f"scan_e1{suffix}").read_bytes())
+
+    def test_unchanged_run_skips_dcm2niix(self, tmp_path, capsys):
+        """Rerunning over unchanged inputs should not even run dcm2niix."""
+        nifti_stem, dicom_path, _ = _make_matching_series(tmp_path, "scan", 2)
+        self._run(tmp_path, nifti_stem, dicom_path)
+        dcm2niix = self._run(tmp_path, nifti_stem, dicom_path)
+        dcm2niix.assert_not_called()
+        assert "Every series is up to date." in capsys.readouterr().out
+
+    def test_up_to_date_series_skipped(self, tmp_path, capsys):
+        """When the run has changed, series converted before should be skipped without duplicates."""
+        nifti_stem, dicom_path, _ = _make_matching_series(tmp_path, "scan", 2)
+        self._run(tmp_path, nifti_stem, dicom_path)
+        # a new file in the session, and dcm2niix writing the first echo again
+        (tmp_path / "new.dcm").write_bytes(b"new")
+        self._rerun_dcm2niix(tmp_path)
+        with patch("xa30_workaround.scripts.dcmdat2niix.dat_to_array", side_effect=AssertionError("converted")):
+            self._run(tmp_path, nifti_stem, dicom_path)
+        assert "is up to date, skipping." in capsys.readouterr().out
+        assert sorted(p.name for p in tmp_path.glob("*.nii")) == ["scan_e1.nii", "scan_e2.nii"]
+
+    def test_changed_dat_reconverted(self, tmp_path):
+        """A series whose .dat files changed should be converted again."""
+        nifti_stem, dicom_path, _ = _make_matching_series(tmp_path, "scan", 2)
+        self._run(tmp_path, nifti_stem, dicom_path)
+        _, _, data = _make_matching_series(tmp_path, "scan", 2)
+        self._run(tmp_path, nifti_stem, dicom_path)
+        result = np.asarray(nib.Nifti1Image.load(tmp_path / "scan_e2.nii").dataobj)
+        assert np.array_equal(result, np.flip(data[..., 1, :], 0))
+
+    def test_force_reconverts(self, tmp_path):
+        """--force should convert every series again."""
+        nifti_stem, dicom_path, _ = _make_matching_series(tmp_path, "scan", 2)
+        self._run(tmp_path, nifti_stem, dicom_path)
+        self._rerun_dcm2niix(tmp_path)
+        dcm2niix = self._run(tmp_path, nifti_stem, dicom_path, "--force")
+        dcm2niix.assert_called_once()
+        assert not (tmp_path / "scan.nii").exists()
+
+
+    @pytest.mark.parametrize("option", ["--out-dtype=float32", "--stream", "--orientation=content", "--gzip-level=6"])
+    def test_changed_option_reconverts(self, tmp_path, option, capsys):
+        """Changing a conversion option should run dcm2niix and convert the series again."""
+        nifti_stem, dicom_path, data = _make_matching_series(tmp_path, "scan", 2)
+        self._run(tmp_path, nifti_stem, dicom_path)
+        self._rerun_dcm2niix(tmp_path)
+        capsys.readouterr()
+        dcm2niix = self._run(tmp_path, nifti_stem, dicom_path, option)
+        dcm2niix.assert_called_once()
+        assert "up to date" not in capsys.readouterr().out
+        result = nib.Nifti1Image.load(tmp_path / "scan_e2.nii")
+        assert np.array_equal(np.asarray(result.dataobj), np.flip(data[..., 1, :], 0))
+        if option == "--out-dtype=float32":
+            assert result.get_data_dtype() == np.float32
+
+class TestWatchMain:
+    def _session(self, tmp_path):
+        session = tmp_path / "inbox" / "session1"
+        session.mkdir(parents=True)
+        nifti_stem, dicom_path, _ = _make_matching_series(session, "scan", 2)
+        return session, nifti_stem, dicom_path
+
+    def test_session_complete(self, tmp_path):
+        """A session is complete once every series has a .dat file per repetition."""
+        session, _, dicom_path = self._session(tmp_path)
+        for name in ["frame_001.dat", "frame_002.dat"]:
+            (session / name).rename(session / f"1.2.3.{name}")
+        with patch("xa30_workaround.scripts.dcmdat2niix.session_series", return_value={"1.2.3.0.0.0": dicom_path}):
+            for repetitions, complete in [(1, True), (2, False)]:
+                protocol = {"num_repetitions": repetitions}
+                with patch("xa30_workaround.scripts.dcmdat2niix.read_series_protocol", return_value=protocol):
+                    assert session_complete(session) is complete
+
+    def test_session_complete_finds_dat_files_like_conversion(self, tmp_path, dicom_file):
+        """Every .dat file beside the DICOM should count without --dat-dir, and only UID matches with it."""
+        session = tmp_path / "session"
+        dicom_file(session / "a.dcm", "1.2.3.0.0.0")
+        for i in [1, 2]:
+            (session / f"frame_{i:03d}.dat").write_bytes(b"\x00" * 8)
+        dat_dir = tmp_path / "dat"
+        dat_dir.mkdir()
+        for name in ["1.2.3.frame_001.dat", "1.2.3.frame_002.dat", "9.9.9.frame_001.dat", "9.9.9.frame_002.dat"]:
+            (dat_dir / name).write_bytes(b"\x00" * 8)
+        with patch("xa30_workaround.scripts.dcmdat2niix.read_series_protocol", return_value={"num_repetitions": 2}):
+            assert not session_complete(session)
+            assert not session_complete(session, dat_dir)
+            (session / "frame_003.dat").write_bytes(b"\x00" * 8)
+            (dat_dir / "9.9.9.frame_003.dat").write_bytes(b"\x00" * 8)
+            assert session_complete(session)
+            assert not session_complete(session, dat_dir)
+            (dat_dir / "1.2.3.frame_003.dat").write_bytes(b"\x00" * 8)
+            assert session_complete(session, dat_dir)
+
+    def test_converts_settled_session(self, tmp_path, capsys):
+        """watch --once should convert each complete session into its own output directory."""
+        session, nifti_stem, dicom_path = self._session(tmp_path)
+        with patch(
+            "xa30_workaround.scripts.dcmdat2niix.iter_dicom2nifti", return_value={nifti_stem: dicom_path}.items()
+        ):
+            main(["watch", "--once", "--settle=0", "--poll-interval=0.01", str(tmp_path / "inbox")])
+        out = capsys.readouterr().out
+        assert f"Converting {session}..." in out
+        assert "Saving nifti files..." in out
+        assert (session / "scan_e2.nii").exists()
+
+    def test_incomplete_session_waits(self, tmp_path, capsys):
+        """A session still missing .dat files should not be converted."""
+        session, _, _ = self._session(tmp_path)
+        with patch("xa30_workaround.scripts.dcmdat2niix.session_complete", return_value=False):
+            main(["watch", "--once", "--settle=0", "--poll-interval=0.01", str(tmp_path / "inbox")])
+        assert "Converting" not in capsys.readouterr().out
+        assert not (session / "scan_e2.nii").exists()
+
+
+class TestBatchMain:
+    def _sessions(self, tmp_path, names):
+        pairs = {}
+        for name in names:
+            session = tmp_path / name
+            session.mkdir()
+            nifti_stem, dicom_path, _ = _make_matching_series(session, "scan", 2)
+            pairs[str(session)] = {nifti_stem: dicom_path}
+        return pairs
+
+    @pytest.mark.parametrize("options", [[], ["--series-jobs=2"]])
+    def test_converts_every_session(self, tmp_path, options, capsys):
+        """Every session of the manifest should be converted, and a failed one should not stop the others."""
+        pairs = self._sessions(tmp_path, ["s1", "s2", "s3"])
+        (tmp_path / "s2" / "frame_002.dat").write_bytes(b"")
+        manifest = tmp_path / "sessions.csv"
+        manifest.write_text("dicom_dir,out_dir\ns1,\ns2,\ns3,out3\n")
+        summary = tmp_path / "summary.json"
+        with patch(
+            "xa30_workaround.scripts.dcmdat2niix.iter_dicom2nifti", side_effect=lambda *args: pairs[args[-1]].items()
+        ):
+            with pytest.raises(SystemExit) as exit_info:
+                main(["batch", str(manifest), f"--summary={summary}", *options])
+        assert exit_info.value.code == 1
+        assert (tmp_path / "s1" / "scan_e2.nii").exists()
+        assert (tmp_path / "s3" / "scan_e2.nii").exists()
+        assert not (tmp_path / "s2" / "scan_e2.nii").exists()
+        outcomes = json.loads(summary.read_text())
+        assert [outcome["status"] for outcome in outcomes] == ["converted", "failed", "converted"]
+        assert "contains no data" in outcomes[1]["error"]
+        assert outcomes[2]["out_dir"] == str(tmp_path / "out3")
+        assert "Converted 2 of 3 sessions." in capsys.readouterr().out
+
+    def test_shares_dat_index_and_cache(self, tmp_path):
+        """Every session should be converted with the same header cache and .dat directory indexes."""
+        pairs = self._sessions(tmp_path, ["s1", "s2"])
+        manifest = tmp_path / "sessions.json"
+        manifest.write_text(json.dumps([{"dicom_dir": "s1"}, {"dicom_dir": "s2"}]))
+        shared = []
+        with patch(
+            "xa30_workaround.scripts.dcmdat2niix.iter_dicom2nifti", side_effect=lambda *args: pairs[args[-1]].items()
+        ):
+            with patch(
+                "xa30_workaround.scripts.dcmdat2niix.convert_session",
+                side_effect=lambda *args, **kwargs: shared.append(kwargs),
+            ):
+                main(["batch", str(manifest), "--cache-dir", str(tmp_path / "cache")])
+        assert len(shared) == 2
+        assert shared[0]["cache"] is shared[1]["cache"]
+        assert shared[0]["dat_indexes"] is shared[1]["dat_indexes"]
+
+    def test_bad_session_arguments_stop_before_converting(self, tmp_path):
+        """A session with bad arguments should fail the batch before any session is converted."""
+        self._sessions(tmp_path, ["s1"])
+        manifest = tmp_path / "sessions.csv"
+        manifest.write_text("dicom_dir,args\ns1,\ns1,--jobs 0\n")
+        with patch("xa30_workaround.scripts.dcmdat2niix.iter_dicom2nifti") as dcm2niix:
+            with pytest.raises(SystemExit):
+                main(["batch", str(manifest)])
+        dcm2niix.assert_not_called()
+
+
+class TestProfileMain:
+    def _run(self, tmp_path, *options):
+        nifti_stem, dicom_path, _ = _make_matching_series(tmp_path, "scan", 2)
+        report = tmp_path / "profile" / "report.json"
+        report.parent.mkdir()
+        with patch(
+            "xa30_workaround.scripts.dcmdat2niix.iter_dicom2nifti", return_value={nifti_stem: dicom_path}.items()
+        ):
+            main([f"--profile-report={report}", *options, str(tmp_path)])
+        return nifti_stem, json.loads(report.read_text())
+
+    @pytest.mark.parametrize("options", [[], ["--stream"], ["--series-jobs=2"]])
+    def test_report_covers_each_stage(self, tmp_path, options):
+        """The report should hold the time, bytes and memory of every stage of the series."""
+        nifti_stem, report = self._run(tmp_path, *options)
+        stages = report["series"][nifti_stem]
+        assert {"dcm2niix", "protocol", "load_nifti", "dat_search", "decode", "orientation", "write"} <= set(stages)
+        assert stages["decode"]["bytes_read"] == 2 * (2 * 6 * 5 * 4 * 2)
+        assert stages["write"]["bytes_written"] == (tmp_path / "scan_e2.nii").stat().st_size
+        assert all(stage["peak_rss_bytes"] > 0 for stage in stages.values())
+        assert report["totals"]["decode"]["series"] == 1
+
+    def test_report_written_on_failure(self, tmp_path):
+        """The report should still be written when a series fails."""
+        nifti_stem, dicom_path, _ = _make_matching_series(tmp_path, "scan", 2)
+        (tmp_path / "frame_002.dat").write_bytes(b"")
+        report = tmp_path / "report.json"
+        with patch(
+            "xa30_workaround.scripts.dcmdat2niix.iter_dicom2nifti", return_value={nifti_stem: dicom_path}.items()
+        ):
+            with pytest.raises(ValueError, match="contains no data"):
+                main([f"--profile-report={report}", str(tmp_path)])
+        assert "validate" in json.loads(report.read_text())["series"][nifti_stem]
+
+    def test_log_lines(self, tmp_path, capsys):
+        """--profile-log should print each stage as a line of JSON."""
+        nifti_stem, dicom_path, _ = _make_matching_series(tmp_path, "scan", 2)
+        with patch(
+            "xa30_workaround.scripts.dcmdat2niix.iter_dicom2nifti", return_value={nifti_stem: dicom_path}.items()
+        ):
+            main(["--profile-log", str(tmp_path)])
+        lines = [line.split(" ", 1) for line in capsys.readouterr().err.splitlines()]
+        stages = [json.loads(record)["stage"] for prefix, record in lines if prefix == "dcmdat2niix-profile"]
+        assert "decode" in stages and "write" in stages
+
+
+class TestSeriesJobs:
+    def test_estimate_series_memory(self, tmp_path):
+        """The estimate should cover the assembled series, or a few frames when streaming."""
+        nifti_stem, dicom_path, _ = _make_matching_series(tmp_path, "scan", 3)
+        frame_bytes = 4 * 5 * 6 * 2 * 2
+        assert estimate_series_memory(nifti_stem, dicom_path) == (frame_bytes + frame_bytes // 2) * 3
+        assert estimate_series_memory(nifti_stem, dicom_path, stream=True, jobs=2) == frame_bytes * 4
+        float32 = estimate_series_memory(nifti_stem, dicom_path, out_dtype="float32")
+        assert float32 == (3 * frame_bytes + frame_bytes // 2) * 3
+
+    def test_estimate_unreadable_series_is_zero(self, tmp_path):
+        """Series that can't be inspected should estimate to 0 and fail in the conversion itself."""
+        assert estimate_series_memory(str(tmp_path / "missing"), tmp_path / "missing.dcm") == 0
+
+    def test_converts_series_concurrently(self, tmp_path, capsys):
+        """--series-jobs should convert every series, printing each series' log in one block."""
+        dicoms_nii_map = {}
+        for name in ["run1", "run2", "run3"]:
+            dicom_dir = tmp_path / name
+            dicom_dir.mkdir()
+            nifti_stem, dicom_path, _ = _make_matching_series(dicom_dir, "scan", 2)
+            dicoms_nii_map[nifti_stem] = dicom_path
+
+        with patch("xa30_workaround.scripts.dcmdat2niix.iter_dicom2nifti", return_value=dicoms_nii_map.items()):
+            with patch("sys.argv", ["dcmdat2niix", "--series-jobs=2", str(tmp_path)]):
+                main()
+
+        for name in ["run1", "run2", "run3"]:
+            assert (tmp_path / name / "scan_e1.nii").exists()
+            assert (tmp_path / name / "scan_e2.nii").exists()
+        out = capsys.readouterr().out.splitlines()
+        for i, line in enumerate(out):
+            if line.startswith("Found"):
+                assert out[i + 1] == "Converting .dat files to nifti..."
+                assert out[i + 2] == "Saving nifti files..."
+
+
+class TestHeaderCacheMain:
+    def test_warm_rerun_skips_header_parsing(self, tmp_path):
+        """With --cache-dir, a rerun should not parse the DICOM header again."""
+        argv = ["dcmdat2niix", f"--cache-dir={tmp_path / 'cache'}", str(tmp_path)]
+        dicom_dir = tmp_path / "dicom"
+        dicom_dir.mkdir()
+        for run in range(2):
+            # recreate the dcm2niix output, leaving the DICOM untouched on the rerun
+            stat = (dicom_dir / "test.dcm").stat() if run else None
+            nifti_stem, dicom_path, _ = _make_matching_series(dicom_dir, "scan", 2)
+            if stat is not None:
+                os.utime(dicom_path, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+            pairs = {nifti_stem: dicom_path}.items()
+            with patch("xa30_workaround.scripts.dcmdat2niix.iter_dicom2nifti", return_value=pairs):
+                with patch("sys.argv", argv):
+                    if run == 0:
+                        main()
+                    else:
+                        with patch(
+                            "xa30_workaround.scripts.dcmdat2niix.read_protocol", side_effect=AssertionError("parsed")
+                        ):
+                            main()
+            with open(dicom_dir / "scan_e2.json") as f:
+                assert json.load(f)["EchoTime"] == 0.04
@@ -1,11 +1,68 @@
+import json
 import subprocess
-from unittest.mock import patch
+import sys
+import threading
+import time
+from pathlib import Path
+from unittest.mock import ANY, patch
+import pydicom
 import pytest
 
-# dicom.py checks for dcm2niix at import time and exits if not found.
-# Patch subprocess.run to prevent that side effect during testing.
-with patch("subprocess.run"):
-    from xa30_workaround.dicom import execute, dicom2nifti
+from xa30_workaround.dicom import (
+    SeriesIndex,
+    dcm2niix_help,
+    dcm2niix_version,
+    execute,
+    dicom2nifti,
+    find_series_dicom,
+    iter_dicom2nifti,
+    parse_dcm2niix_output,
+)
+
+# the repository, for fresh interpreters
+ROOT = str(Path(__file__).resolve().parent.parent)
+
+DCM2NIIX_HELP = "Chris Rorden's dcm2niiX version v1.0.20230411  (JP2:OpenJPEG) GCC9.4.0 x86-64 (64-bit Linux)\n"
+
+
+def _write_sidecar(nifti, **metadata):
+    """Write the BIDS sidecar of a dcm2niix output."""
+    Path(f"{nifti}.json").write_text(json.dumps({"ConversionSoftware": "dcm2niix", **metadata}))
+
+
+@pytest.fixture(autouse=True)
+def dcm2niix_probe():
+    """Stand in for `dcm2niix -h`, probing it afresh in each test."""
+    dcm2niix_help.cache_clear()
+    completed = subprocess.CompletedProcess(["dcm2niix", "-h"], 0, stdout=DCM2NIIX_HELP)
+    with patch("xa30_workaround.dicom.subprocess.run", return_value=completed) as run:
+        yield run
+    dcm2niix_help.cache_clear()
+
+
+class TestDcm2niixProbe:
+    def test_not_probed_at_import(self):
+        """Importing the module should not run dcm2niix, so it should import without dcm2niix installed."""
+        code = "import xa30_workaround.dicom, xa30_workaround.scripts.dcmdat2niix"
+        result = subprocess.run([sys.executable, "-c", code], env={"PATH": "", "PYTHONPATH": ROOT}, capture_output=True)
+        assert result.returncode == 0, result.stderr
+
+    def test_probed_once(self, dcm2niix_probe):
+        """dcm2niix should only be probed on first use, and its version parsed from the help text."""
+        assert dcm2niix_probe.call_count == 0
+        with patch("xa30_workaround.dicom.execute", return_value=iter([])):
+            dicom2nifti("/data/scan")
+            dicom2nifti("/data/other")
+        assert dcm2niix_version() == "v1.0.20230411"
+        assert dcm2niix_probe.call_count == 1
+
+    @pytest.mark.parametrize("error", [FileNotFoundError(), subprocess.CalledProcessError(1, "dcm2niix")])
+    def test_missing_dcm2niix_exits(self, dcm2niix_probe, error, capsys):
+        """Without a working dcm2niix, the first use should exit with a message."""
+        dcm2niix_probe.side_effect = error
+        with pytest.raises(SystemExit):
+            dicom2nifti("/data/scan")
+        assert "dcm2niix not installed" in capsys.readouterr().out
 
 
 class TestExecute:
@@ -34,8 +91,8 @@ class TestDicom2Nifti:
         assert "/output/scan_e1" in result
         assert str(result["/output/scan_e1"]) == "/data/scan/file.dcm"
 
-    def test_skips_verbose_lines(self):
-        """Lines with 'Patient Position', 'orient', 'acq', 'DICOM file:' should be skipped."""
+    def test_passes_output_through(self, capsys):
+        """Every line of dcm2niix output should be printed unchanged, including verbose ones."""
         fake_output = [
             "Patient Position: HFS\n",
             "patient position is HFS\n",
@@ -50,6 +107,18 @@ class TestDicom2Nifti:
             result = dicom2nifti("/data/scan")
 
         assert len(result) == 1
+        assert capsys.readouterr().out == "".join(fake_output)
+
+    def test_non_verbose_output_has_no_dicom(self):
+        """Without -v, dcm2niix only reports the outputs, so no DICOM should be taken from its output."""
+        lines = [
+            "Chris Rorden's dcm2niiX version v1.0.20230411\n",
+            "Found 2 DICOM file(s)\n",
+            "Convert 1 DICOM as /output/scan1_e1 (64x64x40)\n",
+            "Convert 1 DICOM as /output/scan2_e1 (64x64x40)\n",
+            "Conversion required 0.1 seconds\n",
+        ]
+        assert list(parse_dcm2niix_output(iter(lines))) == [("/output/scan1_e1", None), ("/output/scan2_e1", None)]
 
     def test_multiple_conversions(self):
         """Should handle multiple DICOM-to-NIFTI conversions."""
@@ -72,3 +141,208 @@ class TestDicom2Nifti:
         with patch("xa30_workaround.dicom.execute", return_value=iter([])):
             result = dicom2nifti("/data")
         assert result == {}
+
+
+class TestIterDicom2Nifti:
+    def test_pair_held_until_next_series(self):
+        """A series should only be yielded once dcm2niix has moved on to the next one."""
+        lines = iter(
+            [
+                "Converting /data/scan1/file1.dcm\n",
+                "Convert 1 DICOM as /output/scan1_e1 (64x64x40)\n",
+                "Converting /data/scan2/file2.dcm\n",
+                "Convert 2 DICOM as /output/scan2_e1 (64x64x40)\n",
+            ]
+        )
+        pairs = parse_dcm2niix_output(lines)
+        assert next(pairs) == ("/output/scan1_e1", Path("/data/scan1/file1.dcm"))
+        # the first pair is yielded as soon as the second series starts
+        assert next(lines) == "Convert 2 DICOM as /output/scan2_e1 (64x64x40)\n"
+
+    def test_yields_before_dcm2niix_finishes(self):
+        """The first series should be available while dcm2niix is still converting the next."""
+        received = threading.Event()
+
+        def fake_execute(cmd, started=None):
+            yield "Converting /data/scan1/file1.dcm\n"
+            yield "Convert 1 DICOM as /output/scan1_e1 (64x64x40)\n"
+            yield "Converting /data/scan2/file2.dcm\n"
+            # dcm2niix doesn't finish until the caller has the first series
+            assert received.wait(5)
+            yield "Convert 2 DICOM as /output/scan2_e1 (64x64x40)\n"
+
+        with patch("xa30_workaround.dicom.execute", fake_execute):
+            pairs = iter_dicom2nifti("/data")
+            assert next(pairs)[0] == "/output/scan1_e1"
+            received.set()
+            assert [nifti for nifti, _ in pairs] == ["/output/scan2_e1"]
+
+    def test_raises_dcm2niix_errors(self):
+        """Errors from dcm2niix should be raised to the caller."""
+
+        def fake_execute(cmd, started=None):
+            yield "Converting /data/scan1/file1.dcm\n"
+            yield "Convert 1 DICOM as /output/scan1_e1 (64x64x40)\n"
+            raise subprocess.CalledProcessError(1, cmd)
+
+        with patch("xa30_workaround.dicom.execute", fake_execute):
+            pairs = iter_dicom2nifti("/data")
+            with pytest.raises(subprocess.CalledProcessError):
+                list(pairs)
+
+    @pytest.mark.parametrize("stop", ["close", "raise"])
+    def test_stops_dcm2niix_when_caller_stops(self, stop):
+        """dcm2niix should be terminated and its output thread joined if the caller stops early or raises."""
+        script = (
+            "import time\n"
+            "print('Converting /data/scan1/file1.dcm')\n"
+            "print('Convert 1 DICOM as /output/scan1_e1 (64x64x40)')\n"
+            "print('Converting /data/scan2/file2.dcm', flush=True)\n"
+            "time.sleep(60)\n"
+        )
+        processes = []
+
+        def fake_execute(cmd, started=None):
+            def record(process):
+                processes.append(process)
+                if started is not None:
+                    started(process)
+
+            return execute([sys.executable, "-c", script], started=record)
+
+        threads = threading.active_count()
+        start = time.monotonic()
+        with patch("xa30_workaround.dicom.execute", fake_execute):
+            pairs = iter_dicom2nifti("/data")
+            assert next(pairs)[0] == "/output/scan1_e1"
+            if stop == "close":
+                pairs.close()
+            else:
+                with pytest.raises(KeyError):
+                    pairs.throw(KeyError("stop"))
+        assert time.monotonic() - start < 30
+        assert processes[0].returncode is not None
+        assert threading.active_count() == threads
+
+
+class TestSeriesIndex:
+    def test_series(self, tmp_path, dicom_file):
+        """Every series should be found once, skipping .dat files, dcm2niix outputs and non-DICOM files."""
+        first = dicom_file(tmp_path / "a" / "1.dcm", "1.2.3.1", SeriesNumber=1)
+        dicom_file(tmp_path / "a" / "2.dcm", "1.2.3.1", SeriesNumber=1)
+        second = dicom_file(tmp_path / "b" / "1.dcm", "1.2.3.2", SeriesNumber=2)
+        (tmp_path / "b" / "frame.dat").write_bytes(b"\x00" * 16)
+        (tmp_path / "b" / "scan.json").write_text("{}")
+        (tmp_path / "notes.txt").write_text("not a DICOM file")
+        assert SeriesIndex(tmp_path).series() == {"1.2.3.1": first, "1.2.3.2": second}
+
+    def test_find_by_uid_reads_only_as_far_as_needed(self, tmp_path, dicom_file):
+        """Looking up a series by its UID should stop reading headers once it is found."""
+        first = dicom_file(tmp_path / "a.dcm", "1.2.3.1")
+        dicom_file(tmp_path / "b.dcm", "1.2.3.2")
+        index = SeriesIndex(tmp_path)
+        with patch("xa30_workaround.dicom.pydicom.dcmread", wraps=pydicom.dcmread) as dcmread:
+            assert index.find("1.2.3.1") == first
+        assert dcmread.call_count == 1
+
+    def test_find_by_series_number(self, tmp_path, dicom_file):
+        """Without a UID, a series should be found by a unique Series Number, or its description."""
+        dicom_file(tmp_path / "a.dcm", "1.2.3.1", SeriesNumber=3, SeriesDescription="bold_mag")
+        phase = dicom_file(tmp_path / "b.dcm", "1.2.3.2", SeriesNumber=3, SeriesDescription="bold_phase")
+        other = dicom_file(tmp_path / "c.dcm", "1.2.3.3", SeriesNumber=4, SeriesDescription="t1")
+        index = SeriesIndex(tmp_path)
+        assert index.find("1.2.3.9", 4) == other
+        assert index.find(number=3, description="bold_phase") == phase
+        # two series with the same number can't be told apart without their description
+        assert index.find(number=3) is None
+        assert index.find(number=5) is None
+
+    def test_find_by_acquisition_time(self, tmp_path, dicom_file):
+        """Two studies with the same series should be told apart by acquisition time, reading only as far as needed."""
+        for study, hour in [("a", "09"), ("b", "14")]:
+            for volume in range(2):
+                dicom_file(
+                    tmp_path / study / f"{volume}.dcm",
+                    f"1.2.3.{int(hour)}",
+                    SeriesNumber=3,
+                    ProtocolName="MBME_DcmOnlyE1",
+                    AcquisitionTime=f"{hour}1502.{volume}25",
+                )
+        index = SeriesIndex(tmp_path)
+        with patch("xa30_workaround.dicom.pydicom.dcmread", wraps=pydicom.dcmread) as dcmread:
+            found = index.find(number=3, protocol="MBME_DcmOnlyE1", acquisition_time="09:15:02.125000")
+        assert found == tmp_path / "a" / "0.dcm"
+        # the second volume of the first study matches, so the second study isn't read
+        assert dcmread.call_count == 2
+        assert index.find(number=3, acquisition_time="14:15:02.025") == tmp_path / "b" / "0.dcm"
+        assert index.find(number=3, protocol="other", acquisition_time="14:15:02.025") is None
+        assert index.find(number=3) is None
+
+    def test_find_by_acquisition_datetime(self, tmp_path, dicom_file):
+        """Enhanced DICOM, which only carries an acquisition datetime, should be matched on its time part."""
+        enhanced = dicom_file(
+            tmp_path / "a.dcm", "1.2.3.1", SeriesNumber=5, AcquisitionDateTime="20230721093553.123000"
+        )
+        dicom_file(tmp_path / "b.dcm", "1.2.3.2", SeriesNumber=5, AcquisitionDateTime="20230721101500.000000+0200")
+        index = SeriesIndex(tmp_path)
+        assert index.find(None, 5, None, None, "09:35:53.123000") == enhanced
+        assert index.find(None, 5, None, None, "11:00:00") is None
+
+    def test_find_without_times_falls_back_to_unique_match(self, tmp_path, dicom_file):
+        """Series whose headers carry no time should still be found when the rest of the identifiers are unique."""
+        found = dicom_file(tmp_path / "a.dcm", "1.2.3.1", SeriesNumber=5, SeriesDescription="bold")
+        dicom_file(tmp_path / "b.dcm", "1.2.3.2", SeriesNumber=6, SeriesDescription="bold")
+        dicom_file(tmp_path / "c.dcm", "1.2.3.3", SeriesNumber=6, SeriesDescription="bold")
+        index = SeriesIndex(tmp_path)
+        assert index.find(None, 5, "bold", None, "09:35:53.123000") == found
+        assert index.find(None, 6, "bold", None, "09:35:53.123000") is None
+
+
+class TestFindSeriesDicom:
+    def test_finds_dicom_from_sidecar(self, tmp_path, dicom_file):
+        """The DICOM of an output should be found from the identifiers in its sidecar."""
+        dicom = dicom_file(tmp_path / "dicom" / "a.dcm", "1.2.3.1", SeriesNumber=5)
+        _write_sidecar(tmp_path / "scan_e1", SeriesInstanceUID="1.2.3.1", SeriesNumber=5)
+        _write_sidecar(tmp_path / "scan.v2_e1", SeriesNumber=5)
+        index = SeriesIndex(tmp_path / "dicom")
+        assert find_series_dicom(str(tmp_path / "scan_e1"), index) == dicom
+        assert find_series_dicom(str(tmp_path / "scan.v2_e1"), index) == dicom
+
+    def test_anonymized_sidecar(self, tmp_path, dicom_file):
+        """An anonymized sidecar, without a UID, should be matched on the fields it keeps."""
+        dicom_file(tmp_path / "dicom" / "a.dcm", "1.2.3.1", SeriesNumber=5, AcquisitionTime="091502.5")
+        dicom = dicom_file(tmp_path / "dicom" / "b.dcm", "1.2.3.2", SeriesNumber=5, AcquisitionTime="141502.5")
+        _write_sidecar(
+            tmp_path / "scan_e1", SeriesNumber=5, ProtocolName="MBME_DcmOnlyE1", AcquisitionTime="14:15:02.500000"
+        )
+        assert find_series_dicom(str(tmp_path / "scan_e1"), SeriesIndex(tmp_path / "dicom")) == dicom
+
+    def test_unmatched_sidecar_returns_none(self, tmp_path, dicom_file, capsys):
+        """An output whose series isn't in the index, or that has no sidecar, should be reported and skipped."""
+        dicom_file(tmp_path / "dicom" / "a.dcm", "1.2.3.1", SeriesNumber=5)
+        _write_sidecar(tmp_path / "scan_e1", SeriesInstanceUID="1.2.3.2", SeriesNumber=6)
+        index = SeriesIndex(tmp_path / "dicom")
+        assert find_series_dicom(str(tmp_path / "scan_e1"), index) is None
+        assert "Could not tell which DICOM files" in capsys.readouterr().out
+        assert find_series_dicom(str(tmp_path / "missing_e1"), index) is None
+        assert "Could not read the sidecar" in capsys.readouterr().out
+
+    def test_iter_dicom2nifti_uses_sidecars(self, tmp_path, dicom_file):
+        """Without verbose output, iter_dicom2nifti should pair each output with its DICOM from its sidecar."""
+        dicom = dicom_file(tmp_path / "dicom" / "a.dcm", "1.2.3.1", SeriesNumber=5)
+        nifti = str(tmp_path / "scan_e1")
+        _write_sidecar(nifti, SeriesInstanceUID="1.2.3.1")
+        lines = [f"Convert 1 DICOM as {nifti} (64x64x40)\n"]
+        with patch("xa30_workaround.dicom.execute", return_value=iter(lines)) as execute:
+            assert list(iter_dicom2nifti("-z", "y", str(tmp_path / "dicom"))) == [(nifti, dicom)]
+        execute.assert_called_once_with(["dcm2niix", "-z", "y", str(tmp_path / "dicom")], started=ANY)
+
+    def test_iter_dicom2nifti_skips_unmatched_series(self, tmp_path, dicom_file):
+        """A series whose DICOM can't be found should be skipped, leaving the rest of the session."""
+        dicom = dicom_file(tmp_path / "dicom" / "a.dcm", "1.2.3.1", SeriesNumber=5)
+        lines = []
+        for stem, uid in [("lost_e1", "1.2.3.9"), ("scan_e1", "1.2.3.1")]:
+            _write_sidecar(tmp_path / stem, SeriesInstanceUID=uid)
+            lines.append(f"Convert 1 DICOM as {tmp_path / stem} (64x64x40)\n")
+        with patch("xa30_workaround.dicom.execute", return_value=iter(lines)):
+            assert list(iter_dicom2nifti(str(tmp_path / "dicom"))) == [(str(tmp_path / "scan_e1"), dicom)]
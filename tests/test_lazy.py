@@ -0,0 +1,63 @@
+import importlib.machinery
+import json
+import subprocess
+import sys
+from pathlib import Path
+from unittest.mock import patch
+
+import pytest
+from xa30_workaround.lazy import lazy_import
+
+# the repository, for fresh interpreters
+ROOT = str(Path(__file__).resolve().parent.parent)
+
+
+def _fresh(code):
+    """Run code in a fresh interpreter, returning what it prints as JSON."""
+    result = subprocess.run([sys.executable, "-c", code], env={"PYTHONPATH": ROOT}, capture_output=True, text=True)
+    assert result.returncode == 0, result.stderr
+    return json.loads(result.stdout)
+
+
+def test_already_imported():
+    """A module that is already imported should be returned as is."""
+    assert lazy_import("json") is json
+
+
+def test_missing_module_raises():
+    """A module that doesn't exist should still fail at import."""
+    with pytest.raises(ModuleNotFoundError):
+        lazy_import("xa30_workaround.no_such_module")
+
+
+def test_module_without_loader_raises():
+    """A module whose spec has no loader can't be deferred, so it should fail at import."""
+    spec = importlib.machinery.ModuleSpec("no_loader", None)
+    with patch("importlib.util.find_spec", return_value=spec):
+        with pytest.raises(ImportError, match="no loader"):
+            lazy_import("no_loader")
+    assert "no_loader" not in sys.modules
+
+
+def test_loaded_on_first_use():
+    """The module should only be executed once one of its attributes is used."""
+    code = """
+import json, sys
+from xa30_workaround.lazy import lazy_import
+np = lazy_import("numpy")
+before = "numpy.linalg" in sys.modules
+np.zeros(1)
+print(json.dumps([before, "numpy.linalg" in sys.modules]))
+"""
+    assert _fresh(code) == [False, True]
+
+
+def test_cli_import_defers_heavy_modules():
+    """Importing dcmdat2niix should load none of numpy, nibabel, pydicom or indexed_gzip."""
+    code = """
+import json, sys
+import xa30_workaround.scripts.dcmdat2niix
+heavy = ["numpy.linalg", "nibabel.nifti1", "pydicom.dataset", "indexed_gzip.indexed_gzip"]
+print(json.dumps([name for name in heavy if name in sys.modules]))
+"""
+    assert _fresh(code) == []
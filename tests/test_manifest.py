@@ -0,0 +1,137 @@
+import os
+import subprocess
+import sys
+from pathlib import Path
+from unittest.mock import patch
+
+from xa30_workaround.manifest import MANIFEST_NAME, Manifest, directory_fingerprint, series_fingerprint
+
+# the repository, for fresh interpreters
+ROOT = str(Path(__file__).resolve().parent.parent)
+
+
+def _make_series(tmp_path):
+    dicom = tmp_path / "a.dcm"
+    dicom.write_bytes(b"header")
+    dat = tmp_path / "a.dat"
+    dat.write_bytes(b"\x00" * 8)
+    output = tmp_path / "a_e2.nii"
+    output.write_bytes(b"image")
+    return dicom, dat, output
+
+
+class TestManifest:
+    def test_recorded_series_is_up_to_date(self, tmp_path):
+        """A recorded series should be up to date with the same inputs."""
+        dicom, dat, output = _make_series(tmp_path)
+        manifest = Manifest(tmp_path)
+        inputs = series_fingerprint(dicom, [dat])
+        assert manifest.series_outputs("a", inputs) is None
+        manifest.record("a", inputs, [output])
+        outputs = Manifest(tmp_path).series_outputs("a", inputs)
+        assert outputs is not None and list(outputs) == [str(output)]
+
+    def test_changed_input_is_stale(self, tmp_path):
+        """Changing a .dat file should make the series stale."""
+        dicom, dat, output = _make_series(tmp_path)
+        manifest = Manifest(tmp_path)
+        manifest.record("a", series_fingerprint(dicom, [dat]), [output])
+        dat.write_bytes(b"\x00" * 16)
+        assert manifest.series_outputs("a", series_fingerprint(dicom, [dat])) is None
+
+    def test_changed_output_is_stale(self, tmp_path):
+        """Missing or rewritten outputs should make the series stale."""
+        dicom, dat, output = _make_series(tmp_path)
+        manifest = Manifest(tmp_path)
+        inputs = series_fingerprint(dicom, [dat])
+        manifest.record("a", inputs, [output])
+        stat = output.stat()
+        os.utime(output, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1))
+        assert manifest.series_outputs("a", inputs) is None
+        output.unlink()
+        assert manifest.series_outputs("a", inputs) is None
+
+    def test_run_up_to_date(self, tmp_path):
+        """A run should be up to date while its inputs and every series' outputs are unchanged."""
+        dicom, dat, output = _make_series(tmp_path)
+        manifest = Manifest(tmp_path)
+        manifest.record("a", series_fingerprint(dicom, [dat]), [output])
+        inputs = directory_fingerprint(tmp_path)
+        assert not manifest.run_up_to_date(["-z", "y", str(tmp_path)], inputs)
+        manifest.record_run(["-z", "y", str(tmp_path)], inputs, ["a"])
+        assert manifest.run_up_to_date(["-z", "y", str(tmp_path)], inputs)
+        assert not manifest.run_up_to_date(["-z", "n", str(tmp_path)], inputs)
+        output.unlink()
+        assert not manifest.run_up_to_date(["-z", "y", str(tmp_path)], inputs)
+
+    def test_run_stale_when_series_input_changes(self, tmp_path):
+        """A run should not be up to date once a .dat file its series used has changed, even if the run inputs haven't."""
+        dicom, dat, output = _make_series(tmp_path)
+        manifest = Manifest(tmp_path)
+        manifest.record("a", series_fingerprint(dicom, [dat]), [output])
+        manifest.record_run(["-z", "y", str(tmp_path)], "inputs", ["a"])
+        assert manifest.run_up_to_date(["-z", "y", str(tmp_path)], "inputs")
+        dat.write_bytes(b"\x00" * 16)
+        assert not manifest.run_up_to_date(["-z", "y", str(tmp_path)], "inputs")
+
+    def test_options_change_series_fingerprint(self, tmp_path):
+        """A series recorded with other conversion options should be stale."""
+        dicom, dat, output = _make_series(tmp_path)
+        manifest = Manifest(tmp_path)
+        manifest.record("a", series_fingerprint(dicom, [dat], {"out_dtype": "int16"}), [output])
+        assert manifest.series_outputs("a", series_fingerprint(dicom, [dat], {"out_dtype": "float32"})) is None
+
+    def test_clear(self, tmp_path):
+        """Clearing should forget every series and run."""
+        dicom, dat, output = _make_series(tmp_path)
+        manifest = Manifest(tmp_path)
+        inputs = series_fingerprint(dicom, [dat])
+        manifest.record("a", inputs, [output])
+        manifest.clear()
+        assert manifest.series_outputs("a", inputs) is None
+
+
+class TestDirectoryFingerprint:
+    def test_ignores_outputs(self, tmp_path):
+        """Output files and the manifest itself should not change the fingerprint."""
+        _make_series(tmp_path)
+        before = directory_fingerprint(tmp_path)
+        (tmp_path / "b.nii.gz").write_bytes(b"image")
+        (tmp_path / "b.json").write_text("{}")
+        (tmp_path / MANIFEST_NAME).write_bytes(b"db")
+        assert directory_fingerprint(tmp_path) == before
+
+    def test_new_input_changes(self, tmp_path):
+        """A new input file should change the fingerprint."""
+        _make_series(tmp_path)
+        before = directory_fingerprint(tmp_path)
+        (tmp_path / "sub").mkdir()
+        (tmp_path / "sub" / "b.dat").write_bytes(b"\x00" * 8)
+        assert directory_fingerprint(tmp_path) != before
+
+
+    def test_dat_dir_not_walked(self, tmp_path):
+        """Only the listing of a shared .dat directory should count, not the files in it."""
+        session = tmp_path / "session"
+        session.mkdir()
+        _make_series(session)
+        dat_dir = tmp_path / "dat"
+        dat_dir.mkdir()
+        (dat_dir / "other.dat").write_bytes(b"\x00" * 8)
+        before = directory_fingerprint(session, dat_dir)
+        with patch("os.walk", wraps=os.walk) as walk:
+            (dat_dir / "other.dat").write_bytes(b"\x00" * 16)
+            assert directory_fingerprint(session, dat_dir) == before
+        assert [call.args[0] for call in walk.call_args_list] == [session]
+        (dat_dir / "new.dat").write_bytes(b"\x00" * 8)
+        assert directory_fingerprint(session, dat_dir) != before
+
+def test_imports_without_version_file():
+    """The modules should import in a source checkout, where _version.py hasn't been generated."""
+    code = (
+        "import sys\n"
+        "sys.modules['xa30_workaround._version'] = None\n"
+        "import xa30_workaround.dicom, xa30_workaround.manifest, xa30_workaround.profiling\n"
+    )
+    result = subprocess.run([sys.executable, "-c", code], env={"PYTHONPATH": ROOT}, capture_output=True)
+    assert result.returncode == 0, result.stderr
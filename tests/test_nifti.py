@@ -0,0 +1,190 @@
+from typing import cast
+
+import numpy as np
+import nibabel as nib
+import pytest
+from nibabel.arrayproxy import ArrayProxy
+from numpy.typing import DTypeLike
+from xa30_workaround.nifti import (
+    NiftiStreamWriter,
+    cast_output,
+    header_dtype,
+    output_image,
+    read_first_volume,
+    save_nifti,
+)
+
+
+def _make_header(dtype: DTypeLike = np.int16):
+    header = nib.Nifti1Header()
+    header.set_data_dtype(dtype)
+    return header
+
+
+class TestHeaderDtype:
+    def test_keeps_wider_dtype(self):
+        """Header dtypes that hold uint16 safely should be kept."""
+        assert header_dtype(_make_header(np.float32)) == np.float32
+        assert header_dtype(_make_header(np.uint16)) == np.uint16
+
+    def test_keeps_int16(self):
+        """int16 headers, which dcm2niix writes for most series, should be kept."""
+        assert header_dtype(_make_header(np.int16)) == np.int16
+
+    def test_falls_back_to_uint16(self):
+        """Other header dtypes that can't hold uint16 should fall back to uint16."""
+        assert header_dtype(_make_header(np.uint8)) == np.uint16
+
+
+class TestCastOutput:
+    def test_native_keeps_data(self):
+        """native should return the data itself, unscaled."""
+        data = np.arange(10, dtype=np.uint16)
+        cast, slope_inter = cast_output(data, "native")
+        assert cast is data and slope_inter == (None, None)
+
+    @pytest.mark.parametrize("dtype", [np.int16, np.float32, np.uint16])
+    def test_header_keeps_header_dtype(self, dtype):
+        """header should store the data as the header's dtype, shifting int16 only if it doesn't fit."""
+        data = np.arange(10, dtype=np.uint16)
+        cast, slope_inter = cast_output(data, "header", _make_header(dtype))
+        assert cast.dtype == dtype and slope_inter == (None, None)
+        assert np.array_equal(cast, np.arange(10))
+        above = np.array([0, 40000], dtype=np.uint16)
+        cast, slope_inter = cast_output(above, "header", _make_header(np.int16))
+        assert cast.dtype == np.int16 and slope_inter == (1.0, 32768.0)
+
+    def test_unknown_dtype(self):
+        """Unknown policies should raise."""
+        with pytest.raises(ValueError):
+            cast_output(np.arange(10, dtype=np.uint16), "int8")
+
+    def test_int16_in_place(self):
+        """Data that fits in int16 should be reinterpreted without a copy."""
+        data = np.arange(10, dtype=np.uint16)
+        cast, slope_inter = cast_output(data, "int16")
+        assert cast.dtype == np.int16 and np.shares_memory(cast, data)
+        assert slope_inter == (None, None) and np.array_equal(cast, np.arange(10))
+
+    @pytest.mark.parametrize("suffix", [".nii", ".nii.gz"])
+    def test_int16_shifted_round_trip(self, tmp_path, suffix):
+        """Data that doesn't fit in int16 should be shifted into range and read back exactly."""
+        data = np.array([0, 1, 32767, 32768, 65535] * 12, dtype=np.uint16).reshape(3, 4, 5)
+        cast, slope_inter = cast_output(data.copy(), "int16")
+        assert cast.dtype == np.int16 and slope_inter == (1.0, 32768.0)
+        path = tmp_path / f"out{suffix}"
+        save_nifti(output_image(cast, np.eye(4), _make_header(np.float32), slope_inter), path)
+        img = nib.Nifti1Image.load(path)
+        assert img.get_data_dtype() == np.int16
+        assert np.array_equal(img.get_fdata(), data)
+
+    def test_float32(self):
+        """float32 should cast the data once."""
+        cast, slope_inter = cast_output(np.arange(10, dtype=np.uint16), "float32")
+        assert cast.dtype == np.float32 and slope_inter == (None, None)
+
+
+class TestOutputImage:
+    def test_saved_as_is(self, tmp_path):
+        """The image should be saved with the dtype of its data, whatever the header dtype."""
+        data = np.arange(60, dtype=np.uint16).reshape(3, 4, 5)
+        header = _make_header(np.int16)
+        header.set_slope_inter(2.0, 1.0)
+        save_nifti(output_image(data, np.eye(4), header), tmp_path / "out.nii")
+        img = nib.Nifti1Image.load(tmp_path / "out.nii")
+        assert img.get_data_dtype() == np.uint16
+        assert np.array_equal(np.asarray(img.dataobj), data)
+
+
+class TestReadFirstVolume:
+    @pytest.mark.parametrize("suffix", [".nii", ".nii.gz"])
+    def test_matches_nibabel(self, tmp_path, suffix):
+        """The first volume should match what nibabel reads, including scaling."""
+        data = np.arange(4 * 5 * 6 * 3, dtype=np.int16).reshape(4, 5, 6, 3)
+        img = nib.Nifti1Image(data, np.eye(4))
+        img.header.set_slope_inter(2.0, 1.0)
+        nib.save(img, tmp_path / f"out{suffix}")
+        img = nib.Nifti1Image.load(tmp_path / f"out{suffix}")
+        assert np.array_equal(read_first_volume(img), img.dataobj[..., 0])
+
+    def test_reads_only_first_volume(self, tmp_path):
+        """The rest of a .nii.gz file should never be decompressed."""
+        rng = np.random.RandomState(0)
+        data = rng.randint(0, 65535, size=(8, 8, 8, 20)).astype(np.uint16)
+        path = tmp_path / "out.nii.gz"
+        nib.save(nib.Nifti1Image(data, np.eye(4)), path)
+        img = nib.Nifti1Image.load(path)
+        # cut the file off well after its first volume
+        path.write_bytes(path.read_bytes()[: path.stat().st_size // 2])
+        assert np.array_equal(read_first_volume(img), data[..., 0])
+
+
+class TestNiftiStreamWriter:
+    @pytest.mark.parametrize("suffix", [".nii", ".nii.gz"])
+    def test_round_trip(self, tmp_path, suffix):
+        """Frames written one at a time should read back as the full 4D array."""
+        rng = np.random.RandomState(0)
+        data = rng.randint(0, 65535, size=(4, 5, 6, 3)).astype(np.uint16)
+        affine = np.diag([2.0, 2.0, 3.0, 1.0])
+        path = tmp_path / f"out{suffix}"
+        with NiftiStreamWriter(path, data.shape, affine, _make_header()) as writer:
+            for t in range(data.shape[-1]):
+                writer.write(data[..., t])
+
+        img = nib.Nifti1Image.load(path)
+        assert img.shape == data.shape
+        assert img.affine is not None and np.allclose(img.affine, affine)
+        assert np.array_equal(np.asarray(img.dataobj), data)
+
+    def test_single_frame(self, tmp_path):
+        """A 3D shape should take exactly one volume."""
+        data = np.arange(60, dtype=np.uint16).reshape(3, 4, 5)
+        path = tmp_path / "out.nii"
+        with NiftiStreamWriter(path, data.shape, np.eye(4), _make_header()) as writer:
+            writer.write(data)
+        assert np.array_equal(np.asarray(nib.Nifti1Image.load(path).dataobj), data)
+
+    def test_too_many_frames_raises(self, tmp_path):
+        """Writing more volumes than the shape holds should raise."""
+        data = np.zeros((2, 2, 2), dtype=np.uint16)
+        with pytest.raises(ValueError, match="only holds"):
+            with NiftiStreamWriter(tmp_path / "out.nii", data.shape, np.eye(4), _make_header()) as writer:
+                writer.write(data)
+                writer.write(data)
+
+    def test_values_out_of_range_raise(self, tmp_path):
+        """Volumes that don't fit in an integer dtype should raise instead of wrapping."""
+        with NiftiStreamWriter(tmp_path / "out.nii", (2, 2, 2), np.eye(4), _make_header(), dtype=np.uint8) as writer:
+            with pytest.raises(ValueError, match="don't fit"):
+                writer.write(np.full((2, 2, 2), 40000, dtype=np.uint16))
+            writer.write(np.full((2, 2, 2), 200, dtype=np.uint16))
+        assert np.all(np.asarray(nib.Nifti1Image.load(tmp_path / "out.nii").dataobj) == 200)
+
+    @pytest.mark.parametrize("suffix", [".nii", ".nii.gz"])
+    def test_int16_shifted_round_trip(self, tmp_path, suffix):
+        """uint16 volumes stored as int16 should be shifted into range and read back exactly."""
+        data = np.array([0, 1, 32767, 32768, 40000, 65535] * 20, dtype=np.uint16).reshape(2, 3, 4, 5)
+        path = tmp_path / f"out{suffix}"
+        with NiftiStreamWriter(path, data.shape, np.eye(4), _make_header(), dtype=np.int16) as writer:
+            for i in range(data.shape[3]):
+                writer.write(data[..., i])
+        img = nib.Nifti1Image.load(path)
+        assert img.get_data_dtype() == np.int16
+        proxy = cast(ArrayProxy, img.dataobj)
+        assert proxy.slope == 1.0 and proxy.inter == 32768.0
+        assert np.array_equal(img.get_fdata(), data)
+
+    def test_missing_frames_raises(self, tmp_path):
+        """Closing before all volumes are written should raise."""
+        writer = NiftiStreamWriter(tmp_path / "out.nii", (2, 2, 2, 3), np.eye(4), _make_header())
+        writer.write(np.zeros((2, 2, 2), dtype=np.uint16))
+        with pytest.raises(ValueError, match="1 of 3 frames"):
+            writer.close()
+
+    def test_removes_partial_file_on_error(self, tmp_path):
+        """An exception inside the context should remove the partial file."""
+        path = tmp_path / "out.nii"
+        with pytest.raises(RuntimeError):
+            with NiftiStreamWriter(path, (2, 2, 2, 3), np.eye(4), _make_header()):
+                raise RuntimeError("decode failed")
+        assert not path.exists()
@@ -0,0 +1,163 @@
+from unittest.mock import patch
+
+import numpy as np
+import pytest
+from xa30_workaround.orientation import (
+    find_orientation,
+    flip_candidates,
+    geometry_orientation,
+    match_orientation,
+    normalized_volume,
+    resolve_orientation,
+)
+
+ALL_FLIPS = [(), (0,), (1,), (2,), (0, 1), (0, 2), (1, 2), (0, 1, 2)]
+
+
+def _volume(shape=(8, 9, 10)):
+    """A smooth, asymmetric volume like a brain image, plus some noise."""
+    x, y, z = np.meshgrid(*[np.linspace(0, 1, n) for n in shape], indexing="ij")
+    noise = np.random.RandomState(0).rand(*shape)
+    return (1000 * (x**2 + 2 * y**3 + 3 * z) + 10 * noise).astype(np.uint16)
+
+
+class TestNormalizedVolume:
+    def test_float32_between_zero_and_one(self):
+        """Volumes should be copied to float32 and scaled to [0, 1]."""
+        volume = _volume()
+        result = normalized_volume(volume)
+        assert result.dtype == np.float32
+        assert result.min() == 0.0
+        assert result.max() == 1.0
+        assert volume.dtype == np.uint16
+
+
+class TestFlipCandidates:
+    @pytest.mark.parametrize("flips", ALL_FLIPS)
+    def test_best_guess_first(self, flips):
+        """The projections should identify the flip without any full comparison."""
+        nifti = normalized_volume(_volume())
+        dat = normalized_volume(np.flip(_volume(), flips))
+        assert flip_candidates(dat, nifti) == [flips]
+
+    def test_symmetric_axis_is_ambiguous(self):
+        """An axis with a symmetric profile should offer both choices."""
+        volume = _volume()
+        # make axis 2 symmetric
+        volume = np.concatenate([volume, np.flip(volume, 2)], axis=2)
+        nifti = normalized_volume(volume)
+        candidates = flip_candidates(normalized_volume(np.flip(volume, 0)), nifti)
+        assert sorted(candidates) == [(0,), (0, 2)]
+
+
+class TestFindOrientation:
+    @pytest.mark.parametrize("flips", ALL_FLIPS)
+    def test_finds_flip(self, flips):
+        """The flip found should line the dat up with the nifti."""
+        volume = _volume()
+        dat = np.flip(volume, flips)[..., np.newaxis]
+        axes = find_orientation(dat, volume)
+        assert np.array_equal(np.flip(dat[..., 0], axes), volume)
+
+    def test_accepts_first_nifti_volume(self):
+        """A multi-frame dat should match against just the first volume of the nifti."""
+        volume = _volume()
+        dat = np.flip(volume, 2)[..., np.newaxis, np.newaxis]
+        assert find_orientation(dat, volume) == find_orientation(dat, volume[..., np.newaxis]) == (2,)
+
+    def test_falls_back_to_full_search(self):
+        """If the projections mislead, the other flips should still be tried."""
+        volume = _volume()
+        dat = np.flip(volume, 1)[..., np.newaxis]
+        with patch("xa30_workaround.orientation.flip_candidates", return_value=[(0,)]):
+            assert find_orientation(dat, volume) == (1,)
+
+    def test_flat_volume_raises(self):
+        """A flat volume can't be matched."""
+        volume = np.ones((4, 5, 6), dtype=np.uint16)
+        with pytest.raises(ValueError, match="Sanity check failed"):
+            find_orientation(volume[..., np.newaxis], volume)
+
+    def test_shape_mismatch_raises(self):
+        """Volumes of different shapes can't be matched."""
+        with pytest.raises(ValueError, match="Sanity check failed"):
+            find_orientation(_volume((4, 5, 6))[..., np.newaxis], _volume((6, 5, 4)))
+
+
+class TestMatchOrientationView:
+    def test_returns_view(self):
+        """The matched data should be a flipped view, not a copy."""
+        volume = _volume()
+        dat = np.stack([np.flip(volume, (0, 2))] * 2, axis=-1)[..., np.newaxis]
+        result = match_orientation(dat, volume[..., np.newaxis])
+        assert np.shares_memory(result, dat)
+        assert np.array_equal(result[..., 0, 0], volume)
+
+
+def _affine(row, column, flips=()):
+    """An affine laid out like dcm2niix output for a slice geometry, with some of its axes flipped."""
+    row, column = np.array(row, dtype=float), np.array(column, dtype=float)
+    # dcm2niix affines are in RAS, ImageOrientationPatient in LPS
+    to_ras = np.array([-1.0, -1.0, 1.0])
+    directions = [row * to_ras, -column * to_ras, np.cross(row, column) * to_ras]
+    affine = np.eye(4)
+    for axis, direction in enumerate(directions):
+        affine[:3, axis] = -2 * direction if axis in flips else 2 * direction
+    return affine
+
+
+class TestGeometryOrientation:
+    @pytest.mark.parametrize("flips", ALL_FLIPS)
+    def test_axial(self, flips):
+        """Flipped axes of the affine should be the axes to flip."""
+        orientation = [1, 0, 0, 0, 1, 0]
+        assert geometry_orientation(_affine(orientation[:3], orientation[3:], flips), orientation) == flips
+
+    @pytest.mark.parametrize("flips", [(), (1,), (0, 2)])
+    def test_oblique(self, flips):
+        """Oblique geometries should be resolved the same way."""
+        angle = np.deg2rad(20)
+        orientation = [np.cos(angle), 0, np.sin(angle), 0, 1, 0]
+        assert geometry_orientation(_affine(orientation[:3], orientation[3:], flips), orientation) == flips
+
+    def test_identity_affine(self):
+        """An identity (RAS) affine runs against the DICOM row direction of an axial scan."""
+        assert geometry_orientation(np.eye(4), [1, 0, 0, 0, 1, 0]) == (0,)
+
+    def test_permuted_axes_unresolved(self):
+        """Flips alone can't explain swapped axes."""
+        affine = _affine([1, 0, 0], [0, 1, 0])[:, [1, 0, 2, 3]]
+        assert geometry_orientation(affine, [1, 0, 0, 0, 1, 0]) is None
+
+
+class TestResolveOrientation:
+    def test_geometry_checked_against_content(self):
+        """In auto mode, geometry that agrees with the content should be used as is."""
+        volume = _volume()
+        dat = np.flip(volume, (0, 2))[..., np.newaxis]
+        with patch("xa30_workaround.orientation.find_orientation", side_effect=AssertionError("searched")):
+            assert resolve_orientation(dat, volume, (0, 2)) == (0, 2)
+
+    def test_wrong_geometry_falls_back_to_content(self, capsys):
+        """In auto mode, geometry that disagrees with the content should fall back to searching."""
+        volume = _volume()
+        dat = np.flip(volume, (1,))[..., np.newaxis]
+        assert resolve_orientation(dat, volume, (0,)) == (1,)
+        assert "does not match" in capsys.readouterr().out
+
+    def test_geometry_mode_skips_content(self):
+        """In geometry mode, flat volumes that can't be matched should still be oriented."""
+        volume = np.ones((4, 5, 6), dtype=np.uint16)
+        assert resolve_orientation(volume[..., np.newaxis], volume, (2,), mode="geometry") == (2,)
+
+    def test_geometry_mode_without_geometry_raises(self):
+        """In geometry mode, missing geometry is an error."""
+        volume = _volume()
+        with pytest.raises(ValueError, match="scan geometry"):
+            resolve_orientation(volume[..., np.newaxis], volume, None, mode="geometry")
+
+    def test_content_mode_ignores_geometry(self):
+        """In content mode, the geometry should be ignored."""
+        volume = _volume()
+        dat = np.flip(volume, (1,))[..., np.newaxis]
+        assert resolve_orientation(dat, volume, (0,), mode="content") == (1,)
@@ -0,0 +1,84 @@
+import threading
+
+import pytest
+from xa30_workaround.output import OutputQueue
+
+
+def _write(path, text):
+    with open(path, "w") as f:
+        f.write(text)
+
+
+def _write_partial(path):
+    with open(path, "w") as f:
+        f.write("partial")
+    raise OSError("disk full")
+
+
+class TestOutputQueue:
+    def test_writes_files(self, tmp_path):
+        """Every queued file should be written by the time the queue is closed."""
+        with OutputQueue(3) as queue:
+            for i in range(10):
+                queue.submit(tmp_path / f"{i}.txt", _write, tmp_path / f"{i}.txt", str(i))
+        assert [(tmp_path / f"{i}.txt").read_text() for i in range(10)] == [str(i) for i in range(10)]
+
+    def test_error_raised_and_partial_file_removed(self, tmp_path):
+        """A failing write should be re-raised and its partial file removed."""
+        path = tmp_path / "out.txt"
+        with pytest.raises(OSError, match="disk full"):
+            with OutputQueue(2) as queue:
+                queue.submit(path, _write_partial, path)
+                queue.submit(tmp_path / "ok.txt", _write, tmp_path / "ok.txt", "ok")
+        assert not path.exists()
+        assert (tmp_path / "ok.txt").read_text() == "ok"
+
+    def test_error_raised_by_next_submit(self, tmp_path):
+        """Once a write has failed, submitting another should raise."""
+        queue = OutputQueue(1, max_pending=1)
+        queue.submit(tmp_path / "out.txt", _write_partial, tmp_path / "out.txt")
+        with pytest.raises(OSError, match="disk full"):
+            queue.submit(tmp_path / "next.txt", _write, tmp_path / "next.txt", "next")
+        assert not (tmp_path / "next.txt").exists()
+
+    def test_bounded(self, tmp_path):
+        """Submitting should block while max_pending writes are queued."""
+        release = threading.Event()
+        queue = OutputQueue(1, max_pending=1)
+        queue.submit(tmp_path / "a.txt", release.wait)
+        submitted = threading.Event()
+
+        def submit():
+            queue.submit(tmp_path / "b.txt", _write, tmp_path / "b.txt", "b")
+            submitted.set()
+
+        thread = threading.Thread(target=submit)
+        thread.start()
+        assert not submitted.wait(0.2)
+        release.set()
+        assert submitted.wait(5)
+        thread.join()
+        queue.close()
+        assert (tmp_path / "b.txt").read_text() == "b"
+
+    def test_flush_waits_for_queued_writes(self, tmp_path):
+        """flush should only return once every queued write has finished, raising any error."""
+        release = threading.Event()
+        queue = OutputQueue(2)
+        queue.submit(tmp_path / "a.txt", lambda: release.wait() and _write(tmp_path / "a.txt", "a"))
+        flushed = threading.Event()
+
+        def flush():
+            queue.flush()
+            flushed.set()
+
+        thread = threading.Thread(target=flush)
+        thread.start()
+        assert not flushed.wait(0.2)
+        release.set()
+        assert flushed.wait(5)
+        thread.join()
+        assert (tmp_path / "a.txt").read_text() == "a"
+        queue.submit(tmp_path / "b.txt", _write_partial, tmp_path / "b.txt")
+        with pytest.raises(OSError, match="disk full"):
+            queue.flush()
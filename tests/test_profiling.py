@@ -0,0 +1,96 @@
+import json
+import pickle
+import sys
+from unittest.mock import patch
+
+from xa30_workaround.profiling import LOG_PREFIX, Profiler, new_record, peak_rss, profile_stage
+
+
+class TestProfiler:
+    def test_stages_are_totalled(self):
+        """Repeated runs of a stage should be added up per series."""
+        profiler = Profiler()
+        for _ in range(3):
+            with profiler.stage("decode", "a") as record:
+                record["bytes_read"] += 10
+        with profiler.stage("decode", "b"):
+            pass
+        records = {(record["series"], record["stage"]): record for record in profiler.records()}
+        assert records[("a", "decode")]["calls"] == 3
+        assert records[("a", "decode")]["bytes_read"] == 30
+        assert records[("a", "decode")]["seconds"] >= 0
+        assert records[("a", "decode")]["peak_rss_bytes"] > 0
+        assert records[("b", "decode")]["calls"] == 1
+
+    def test_stage_recorded_on_error(self):
+        """A stage that raises should still be recorded."""
+        profiler = Profiler()
+        try:
+            with profiler.stage("write", "a"):
+                raise OSError("disk full")
+        except OSError:
+            pass
+        assert [record["stage"] for record in profiler.records()] == ["write"]
+
+    def test_merge_from_worker(self):
+        """A profiler sent to a worker should start empty, and its stages should merge back in."""
+        profiler = Profiler(log=True)
+        with profiler.stage("dcm2niix", "a"):
+            pass
+        worker = pickle.loads(pickle.dumps(profiler))
+        assert worker.records() == [] and worker.log
+        with worker.stage("decode", "a") as record:
+            record["bytes_read"] = 5
+        profiler.merge(worker.records())
+        assert sorted(record["stage"] for record in profiler.records()) == ["dcm2niix", "decode"]
+
+    def test_report(self, tmp_path):
+        """The report should break the stages down by series and total them."""
+        profiler = Profiler()
+        for series in ["a", "b"]:
+            record = new_record("write", series)
+            record.update(seconds=1.0, bytes_written=100)
+            profiler.add(record)
+        profiler.add(new_record("dcm2niix"))
+        profiler.write_report(tmp_path / "report.json", ["-z", "y", "dir"])
+        report = json.loads((tmp_path / "report.json").read_text())
+        assert report["argv"] == ["-z", "y", "dir"]
+        assert report["series"]["a"]["write"]["bytes_written"] == 100
+        assert report["totals"]["write"] == {
+            "seconds": 2.0,
+            "bytes_read": 0,
+            "bytes_written": 200,
+            "calls": 2,
+            "series": 2,
+        }
+        assert report["totals"]["dcm2niix"]["series"] == 0
+        assert report["peak_rss_bytes"] > 0
+
+    def test_log_lines(self, capsys):
+        """With log set, each run of a stage should be printed as a line of JSON."""
+        profiler = Profiler(log=True)
+        with profiler.stage("protocol", "a"):
+            pass
+        (line,) = capsys.readouterr().err.splitlines()
+        prefix, record = line.split(" ", 1)
+        assert prefix == LOG_PREFIX
+        assert json.loads(record)["stage"] == "protocol"
+
+
+def test_profile_stage_without_profiler():
+    """Without a profiler, a stage should still yield a record to fill in."""
+    with profile_stage(None, "write", "a") as record:
+        record["bytes_written"] += 1
+    assert record["bytes_written"] == 1
+
+
+def test_without_resource_module():
+    """Where the resource module is missing, e.g. on Windows, profiling should work without peak RSS."""
+    with patch.dict(sys.modules, {"resource": None}):
+        assert peak_rss() is None
+        profiler = Profiler()
+        for _ in range(2):
+            with profiler.stage("write", "a"):
+                pass
+        (record,) = profiler.records()
+    assert record["calls"] == 2 and record["peak_rss_bytes"] is None
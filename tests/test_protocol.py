@@ -0,0 +1,107 @@
+import time
+
+import numpy as np
+import pytest
+from xa30_workaround.protocol import parse_ascconv, parse_value, read_protocol
+
+ASCCONV = b"""### ASCCONV BEGIN object=MrProtDataImpl@MrProtocolData version=51130001 ###
+ulVersion\t = \t0x14b44b6
+tProtocolName\t = \t""MBME_DcmOnlyE1""
+lContrasts\t = \t3
+alTE[0]\t = \t14200
+alTE[1]\t = \t38930
+alTE[2]\t = \t63660
+alTE[3]\t = \t0
+lRepetitions\t = \t499
+sSliceArray.lSize\t = \t72
+sSliceArray.ucMode\t = \t0x4
+sSliceAcceleration.lMultiBandFactor\t = \t6
+sKSpace.lBaseResolution\t = \t110
+sKSpace.lPhaseEncodingLines\t = \t110
+sSliceArray.asSlice[0].dThickness\t = \t2.0\t# in mm
+### ASCCONV END ###
+"""
+
+
+def _write_dicom(path, protocol, pixel_bytes=0):
+    """Write a DICOM-like file with a header, the protocol and some pixel data."""
+    path.write_bytes(b"\x00" * 128 + b"DICM" + b"header\n" + protocol + b"\n" + b"\xff" * pixel_bytes)
+    return path
+
+
+class TestParseValue:
+    @pytest.mark.parametrize(
+        "value, expected",
+        [("14200", 14200), ("0x4", 4), ("2.5", 2.5), ('""name""', "name"), ("2.0\t# in mm", 2.0), ("abc", "abc")],
+    )
+    def test_values(self, value, expected):
+        """ASCCONV values should be converted to Python values."""
+        assert parse_value(value) == expected
+
+
+class TestParseAscconv:
+    def test_flat_parameters(self):
+        """Each assignment line should become a parameter."""
+        parameters = parse_ascconv(ASCCONV.decode())
+        assert parameters["alTE[1]"] == 38930
+        assert parameters["sSliceArray.asSlice[0].dThickness"] == 2.0
+        assert parameters["tProtocolName"] == "MBME_DcmOnlyE1"
+        assert "### ASCCONV BEGIN object" not in parameters
+
+
+class TestReadProtocol:
+    def test_ascconv_block(self, tmp_path):
+        """The ASCCONV block should be parsed into a structured protocol."""
+        protocol = read_protocol(_write_dicom(tmp_path / "a.dcm", ASCCONV))
+        assert protocol["alTE"] == [14200, 38930, 63660]
+        assert np.allclose(protocol["echo_times"], [0.0142, 0.03893, 0.06366])
+        assert protocol["num_slices"] == 72
+        assert protocol["slice_mode"] == "interleaved"
+        assert protocol["multiband_factor"] == 6
+        assert protocol["base_resolution"] == 110
+        assert protocol["phase_encoding_lines"] == 110
+        assert protocol["num_repetitions"] == 499
+
+    def test_legacy_layout(self, tmp_path):
+        """An alTE line followed by value lines should still be read."""
+        lines = b"alTE\n" + b"".join(f"= \t{te}\n".encode() for te in [20000, 40000, 0, 0, 0, 0, 0, 0])
+        protocol = read_protocol(_write_dicom(tmp_path / "a.dcm", lines))
+        assert np.allclose(protocol["echo_times"], [0.02, 0.04])
+        assert protocol["num_slices"] is None
+
+    def test_ignores_pixel_data(self, tmp_path):
+        """Protocol parsing should not depend on anything after the header."""
+        small = read_protocol(_write_dicom(tmp_path / "small.dcm", ASCCONV))
+        large = read_protocol(_write_dicom(tmp_path / "large.dcm", ASCCONV, pixel_bytes=4 * 1024 * 1024))
+        assert np.array_equal(small["echo_times"], large["echo_times"])
+        assert small["ascconv"] == large["ascconv"]
+
+    def test_legacy_layout_time_independent_of_pixel_data(self, tmp_path):
+        """Without an ASCCONV block, the search for one should stop at the header, not scan the pixel data."""
+        lines = b"alTE\n" + b"".join(f"= \t{te}\n".encode() for te in [20000, 40000, 0, 0, 0, 0, 0, 0])
+        small = _write_dicom(tmp_path / "small.dcm", lines)
+        # a sparse file, so the pixel data costs no disk space
+        large = _write_dicom(tmp_path / "large.dcm", lines)
+        with open(large, "r+b") as f:
+            f.truncate(256 * 1024 * 1024)
+
+        def read_time(path):
+            times = []
+            for _ in range(3):
+                start = time.perf_counter()
+                assert read_protocol(path)["alTE"][:2] == [20000, 40000]
+                times.append(time.perf_counter() - start)
+            return min(times)
+
+        assert read_time(large) < 5 * read_time(small) + 0.01
+
+    def test_missing_alte(self, tmp_path):
+        """Files without a protocol should have no echo times."""
+        protocol = read_protocol(_write_dicom(tmp_path / "a.dcm", b"nothing here"))
+        assert protocol["echo_times"] is None
+        assert protocol["ascconv"] == {}
+
+    def test_empty_file(self, tmp_path):
+        """Empty files should have no echo times."""
+        (tmp_path / "a.dcm").write_bytes(b"")
+        assert read_protocol(tmp_path / "a.dcm")["echo_times"] is None
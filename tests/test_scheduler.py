@@ -0,0 +1,94 @@
+import pytest
+from xa30_workaround.scheduler import SeriesScheduler, available_memory, capture_output, capture_result
+
+
+def _chatty(name, lines):
+    for i in range(lines):
+        print(f"{name} line {i}")
+
+
+def _square(x):
+    print(x)
+    return x * x
+
+
+def _failing(name):
+    print(f"{name} starting")
+    raise ValueError(f"{name} failed")
+
+
+class TestAvailableMemory:
+    def test_positive(self):
+        """Available memory should be a positive number of bytes on this platform."""
+        memory = available_memory()
+        assert memory is None or memory > 0
+
+
+class TestCaptureOutput:
+    def test_captures_prints(self):
+        """Printed output should be returned rather than written to stdout."""
+        log, error = capture_output(_chatty, "a", 2)
+        assert log == "a line 0\na line 1\n"
+        assert error is None
+
+    def test_returns_error(self):
+        """Exceptions should be returned along with the output so far."""
+        log, error = capture_output(_failing, "a")
+        assert log == "a starting\n"
+        assert isinstance(error, ValueError)
+
+    def test_captures_result(self):
+        """capture_result should also return the value returned by the function."""
+        assert capture_result(_square, 3) == ("3\n", None, 9)
+
+
+class TestSeriesScheduler:
+    def test_logs_are_not_interleaved(self, capsys):
+        """Each series' output should be printed in one contiguous block."""
+        with SeriesScheduler(3) as scheduler:
+            for name in ["a", "b", "c", "d"]:
+                scheduler.submit(_chatty, name, 50)
+        out = capsys.readouterr().out.splitlines()
+        assert len(out) == 200
+        for block in range(4):
+            names = {line.split()[0] for line in out[block * 50 : (block + 1) * 50]}
+            assert len(names) == 1
+
+    def test_results_collected(self, capsys):
+        """The values returned by the series should be collected."""
+        with SeriesScheduler(2) as scheduler:
+            for x in range(4):
+                scheduler.submit(_square, x)
+        assert sorted(scheduler.results) == [0, 1, 4, 9]
+
+    def test_error_is_raised(self, capsys):
+        """An error in a worker should be raised after its output is printed."""
+        with pytest.raises(ValueError, match="b failed"):
+            with SeriesScheduler(2) as scheduler:
+                scheduler.submit(_chatty, "a", 1)
+                scheduler.submit(_failing, "b")
+        assert "b starting" in capsys.readouterr().out
+
+    def test_drain_keeps_workers(self, capsys):
+        """After drain raises the error of a batch of series, the scheduler should run more series."""
+        with SeriesScheduler(2) as scheduler:
+            scheduler.submit(_failing, "a")
+            with pytest.raises(ValueError, match="a failed"):
+                scheduler.drain()
+            scheduler.submit(_square, 3)
+            scheduler.drain()
+        assert scheduler.results == [9]
+
+    def test_memory_admission(self):
+        """A series should only be admitted if it fits alongside the running ones."""
+        scheduler = SeriesScheduler(4, memory_limit=100)
+        try:
+            assert scheduler.fits(500)  # nothing running, always admitted
+            scheduler.running = {"x": 60}
+            assert scheduler.fits(40)
+            assert not scheduler.fits(41)
+            scheduler.running = {"x": 10, "y": 10, "z": 10, "w": 10}
+            assert not scheduler.fits(1)  # no free worker
+        finally:
+            scheduler.running = {}
+            scheduler.close()
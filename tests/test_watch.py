@@ -0,0 +1,113 @@
+import threading
+import time
+
+from xa30_workaround.watch import Inbox, InotifyWatcher, PollingWatcher, make_watcher, snapshot
+
+
+class TestSnapshot:
+    def test_ignores_outputs(self, tmp_path):
+        """Output files should not count as session files."""
+        (tmp_path / "a.dcm").write_bytes(b"dicom")
+        (tmp_path / "a.nii.gz").write_bytes(b"image")
+        (tmp_path / "a.json").write_text("{}")
+        assert list(snapshot(tmp_path)) == [str(tmp_path / "a.dcm")]
+
+
+class TestInbox:
+    def test_settles_after_quiet_period(self, tmp_path):
+        """A session should only be reported once its files are unchanged for the settle time."""
+        session = tmp_path / "session1"
+        session.mkdir()
+        (session / "a.dcm").write_bytes(b"dicom")
+        inbox = Inbox(tmp_path, settle=10)
+        assert inbox.scan(now=0) == []
+        assert inbox.scan(now=5) == []
+        (settled, files), *rest = inbox.scan(now=10)
+        assert settled == str(session) and not rest
+        # a change restarts the wait
+        (session / "a.dat").write_bytes(b"\x00" * 4)
+        assert inbox.scan(now=15) == []
+        assert [s for s, _ in inbox.scan(now=25)] == [str(session)]
+
+    def test_handled_until_changed(self, tmp_path):
+        """A handled session should not be reported again until its files change."""
+        session = tmp_path / "session1"
+        session.mkdir()
+        (session / "a.dcm").write_bytes(b"dicom")
+        inbox = Inbox(tmp_path, settle=0)
+        [(path, files)] = inbox.scan(now=0)
+        inbox.handled(path, files)
+        assert inbox.scan(now=1) == []
+        assert not inbox.pending()
+        (session / "b.dcm").write_bytes(b"dicom")
+        assert [s for s, _ in inbox.scan(now=2)] == [str(session)]
+        assert inbox.pending()
+
+    def test_empty_and_hidden_sessions_ignored(self, tmp_path):
+        """Empty and hidden directories and loose files are not sessions."""
+        (tmp_path / "empty").mkdir()
+        (tmp_path / ".hidden").mkdir()
+        (tmp_path / ".hidden" / "a.dcm").write_bytes(b"dicom")
+        (tmp_path / "loose.dcm").write_bytes(b"dicom")
+        assert Inbox(tmp_path, settle=0).scan(now=0) == []
+
+    def test_shared_dirs_count(self, tmp_path, dicom_file):
+        """Changes to the session's own .dat files in a shared directory should hold it back."""
+        dicom_file(tmp_path / "inbox" / "session1" / "a.dcm", "1.2.3.4.0.0.0")
+        dat_dir = tmp_path / "dats"
+        dat_dir.mkdir()
+        inbox = Inbox(tmp_path / "inbox", settle=5, shared_dirs=[dat_dir])
+        inbox.scan(now=0)
+        (dat_dir / "img_1.2.3.4_001.dat").write_bytes(b"\x00" * 4)
+        assert inbox.scan(now=5) == []
+        [(_, files)] = inbox.scan(now=10)
+        assert str(dat_dir / "img_1.2.3.4_001.dat") in files
+
+    def test_unrelated_shared_files_ignored(self, tmp_path, dicom_file):
+        """A handled session should stay handled when .dat files of another session arrive in a shared directory."""
+        dicom_file(tmp_path / "inbox" / "session1" / "a.dcm", "1.2.3.4.0.0.0")
+        dicom_file(tmp_path / "inbox" / "session2" / "a.dcm", "1.2.3.5.0.0.0")
+        dat_dir = tmp_path / "dats"
+        dat_dir.mkdir()
+        (dat_dir / "img_1.2.3.4_001.dat").write_bytes(b"\x00" * 4)
+        inbox = Inbox(tmp_path / "inbox", settle=0, shared_dirs=[dat_dir])
+        settled = inbox.scan(now=0)
+        assert [session for session, _ in settled] == [
+            str(tmp_path / "inbox" / "session1"),
+            str(tmp_path / "inbox" / "session2"),
+        ]
+        for session, files in settled:
+            inbox.handled(session, files)
+        (dat_dir / "img_1.2.3.5_001.dat").write_bytes(b"\x00" * 4)
+        (dat_dir / "img_9.9.9_001.dat").write_bytes(b"\x00" * 4)
+        assert [session for session, _ in inbox.scan(now=1)] == [str(tmp_path / "inbox" / "session2")]
+
+
+class TestWatchers:
+    def test_inotify_wakes_on_change(self, tmp_path):
+        """inotify should wake up as soon as a file appears, well before the interval."""
+        watcher = make_watcher(interval=30)
+        if not isinstance(watcher, InotifyWatcher):
+            return
+        (tmp_path / "session1").mkdir()
+        watcher.add(tmp_path)
+        timer = threading.Timer(0.1, (tmp_path / "session1" / "a.dat").write_bytes, [b"\x00"])
+        timer.start()
+        start = time.monotonic()
+        watcher.wait()
+        watcher.close()
+        assert time.monotonic() - start < 10
+
+    def test_inotify_times_out(self, tmp_path):
+        """Without changes, inotify should wait for the interval."""
+        watcher = make_watcher(interval=0.05)
+        watcher.add(tmp_path)
+        watcher.wait()
+        watcher.close()
+
+    def test_polling_sleeps(self):
+        """The polling fallback should just wait for the interval."""
+        watcher = PollingWatcher(0.01)
+        watcher.add("anything")
+        watcher.wait()
+        watcher.close()
@@ -0,0 +1,52 @@
+import csv
+import json
+import shlex
+from pathlib import Path
+
+# columns of a batch manifest, of which only dicom_dir is required
+SESSION_FIELDS = ("dicom_dir", "dat_dir", "out_dir", "args")
+
+
+def read_sessions(path):
+    """Read the sessions listed in a batch manifest.
+
+    The manifest is a JSON list of objects if its name ends in ``.json``, otherwise a CSV file with a
+    header row. Each session has a ``dicom_dir`` and optionally a ``dat_dir``, an ``out_dir`` and
+    ``args``, the extra dcmdat2niix and dcm2niix arguments of the session, as a list or as a string
+    split like a shell command line. Relative directories are taken from the manifest's directory.
+    """
+    path = Path(path)
+    if path.suffix.lower() == ".json":
+        with open(path) as f:
+            rows = json.load(f)
+        if not isinstance(rows, list):
+            raise ValueError(f"Expected a list of sessions in {path}.")
+    else:
+        with open(path, newline="") as f:
+            rows = list(csv.DictReader(f))
+
+    sessions = []
+    for number, row in enumerate(rows, 1):
+        unknown = set(row) - set(SESSION_FIELDS)
+        if unknown:
+            raise ValueError(f"Session {number} of {path} has unknown fields: {', '.join(sorted(unknown))}.")
+        if not row.get("dicom_dir"):
+            raise ValueError(f"Session {number} of {path} has no dicom_dir.")
+        session = {}
+        for field in ["dicom_dir", "dat_dir", "out_dir"]:
+            # empty CSV cells leave a field out
+            session[field] = path.parent / row[field] if row.get(field) else None
+        args = row.get("args") or []
+        session["args"] = shlex.split(args) if isinstance(args, str) else [str(arg) for arg in args]
+        sessions.append(session)
+    return sessions
+
+
+def session_argv(session, common_args=()):
+    """The dcmdat2niix arguments converting a session, after the arguments common to every session."""
+    argv = list(common_args) + session["args"]
+    if session["dat_dir"] is not None:
+        argv += ["--dat-dir", str(session["dat_dir"])]
+    if session["out_dir"] is not None:
+        argv += ["-o", str(session["out_dir"])]
+    return argv + [str(session["dicom_dir"])]
@@ -0,0 +1,91 @@
+import json
+import os
+import sqlite3
+import time
+from contextlib import contextmanager
+from pathlib import Path
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS headers (
+    path TEXT NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    size INTEGER NOT NULL,
+    series_uid TEXT,
+    entry TEXT NOT NULL,
+    accessed REAL NOT NULL,
+    PRIMARY KEY (path, mtime_ns, size)
+);
+CREATE INDEX IF NOT EXISTS headers_accessed ON headers (accessed);
+"""
+
+
+class HeaderCache:
+    """On-disk cache of parsed DICOM header information.
+
+    Entries are keyed by the DICOM file's path, modification time and size, so a file that changes
+    is parsed again, and hold JSON-serializable fields such as the Series Instance UID, echo times,
+    slice ordering and orientation. Once there are more than ``max_entries`` entries, the least
+    recently used ones are evicted. The cache is a SQLite database, so it can be shared by several
+    processes.
+    """
+
+    def __init__(self, cache_dir, max_entries=10000):
+        self.cache_dir = Path(cache_dir)
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        self.path = self.cache_dir / "headers.sqlite"
+        self.max_entries = max_entries
+        with self.connect() as conn:
+            conn.executescript(SCHEMA)
+
+    @contextmanager
+    def connect(self):
+        """Open a connection to the cache database, committing and closing it when done."""
+        conn = sqlite3.connect(self.path, timeout=60)
+        try:
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    @staticmethod
+    def key(dicom):
+        """Identify a file by its resolved path, modification time and size."""
+        stat = os.stat(dicom)
+        return str(Path(dicom).resolve()), stat.st_mtime_ns, stat.st_size
+
+    def get(self, dicom):
+        """Return the cached entry for a DICOM file, or an empty dict if it isn't cached."""
+        key = self.key(dicom)
+        with self.connect() as conn:
+            row = conn.execute("SELECT entry FROM headers WHERE path = ? AND mtime_ns = ? AND size = ?", key).fetchone()
+            if row is None:
+                return {}
+            conn.execute(
+                "UPDATE headers SET accessed = ? WHERE path = ? AND mtime_ns = ? AND size = ?", (time.time(), *key)
+            )
+        return json.loads(row[0])
+
+    def update(self, dicom, **fields):
+        """Add fields to the cached entry for a DICOM file, returning the updated entry."""
+        key = self.key(dicom)
+        with self.connect() as conn:
+            row = conn.execute("SELECT entry FROM headers WHERE path = ? AND mtime_ns = ? AND size = ?", key).fetchone()
+            entry = {} if row is None else json.loads(row[0])
+            entry.update(fields)
+            # drop entries for older versions of this file
+            conn.execute("DELETE FROM headers WHERE path = ?", key[:1])
+            conn.execute(
+                "INSERT INTO headers VALUES (?, ?, ?, ?, ?, ?)",
+                (*key, entry.get("series_uid"), json.dumps(entry), time.time()),
+            )
+            self.evict(conn)
+        return entry
+
+    def evict(self, conn):
+        """Remove the least recently used entries beyond max_entries."""
+        (count,) = conn.execute("SELECT COUNT(*) FROM headers").fetchone()
+        if count > self.max_entries:
+            conn.execute(
+                "DELETE FROM headers WHERE rowid IN (SELECT rowid FROM headers ORDER BY accessed LIMIT ?)",
+                (count - self.max_entries,),
+            )
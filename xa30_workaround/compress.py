@@ -0,0 +1,178 @@
+import io
+import os
+import shutil
+import struct
+import subprocess
+import zlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+# pigz compresses 128 KiB blocks, each primed with the 32 KiB of input before it
+BLOCK_SIZE = 128 * 1024
+DICTIONARY_SIZE = 32 * 1024
+
+# nibabel writes .gz files at level 1 by default
+DEFAULT_LEVEL = 1
+
+
+def available_cpus():
+    """Number of CPUs this process may run on."""
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        # not available on macOS or Windows
+        return os.cpu_count() or 1
+
+
+def default_threads(writers=1):
+    """Threads for each of ``writers`` outputs compressed at once, so that between them they use every available CPU."""
+    return max(1, available_cpus() // writers)
+
+
+def compress_block(block, dictionary, level, last):
+    """Compress a block to raw deflate data that can be concatenated with the blocks around it."""
+    if dictionary:
+        compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS, zdict=dictionary)
+    else:
+        compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+    # a sync flush ends the block on a byte boundary without ending the deflate stream
+    return compressor.compress(block) + compressor.flush(zlib.Z_FINISH if last else zlib.Z_SYNC_FLUSH)
+
+
+class ParallelGzipWriter(io.RawIOBase):
+    """Write a gzip file, compressing independent blocks on a thread pool, like pigz.
+
+    The input is split into blocks that are compressed concurrently (zlib releases the GIL) and
+    written in order as a single standard gzip member, so any gzip reader can decompress it. Only
+    a few blocks per thread are held in memory at once.
+    """
+
+    def __init__(self, path, level=DEFAULT_LEVEL, threads=None):
+        self.path = os.fspath(path)
+        self.level = level
+        self.threads = threads or default_threads()
+        self.buffer = bytearray()
+        self.dictionary = b""
+        self.crc = 0
+        self.size = 0
+        self.pending = deque()
+        self.pool = ThreadPoolExecutor(self.threads)
+        self.fileobj = open(self.path, "wb")
+        # magic, deflate, no flags, no mtime, no extra flags, unknown OS
+        self.fileobj.write(b"\x1f\x8b\x08\x00" + struct.pack("<I", 0) + b"\x00\xff")
+
+    def writable(self):
+        return True
+
+    def tell(self):
+        """Number of uncompressed bytes written so far."""
+        return self.size
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        # only seeking to where we already are is supported, like other compressed streams
+        if whence != io.SEEK_SET or offset != self.size:
+            raise io.UnsupportedOperation("ParallelGzipWriter can only be written sequentially.")
+        return self.size
+
+    def write(self, data):
+        data = memoryview(data).cast("B")
+        self.crc = zlib.crc32(data, self.crc)
+        self.size += len(data)
+        self.buffer += data
+        while len(self.buffer) > BLOCK_SIZE:
+            self.submit(bytes(self.buffer[:BLOCK_SIZE]), last=False)
+            del self.buffer[:BLOCK_SIZE]
+        return len(data)
+
+    def submit(self, block, last):
+        """Queue a block for compression, writing out finished blocks to bound memory use."""
+        while len(self.pending) >= 2 * self.threads:
+            self.fileobj.write(self.pending.popleft().result())
+        self.pending.append(self.pool.submit(compress_block, block, self.dictionary, self.level, last))
+        self.dictionary = block[-DICTIONARY_SIZE:]
+
+    def close(self):
+        if self.closed:
+            return
+        try:
+            self.submit(bytes(self.buffer), last=True)
+            while self.pending:
+                self.fileobj.write(self.pending.popleft().result())
+            self.fileobj.write(struct.pack("<II", self.crc, self.size & 0xFFFFFFFF))
+        finally:
+            self.pool.shutdown(cancel_futures=True)
+            self.fileobj.close()
+            super().close()
+
+
+class PigzWriter(io.RawIOBase):
+    """Write a gzip file by piping the data through an external pigz process."""
+
+    def __init__(self, path, level=DEFAULT_LEVEL, threads=None, pigz="pigz"):
+        self.path = os.fspath(path)
+        self.size = 0
+        with open(self.path, "wb") as f:
+            cmd = [pigz, f"-{level}", "-c"] + ([] if threads is None else ["-p", str(threads)])
+            self.process = subprocess.Popen(cmd, stdin=subprocess.PIPE, stdout=f)
+        assert self.process.stdin is not None
+        self.stdin = self.process.stdin
+
+    def writable(self):
+        return True
+
+    def tell(self):
+        """Number of uncompressed bytes written so far."""
+        return self.size
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence != io.SEEK_SET or offset != self.size:
+            raise io.UnsupportedOperation("PigzWriter can only be written sequentially.")
+        return self.size
+
+    def write(self, data):
+        data = memoryview(data).cast("B")
+        try:
+            self.stdin.write(data)
+        except BrokenPipeError:
+            # pigz exited early, so report its exit code instead
+            self.check()
+            raise
+        self.size += len(data)
+        return len(data)
+
+    def check(self):
+        """Wait for pigz to exit, raising if it failed."""
+        if self.process.wait() != 0:
+            raise RuntimeError(f"pigz failed with exit code {self.process.returncode} writing {self.path}.")
+
+    def close(self):
+        if self.closed:
+            return
+        try:
+            try:
+                self.stdin.close()
+            except BrokenPipeError:
+                pass
+            self.check()
+        finally:
+            super().close()
+
+
+def open_output(path, level=DEFAULT_LEVEL, threads=None):
+    """Open an output image file for writing, compressing it in parallel if it ends in .gz.
+
+    An external pigz is used when it is on the PATH, otherwise the blocks are compressed on a thread
+    pool. With a single thread, plain single-threaded gzip is used.
+    """
+    path = os.fspath(path)
+    if not path.endswith(".gz"):
+        return open(path, "wb")
+    threads = threads or default_threads()
+    if threads == 1:
+        import gzip
+
+        return gzip.GzipFile(path, "wb", compresslevel=level, mtime=0)
+    pigz = shutil.which("pigz")
+    if pigz is not None:
+        return PigzWriter(path, level, threads, pigz)
+    return ParallelGzipWriter(path, level, threads)
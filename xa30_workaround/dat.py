@@ -1,31 +1,318 @@
-import numpy as np
-
-
-def dat_to_array(dat_files, shape):
-    # frame_list
-    frame_list = []
-    for dat_path in sorted(dat_files):
-        # read binary file
-        with open(dat_path, "rb") as f:
-            binary_data = f.read()
-
-        # convert to numpy array
-        data = np.frombuffer(binary_data, dtype=np.uint16)
-        if len(data) == 0:
-            raise RuntimeError(f"Dat File: {dat_path} contains no data! Has this file been corrupted?")
-        data = data.reshape(*shape)
-        num_slices = data.shape[1]
-
-        # TODO: this should be determined from the slice timing but for now we will assume
-        # interleaved slices
-        indices = np.argsort(np.concatenate((np.arange(1, num_slices, 2), np.arange(0, num_slices, 2))))
-
-        # reindex slices
-        data = data[:, indices, :, :]
-        # TODO: we should probably do multiple orientation checks to make sure this is correct
-        data = np.flip(np.moveaxis(data, [0, 1, 2, 3], [3, 2, 1, 0]), 1)
-
-        # append to frame list
-        frame_list.append(data)
-    data = np.stack(frame_list, axis=-1)
-    return data
+import os
+import re
+from collections import defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+from xa30_workaround.lazy import lazy_import
+
+np = lazy_import("numpy")
+
+# runs of dot-separated numbers, like the Series Instance UIDs in .dat filenames
+UID_PATTERN = re.compile(r"\d+(?:\.\d+)+")
+
+
+def interleaved_indices(num_slices):
+    """Indices that reorder interleaved slices into sequential order."""
+    return np.argsort(np.concatenate((np.arange(1, num_slices, 2), np.arange(0, num_slices, 2))))
+
+
+def read_dat(dat_path, shape, mmap=False):
+    """Read a single .dat file as an (echo, slice, row, col) array.
+
+    With ``mmap=True`` the file is memory-mapped instead of read into a buffer.
+    """
+    if mmap:
+        # np.memmap refuses to map an empty file, so check the size first
+        if os.path.getsize(dat_path) == 0:
+            data = np.zeros(0, dtype=np.uint16)
+        else:
+            data = np.memmap(dat_path, dtype=np.uint16, mode="r")
+    else:
+        data = np.fromfile(dat_path, dtype=np.uint16)
+    if len(data) == 0:
+        raise RuntimeError(f"Dat File: {dat_path} contains no data! Has this file been corrupted?")
+    return data.reshape(*shape)
+
+
+def check_dat_sizes(dat_files, shape):
+    """Check the size of every .dat file against an (echo, slice, row, col) shape without reading them.
+
+    Returns a description of each problem found, so that every bad file can be reported at once.
+    """
+    expected = int(np.prod(shape)) * np.dtype(np.uint16).itemsize
+    problems = []
+    for dat_path in dat_files:
+        try:
+            size = os.path.getsize(dat_path)
+        except OSError as error:
+            problems.append(f"{dat_path} could not be read: {error.strerror}.")
+            continue
+        if size == 0:
+            problems.append(f"{dat_path} contains no data.")
+        elif size < expected:
+            problems.append(f"{dat_path} is truncated: {size} bytes, expected {expected}.")
+        elif size > expected:
+            problems.append(f"{dat_path} is too large: {size} bytes, expected {expected}.")
+    return problems
+
+
+def read_dat_echo(dat_path, shape, echo):
+    """Memory-map a single echo of a .dat file as a (slice, row, col) array, reading nothing else."""
+    echo_shape = tuple(shape[1:])
+    if os.path.getsize(dat_path) == 0:
+        raise RuntimeError(f"Dat File: {dat_path} contains no data! Has this file been corrupted?")
+    offset = echo * int(np.prod(echo_shape)) * np.dtype(np.uint16).itemsize
+    return np.memmap(dat_path, dtype=np.uint16, mode="r", offset=offset, shape=echo_shape)
+
+
+def slice_order(num_slices, slice_timing=None, slice_mode=None, multiband_factor=1):
+    """The spatial slice acquired at each position of a .dat file, i.e. the output slot of each raw slice.
+
+    The order comes from ``slice_timing`` (one time per slice, in spatial order) if given, with
+    simultaneous multiband slices taken in spatial order. Otherwise it is built from the protocol's
+    ``slice_mode`` ("ascending", "descending" or "interleaved") repeated over each multiband
+    package, defaulting to interleaved slices.
+    """
+    if slice_timing is not None:
+        slice_timing = np.asarray(slice_timing, dtype=float)
+        if slice_timing.shape != (num_slices,):
+            raise ValueError(f"Expected slice timing for {num_slices} slices but got {slice_timing.shape[0]}.")
+        return np.argsort(slice_timing, kind="stable")
+
+    if multiband_factor is None or multiband_factor < 1 or num_slices % multiband_factor:
+        multiband_factor = 1
+    package = num_slices // multiband_factor
+    if slice_mode == "ascending":
+        order = np.arange(package)
+    elif slice_mode == "descending":
+        order = np.arange(package)[::-1]
+    else:
+        order = np.argsort(interleaved_indices(package))
+    # the slices of each multiband package are acquired together, one package apart
+    return (order[:, np.newaxis] + package * np.arange(multiband_factor)).ravel()
+
+
+def slice_slots(order):
+    """Index that writes raw slices to their output slots, as a basic slice when the order is a regular step."""
+    order = np.asarray(order)
+    if len(order) > 1:
+        step = order[1] - order[0]
+        if step != 0 and np.array_equal(order, order[0] + step * np.arange(len(order))):
+            stop = order[-1] + step
+            return slice(order[0], None if stop < 0 else stop, step)
+    return order
+
+
+def empty_echoes(shape):
+    """Allocate an (x, y, z, echo, ...) uint16 array in which each echo is one Fortran-contiguous block.
+
+    This matches the on-disk order of NIfTI, so each echo can be written out without a copy.
+    """
+    shape = tuple(shape)
+    # allocate with the echo as the slowest axis, then move it back into place
+    return np.moveaxis(np.empty(shape[:3] + shape[4:] + shape[3:4], dtype=np.uint16, order="F"), -1, 3)
+
+
+def frame_view(frame):
+    """Return an (echo, slice, row, col) view onto an (x, y, z, echo) output frame.
+
+    Writing raw .dat data into this view lands it in the output orientation.
+    """
+    return np.moveaxis(np.flip(frame, 1), [3, 2, 1, 0], [0, 1, 2, 3])
+
+
+def decode_frame(dat_path, shape, frame, slots, mmap=False):
+    """Decode a .dat file into an (x, y, z, echo) frame, writing each raw slice to its output slot."""
+    frame_view(frame)[:, slots] = read_dat(dat_path, shape, mmap)
+    return frame
+
+
+def dat_to_array(dat_files, shape, out=None, mmap=False, workers=1, order=None, flip_axes=()):
+    """Assemble .dat files into an (x, y, z, echo, frame) array.
+
+    The output is allocated once, with each echo contiguous in NIfTI (Fortran) order, and each frame is
+    written straight into its slot. Pass ``out`` to
+    supply a preallocated array (e.g. an ``np.memmap``), ``mmap=True`` to memory-map the input
+    files rather than reading them into a buffer, and ``workers`` to decode frames on a thread pool.
+    ``order`` is the acquisition order of the slices from ``slice_order``, interleaved by default.
+    ``flip_axes`` are the spatial axes to flip (see ``find_orientation``), which are decoded straight
+    into the flipped layout, so the echoes stay contiguous. Frames are always ordered by sorted filename.
+    """
+    dat_files = sorted(dat_files)
+    num_echoes, num_slices, num_rows, num_cols = shape
+    if out is None:
+        out = empty_echoes((num_cols, num_rows, num_slices, num_echoes, len(dat_files)))
+    # the slice permutation is worked out once for the whole series
+    slots = slice_slots(slice_order(num_slices) if order is None else order)
+    flipped = np.flip(out, flip_axes) if flip_axes else out
+
+    def decode(i):
+        return decode_frame(dat_files[i], shape, flipped[..., i], slots, mmap)
+
+    if workers > 1:
+        # numpy releases the GIL while reading and copying, and every frame has its own slot
+        with ThreadPoolExecutor(workers) as pool:
+            # consume the results so that any errors are raised
+            for _ in pool.map(decode, range(len(dat_files))):
+                pass
+    else:
+        for i in range(len(dat_files)):
+            decode(i)
+    return out
+
+
+def iter_dat_frames(dat_files, shape, mmap=False, workers=1, order=None):
+    """Yield each .dat file, in sorted order, as an (x, y, z, echo) frame.
+
+    Each yielded frame is only valid until the next one. With ``workers`` > 1, up to ``workers``
+    frames ahead are decoded on a thread pool while the current one is being consumed. ``order`` is
+    the acquisition order of the slices, as in ``dat_to_array``.
+    """
+    num_echoes, num_slices, num_rows, num_cols = shape
+    frame_shape = (num_cols, num_rows, num_slices, num_echoes)
+    slots = slice_slots(slice_order(num_slices) if order is None else order)
+    dat_files = sorted(dat_files)
+
+    if workers <= 1:
+        frame = empty_echoes(frame_shape)
+        for dat_path in dat_files:
+            yield decode_frame(dat_path, shape, frame, slots, mmap)
+        return
+
+    # keep a bounded window of frames in flight, each with its own buffer from a small pool
+    buffers = [empty_echoes(frame_shape) for _ in range(workers + 1)]
+    with ThreadPoolExecutor(workers) as pool:
+        pending = deque()
+        try:
+            for i, dat_path in enumerate(dat_files):
+                if len(pending) == workers:
+                    yield pending.popleft().result()
+                pending.append(pool.submit(decode_frame, dat_path, shape, buffers[i % len(buffers)], slots, mmap))
+            while pending:
+                yield pending.popleft().result()
+        finally:
+            for future in pending:
+                future.cancel()
+
+
+def expand_index(key, ndim):
+    """Expand an index into one entry per dimension, replacing any Ellipsis with full slices."""
+    if not isinstance(key, tuple):
+        key = (key,)
+    if any(k is None for k in key):
+        raise IndexError("np.newaxis is not supported")
+    ellipses = [i for i, k in enumerate(key) if k is Ellipsis]
+    if len(ellipses) > 1:
+        raise IndexError("an index can only have a single ellipsis ('...')")
+    missing = ndim - len(key) + len(ellipses)
+    if missing < 0:
+        raise IndexError(f"too many indices: array is {ndim}-dimensional, but {len(key) - len(ellipses)} were indexed")
+    if ellipses:
+        return key[: ellipses[0]] + (slice(None),) * missing + key[ellipses[0] + 1 :]
+    return key + (slice(None),) * missing
+
+
+def local_index(key, selected):
+    """Index into the entries selected by key, once they have been gathered into an array of their own."""
+    if np.ndim(selected) == 0:
+        return 0
+    if isinstance(key, slice):
+        return slice(None)
+    return np.arange(len(selected))
+
+
+class DatSeries:
+    """Lazy (x, y, z, echo, frame) view of a series of .dat files, like nibabel's ArrayProxy.
+
+    ``shape`` is the (echo, slice, row, col) shape of each .dat file, ``order`` the acquisition order
+    of the slices (see ``slice_order``) and ``flip_axes`` the spatial axes to flip to match the nifti
+    (see ``find_orientation``). Indexing, e.g. ``series[..., 0, 2:5]``, only reads the requested
+    frames, and memory-maps just the requested echoes of each frame. ``np.asarray(series)`` reads
+    the whole series.
+    """
+
+    ndim = 5
+    is_proxy = True
+
+    def __init__(self, dat_files, shape, order=None, flip_axes=()):
+        self.dat_files = sorted(dat_files)
+        self.raw_shape = tuple(shape)
+        num_echoes, num_slices, num_rows, num_cols = self.raw_shape
+        self.order = slice_order(num_slices) if order is None else np.asarray(order)
+        self.slots = slice_slots(self.order)
+        self.flip_axes = tuple(flip_axes)
+        self.shape = (num_cols, num_rows, num_slices, num_echoes, len(self.dat_files))
+
+    @property
+    def dtype(self):
+        # a property, so that numpy isn't loaded when this module is imported
+        return np.dtype(np.uint16)
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __array__(self, dtype=None, copy=None):
+        data = self[...]
+        return data if dtype is None else data.astype(dtype)
+
+    def __getitem__(self, key):
+        *spatial, echo_key, frame_key = expand_index(key, self.ndim)
+        num_cols, num_rows, num_slices, num_echoes, num_frames = self.shape
+        echoes = np.arange(num_echoes)[echo_key]
+        frames = np.arange(num_frames)[frame_key]
+
+        out = empty_echoes((num_cols, num_rows, num_slices, np.size(echoes), np.size(frames)))
+        all_echoes = np.array_equal(np.atleast_1d(echoes), np.arange(num_echoes))
+        for i, frame in enumerate(np.atleast_1d(frames)):
+            if all_echoes:
+                # the whole file is needed, so read it in one go
+                decode_frame(self.dat_files[frame], self.raw_shape, out[..., i], self.slots)
+                continue
+            view = frame_view(out[..., i])
+            for j, echo in enumerate(np.atleast_1d(echoes)):
+                view[j, self.slots] = read_dat_echo(self.dat_files[frame], self.raw_shape, echo)
+
+        if self.flip_axes:
+            out = np.flip(out, self.flip_axes)
+        # index the echoes and frames read by their position in out, keeping numpy's indexing rules
+        return out[tuple(spatial) + (local_index(echo_key, echoes), local_index(frame_key, frames))]
+
+
+class DatIndex:
+    """Index of the .dat files in a directory by the Series Instance UIDs in their filenames.
+
+    The directory is listed once and each filename is parsed once, so looking up the files of a
+    series doesn't list the directory again. This matters for large shared directories on network
+    mounts.
+    """
+
+    def __init__(self, directory):
+        self.directory = Path(directory)
+        # every .dat file in the directory
+        self.files = []
+        # map of Series Instance UID to .dat files, skipping hidden files
+        self.series = defaultdict(list)
+        with os.scandir(self.directory) as entries:
+            for entry in entries:
+                if not entry.name.endswith(".dat") or not entry.is_file():
+                    continue
+                path = self.directory / entry.name
+                self.files.append(path)
+                if entry.name.startswith("."):
+                    continue
+                for uid in set(UID_PATTERN.findall(entry.name[:-4])):
+                    self.series[uid].append(path)
+                    # the .dat files may carry the full UID, while lookups drop its .0.0.0 suffix
+                    if uid.endswith(".0.0.0"):
+                        self.series[uid[:-6]].append(path)
+        self.files.sort()
+        for paths in self.series.values():
+            paths.sort()
+
+    def find(self, series_uid):
+        """Return the sorted .dat files whose filename contains the Series Instance UID."""
+        if series_uid in self.series:
+            return list(self.series[series_uid])
+        # the UID may run into other digits in the filename, so fall back to a substring match
+        return sorted({path for uid, paths in self.series.items() if series_uid in uid for path in paths})
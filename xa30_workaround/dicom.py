@@ -1,17 +1,64 @@
+import os
+import re
 import sys
+import json
+import queue
+import threading
 import subprocess
+from functools import lru_cache
 from pathlib import Path
 
-# test if dcm2niix is installed
-try:
-    subprocess.run(["dcm2niix", "-h"], stdout=subprocess.DEVNULL, check=True)
-except subprocess.CalledProcessError:
-    print("dcm2niix not installed. Please install dcm2niix and try again.")
-    sys.exit(1)
+from xa30_workaround.lazy import lazy_import
+from xa30_workaround.manifest import MANIFEST_NAME, OUTPUT_SUFFIXES
 
+pydicom = lazy_import("pydicom")
 
-def execute(cmd):
+# the DICOM tags identifying a series: Series Instance UID, Series Number, Series Description, Protocol Name,
+# Acquisition Time and, in enhanced DICOM, Acquisition DateTime
+SERIES_TAGS = [
+    (0x0020, 0x000E),
+    (0x0020, 0x0011),
+    (0x0008, 0x103E),
+    (0x0018, 0x1030),
+    (0x0008, 0x0032),
+    (0x0008, 0x002A),
+]
+
+# acquisition times closer than this, in seconds, are the same
+TIME_TOLERANCE = 1e-3
+
+
+@lru_cache(maxsize=None)
+def dcm2niix_help():
+    """Return the help text of dcm2niix, exiting if dcm2niix is not installed.
+
+    dcm2niix is only run the first time this is called, so it isn't probed until it is needed.
+    """
+    try:
+        result = subprocess.run(
+            ["dcm2niix", "-h"], stdout=subprocess.PIPE, stderr=subprocess.STDOUT, universal_newlines=True, check=True
+        )
+    except (OSError, subprocess.CalledProcessError):
+        print("dcm2niix not installed. Please install dcm2niix and try again.")
+        sys.exit(1)
+    return result.stdout
+
+
+def dcm2niix_version():
+    """The version of dcm2niix, as reported in its help text, or None if it isn't reported."""
+    match = re.search(r"version (\S+)", dcm2niix_help())
+    return None if match is None else match.group(1)
+
+
+def execute(cmd, started=None):
+    """Run a command, yielding each line of its stdout, and raise CalledProcessError if it fails.
+
+    started, if given, is called with the Popen as soon as the command has started, so that the
+    caller can stop it.
+    """
     popen = subprocess.Popen(cmd, stdout=subprocess.PIPE, universal_newlines=True)
+    if started is not None:
+        started(popen)
     assert popen.stdout is not None
     for stdout_line in iter(popen.stdout.readline, ""):
         yield stdout_line
@@ -21,27 +68,251 @@ def execute(cmd):
         raise subprocess.CalledProcessError(return_code, cmd)
 
 
-def dicom2nifti(*args):
-    dcm2niix_cmd = ["dcm2niix", *args]
+def parse_dcm2niix_output(lines):
+    """Parse dcm2niix output, yielding a (nifti, dicom) pair for each converted series.
+
+    Every line is passed through to stdout as it is. Only the "Convert N DICOM as" line that
+    dcm2niix prints for each series at any verbosity is parsed; the DICOM of a series is taken from
+    the "Converting" line before it if dcm2niix was run with -v, and is None otherwise. dcm2niix
+    reports a series before it writes it, so each pair is only yielded once dcm2niix has moved on
+    to the next series or finished.
+    """
     dicom_path = None
-    dicoms_nii_map = {}
-    i = 0
-    for line in execute(dcm2niix_cmd):
-        # skip non-essential verbose lines
-        if "Patient Position" in line:
-            continue
-        if "patient position" in line or "orient" in line or "acq" in line:
-            continue
-        if "DICOM file: " in line:
-            continue
+    pending = None
+    for line in lines:
         print(line, end="")
-        if "Converting " in line:
-            # add dicom path
-            dicom_path = Path(line.split("Converting ")[1].strip())
-        if line.startswith("Convert ") and "DICOM as " in line:
+        if not line.startswith("Convert"):
+            continue
+        if line.startswith("Converting "):
+            # the previous series has been written
+            if pending is not None:
+                yield pending
+                pending = None
+            dicom_path = Path(line[len("Converting ") :].strip())
+        elif " DICOM as " in line:
+            if pending is not None:
+                yield pending
             # get the nifti name
             nifti_name = line.split(" DICOM as ")[1].split(" (")[0]
-            dicoms_nii_map[nifti_name] = dicom_path
-            # increment the image index
-            i += 1
-    return dicoms_nii_map
+            pending = (nifti_name, dicom_path)
+            dicom_path = None
+    if pending is not None:
+        yield pending
+
+
+def iter_series_headers(directory):
+    """Yield the path and series tags of each DICOM file under a directory, in a stable order.
+
+    Files that can't be DICOM files (.dat files, dcm2niix outputs and the manifest) are skipped
+    without being opened, as are files that pydicom can't read.
+    """
+    for root, dirs, names in os.walk(directory):
+        dirs.sort()
+        for name in sorted(names):
+            if name.endswith((".dat", *OUTPUT_SUFFIXES)) or name == MANIFEST_NAME:
+                continue
+            path = os.path.join(root, name)
+            try:
+                header = pydicom.dcmread(path, stop_before_pixels=True, specific_tags=SERIES_TAGS)
+            except (pydicom.errors.InvalidDicomError, OSError):
+                continue
+            if (0x0020, 0x000E) in header:
+                yield Path(path), header
+
+
+def parse_time(value):
+    """Seconds since midnight of a DICOM (HHMMSS.FFFFFF) or BIDS (HH:MM:SS.FFFFFF) time, or None if it isn't one."""
+    match = re.fullmatch(r"(\d\d):?(\d\d):?(\d\d(?:\.\d*)?)", str(value).strip())
+    if match is None:
+        return None
+    hours, minutes, seconds = match.groups()
+    return int(hours) * 3600 + int(minutes) * 60 + float(seconds)
+
+
+def parse_datetime(value):
+    """Seconds since midnight of the time in a DICOM datetime (YYYYMMDDHHMMSS.FFFFFF&ZZXX), or None if it has none."""
+    match = re.fullmatch(r"\d{8}(\d{6}(?:\.\d*)?)(?:[+-]\d{4})?", str(value).strip())
+    return None if match is None else parse_time(match.group(1))
+
+
+def header_value(header, tag):
+    """The value of a tag in a DICOM header, or None if it is missing or empty."""
+    element = header.get(tag)
+    return None if element is None or element.value in (None, "") else element.value
+
+
+class SeriesIndex:
+    """Index the series of the DICOM files under a directory, keeping one DICOM file per series.
+
+    The directory is only walked as far as a lookup needs, so finding the first series dcm2niix
+    converted usually reads just the headers of the files ahead of it.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        self._headers = iter_series_headers(directory)
+        self._done = False
+        # Series Instance UID: the DICOM file, Series Number, Series Description, Protocol Name and
+        # the acquisition times of the files read so far
+        self._series = {}
+
+    def _read(self, until=None):
+        """Read headers until until(uid) holds for the series of the last header read, or to the end."""
+        while not self._done:
+            header = next(self._headers, None)
+            if header is None:
+                self._done = True
+                return
+            path, header = header
+            uid = str(header[0x0020, 0x000E].value)
+            if uid not in self._series:
+                number = header_value(header, (0x0020, 0x0011))
+                self._series[uid] = {
+                    "path": path,
+                    "number": None if number is None else int(number),
+                    "description": header_value(header, (0x0008, 0x103E)),
+                    "protocol": header_value(header, (0x0018, 0x1030)),
+                    "times": [],
+                }
+            for tag, parse in [((0x0008, 0x0032), parse_time), ((0x0008, 0x002A), parse_datetime)]:
+                value = header_value(header, tag)
+                seconds = None if value is None else parse(value)
+                if seconds is not None:
+                    self._series[uid]["times"].append(seconds)
+            if until is not None and until(uid):
+                return
+
+    def series(self):
+        """Map the Series Instance UID of every series to one of its DICOM files."""
+        self._read()
+        return {uid: info["path"] for uid, info in self._series.items()}
+
+    def find(self, uid=None, number=None, description=None, protocol=None, acquisition_time=None):
+        """Return a DICOM file of a series, or None if the series can't be told apart from the others.
+
+        A series is found by its Series Instance UID if given. Otherwise, as in anonymized sidecars,
+        it is matched on the Series Number, Series Description, Protocol Name and acquisition time
+        that are given. With an acquisition time, the first matching series is taken, reading no
+        further than needed. Without one, or if no header of the series carries an acquisition time
+        or datetime to match it on, the match must be unique, so every header is read.
+        """
+        if uid is not None:
+            if uid not in self._series:
+                self._read(until=lambda read: read == uid)
+            if uid in self._series:
+                return self._series[uid]["path"]
+        if number is None and acquisition_time is None:
+            return None
+        seconds = None if acquisition_time is None else parse_time(acquisition_time)
+
+        def matches(info, timed=True):
+            if number is not None and info["number"] != int(number):
+                return False
+            for field, value in [("description", description), ("protocol", protocol)]:
+                if value is not None and info[field] is not None and info[field] != value:
+                    return False
+            if not timed or seconds is None:
+                return True
+            return any(abs(time - seconds) < TIME_TOLERANCE for time in info["times"])
+
+        if seconds is None:
+            # a match is only unique once every series has been seen
+            self._read()
+        else:
+            found = [info for info in self._series.values() if matches(info)]
+            if not found:
+                self._read(until=lambda read: matches(self._series[read]))
+        found = [info for info in self._series.values() if matches(info)]
+        unique = seconds is None
+        if not found and seconds is not None and number is not None:
+            # every header has been read by now, so fall back to a unique match if none of them carries a time
+            found = [info for info in self._series.values() if matches(info, timed=False)]
+            if any(info["times"] for info in found):
+                return None
+            unique = True
+        if unique and len(found) > 1:
+            return None
+        return found[0]["path"] if found else None
+
+
+def find_series_dicom(nifti, index):
+    """Find a DICOM file of the series that a dcm2niix output was converted from, or None if it can't be found.
+
+    The series is looked up in the index by the identifiers dcm2niix writes to the BIDS sidecar of
+    the output, printing why if it isn't found.
+    """
+    sidecar = Path(f"{nifti}.json")
+    try:
+        with open(sidecar) as f:
+            metadata = json.load(f)
+    except (OSError, ValueError):
+        print(f"Could not read the sidecar {sidecar} to find the DICOM files of {nifti}, skipping it.")
+        return None
+    dicom = index.find(
+        metadata.get("SeriesInstanceUID"),
+        metadata.get("SeriesNumber"),
+        metadata.get("SeriesDescription"),
+        metadata.get("ProtocolName"),
+        metadata.get("AcquisitionTime"),
+    )
+    if dicom is None:
+        print(
+            f"Could not tell which DICOM files under {index.directory} {nifti} was converted from, skipping it."
+            " Run with -v to have dcm2niix report them."
+        )
+    return dicom
+
+
+def iter_dicom2nifti(*args):
+    """Run dcm2niix, yielding each (nifti, dicom) pair as soon as that series has been written.
+
+    The output of dcm2niix is read on a background thread, so dcm2niix keeps converting the
+    remaining series while the caller works on the ones already yielded. Unless dcm2niix reported
+    the DICOM files it converted, the DICOM of each series is found from its sidecar in an index of
+    the input directory, the last argument, and series that can't be found are skipped. Exits if
+    dcm2niix is not installed.
+
+    If the caller stops early or raises, dcm2niix is terminated and the background thread joined.
+    """
+    dcm2niix_help()
+    dcm2niix_cmd = ["dcm2niix", *args]
+    pairs = queue.Queue()
+    processes = []
+
+    def read_output():
+        try:
+            for pair in parse_dcm2niix_output(execute(dcm2niix_cmd, started=processes.append)):
+                pairs.put(pair)
+        except Exception as error:
+            pairs.put(error)
+        pairs.put(None)
+
+    reader = threading.Thread(target=read_output, daemon=True)
+    reader.start()
+    try:
+        index = None
+        while True:
+            pair = pairs.get()
+            if pair is None:
+                return
+            if isinstance(pair, Exception):
+                raise pair
+            nifti, dicom = pair
+            if dicom is None:
+                if index is None:
+                    index = SeriesIndex(args[-1])
+                dicom = find_series_dicom(nifti, index)
+                if dicom is None:
+                    continue
+            yield nifti, dicom
+    finally:
+        for process in processes:
+            if process.poll() is None:
+                process.terminate()
+            process.wait()
+        reader.join()
+
+
+def dicom2nifti(*args):
+    """Run dcm2niix, returning a map of each nifti output to the DICOM file it was converted from."""
+    return dict(iter_dicom2nifti(*args))
@@ -0,0 +1,23 @@
+import importlib.util
+import sys
+
+
+def lazy_import(name):
+    """Import a module the first time one of its attributes is used, unless it is already imported.
+
+    This keeps heavy dependencies like numpy and nibabel out of the startup of the command line
+    tools, e.g. for ``dcmdat2niix -h``, and out of modules that only need them in some functions.
+    """
+    if name in sys.modules:
+        return sys.modules[name]
+    spec = importlib.util.find_spec(name)
+    if spec is None:
+        raise ModuleNotFoundError(f"No module named {name!r}", name=name)
+    if spec.loader is None:
+        raise ImportError(f"Cannot import {name!r} lazily, it has no loader.", name=name)
+    loader = importlib.util.LazyLoader(spec.loader)
+    spec.loader = loader
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    loader.exec_module(module)
+    return module
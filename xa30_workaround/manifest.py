@@ -0,0 +1,172 @@
+import hashlib
+import json
+import os
+import sqlite3
+import time
+from contextlib import contextmanager
+from pathlib import Path
+
+MANIFEST_NAME = ".dcmdat2niix_manifest.sqlite"
+
+# files written by dcm2niix and dcmdat2niix, which are not inputs
+OUTPUT_SUFFIXES = (".nii", ".nii.gz", ".json", ".bval", ".bvec")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS series (
+    nifti TEXT PRIMARY KEY,
+    inputs TEXT NOT NULL,
+    outputs TEXT NOT NULL,
+    converted REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS runs (
+    arguments TEXT PRIMARY KEY,
+    inputs TEXT NOT NULL,
+    series TEXT NOT NULL,
+    converted REAL NOT NULL
+);
+"""
+
+
+def file_fingerprint(path):
+    """Identify a file by its resolved path, size and modification time."""
+    stat = os.stat(path)
+    return [str(Path(path).resolve()), stat.st_size, stat.st_mtime_ns]
+
+
+def series_fingerprint(dicom, dat_files, options=None):
+    """Fingerprint the inputs of a series: its exemplar DICOM file, its .dat files and the conversion options."""
+    # generated at build time, so imported on first use to let a source checkout import this module
+    from xa30_workaround._version import __version__
+
+    return {
+        "version": __version__,
+        "options": options,
+        "dicom": file_fingerprint(dicom),
+        "dat_files": [file_fingerprint(path) for path in sorted(dat_files)],
+    }
+
+
+def directory_fingerprint(directory, dat_dir=None):
+    """Hash the names, sizes and modification times of every input file under a directory.
+
+    A separate ``dat_dir`` may be shared by many sessions, so it isn't walked: only its own
+    modification time is hashed, which changes when files are added to or removed from it. The .dat
+    files a series was converted from are checked with its series fingerprint instead.
+    """
+    from xa30_workaround._version import __version__
+
+    digest = hashlib.sha256(__version__.encode())
+    for root, dirs, files in os.walk(directory):
+        dirs.sort()
+        for name in sorted(files):
+            if name == MANIFEST_NAME or name.endswith(OUTPUT_SUFFIXES):
+                continue
+            path = os.path.join(root, name)
+            stat = os.stat(path)
+            digest.update(f"{os.path.relpath(path, directory)}\0{stat.st_size}\0{stat.st_mtime_ns}\n".encode())
+    if dat_dir is not None:
+        digest.update(f"{Path(dat_dir).resolve()}\0{os.stat(dat_dir).st_mtime_ns}\n".encode())
+    return digest.hexdigest()
+
+
+def inputs_intact(inputs):
+    """Whether the DICOM and .dat files of a series fingerprint are still unchanged."""
+    for fingerprint in [inputs["dicom"], *inputs["dat_files"]]:
+        try:
+            if file_fingerprint(fingerprint[0]) != fingerprint:
+                return False
+        except OSError:
+            return False
+    return True
+
+
+def outputs_intact(outputs):
+    """Whether every output file still exists, unchanged since it was written."""
+    for path, fingerprint in outputs.items():
+        try:
+            if file_fingerprint(path) != fingerprint:
+                return False
+        except OSError:
+            return False
+    return True
+
+
+class Manifest:
+    """Record of the series converted into an output directory, so reruns can skip them.
+
+    Each series is recorded with fingerprints of its inputs and of the files it produced, and is up
+    to date while neither has changed, so an output that dcm2niix overwrote is converted again. A whole run is
+    recorded with its dcm2niix arguments and conversion options, a fingerprint of its input directory and
+    its series, so an unchanged rerun can skip dcm2niix too. The manifest is a SQLite database, so it can be
+    updated by several processes.
+    """
+
+    def __init__(self, directory):
+        self.path = Path(directory) / MANIFEST_NAME
+        with self.connect() as conn:
+            conn.executescript(SCHEMA)
+
+    @contextmanager
+    def connect(self):
+        """Open a connection to the manifest database, committing and closing it when done."""
+        conn = sqlite3.connect(self.path, timeout=60)
+        try:
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    def clear(self):
+        """Forget every recorded series and run."""
+        with self.connect() as conn:
+            conn.execute("DELETE FROM series")
+            conn.execute("DELETE FROM runs")
+
+    def series_outputs(self, nifti, inputs=None):
+        """Return the recorded outputs of a series if it is up to date (with these inputs, if given), else None."""
+        with self.connect() as conn:
+            row = conn.execute("SELECT inputs, outputs FROM series WHERE nifti = ?", (str(nifti),)).fetchone()
+        if row is None or (inputs is not None and json.loads(row[0]) != inputs):
+            return None
+        outputs = json.loads(row[1])
+        return outputs if outputs_intact(outputs) else None
+
+    def record(self, nifti, inputs, outputs):
+        """Record that a series was converted from inputs into the output files."""
+        outputs = {str(path): file_fingerprint(path) for path in outputs}
+        with self.connect() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO series VALUES (?, ?, ?, ?)",
+                (str(nifti), json.dumps(inputs), json.dumps(outputs), time.time()),
+            )
+
+    def series_inputs(self, nifti):
+        """Return the recorded input fingerprint of a series, or None if it hasn't been recorded."""
+        with self.connect() as conn:
+            row = conn.execute("SELECT inputs FROM series WHERE nifti = ?", (str(nifti),)).fetchone()
+        return None if row is None else json.loads(row[0])
+
+    def run_up_to_date(self, arguments, inputs):
+        """Whether a run with these arguments and inputs already converted every series, from inputs still unchanged.
+
+        ``arguments`` are the dcm2niix arguments and the conversion options of the run.
+        """
+        with self.connect() as conn:
+            row = conn.execute(
+                "SELECT inputs, series FROM runs WHERE arguments = ?", (json.dumps(arguments),)
+            ).fetchone()
+        if row is None or row[0] != inputs:
+            return False
+        for nifti in json.loads(row[1]):
+            recorded = self.series_inputs(nifti)
+            if recorded is None or not inputs_intact(recorded) or self.series_outputs(nifti) is None:
+                return False
+        return True
+
+    def record_run(self, arguments, inputs, series):
+        """Record that a run with these arguments and inputs converted the series."""
+        with self.connect() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO runs VALUES (?, ?, ?, ?)",
+                (json.dumps(arguments), inputs, json.dumps([str(nifti) for nifti in series]), time.time()),
+            )
@@ -0,0 +1,154 @@
+import os
+
+from xa30_workaround.compress import DEFAULT_LEVEL, open_output
+from xa30_workaround.lazy import lazy_import
+
+indexed_gzip = lazy_import("indexed_gzip")
+nib = lazy_import("nibabel")
+np = lazy_import("numpy")
+
+# on-disk dtype of each output dtype policy, None for the dtype of the dcm2niix header (see header_dtype)
+OUTPUT_DTYPES = {"header": None, "native": "uint16", "int16": "int16", "float32": "float32"}
+
+
+def header_dtype(header):
+    """Pick the on-disk dtype of uint16 .dat data saved with a dcm2niix header, so it matches the first echo.
+
+    The header's dtype is kept when uint16 casts to it safely, or when it is int16, which the data is
+    shifted into range of if needed (see ``cast_output``). Otherwise uint16 is used.
+    """
+    dtype = header.get_data_dtype()
+    if np.can_cast(np.uint16, dtype) or (dtype.kind == "i" and dtype.itemsize == 2):
+        return dtype
+    return np.dtype(np.uint16).newbyteorder(dtype.byteorder)
+
+
+def cast_output(data, out_dtype="header", header=None):
+    """Cast uint16 .dat data to the dtype of an output policy, returning it with the (slope, inter) to store.
+
+    ``header`` keeps the dtype of the dcm2niix ``header`` (see ``header_dtype``), ``native`` keeps the
+    data as it is and ``float32`` converts it once. int16 reinterprets the data in place, so ``data``
+    itself is modified: values that fit are unchanged, otherwise every value is shifted down by 32768
+    and the shift is stored as the intercept, which round-trips exactly.
+    """
+    if out_dtype not in OUTPUT_DTYPES:
+        raise ValueError(f"Unknown output dtype {out_dtype}.")
+    dtype = np.dtype(header_dtype(header) if out_dtype == "header" else OUTPUT_DTYPES[out_dtype]).newbyteorder("=")
+    if dtype == data.dtype:
+        return data, (None, None)
+    if dtype != np.int16:
+        return data.astype(dtype), (None, None)
+    if data.size and data.max() > np.iinfo(np.int16).max:
+        # flipping the top bit subtracts 32768 once the bits are read as int16
+        np.bitwise_xor(data, 0x8000, out=data)
+        return data.view(np.int16), (1.0, 32768.0)
+    return data.view(np.int16), (None, None)
+
+
+def output_image(data, affine, header, slope_inter=(None, None)):
+    """An image that nibabel saves with the dtype of ``data`` and the given scaling, without casting or rescaling."""
+    img = nib.Nifti1Image(data, affine, header)
+    img.header.set_data_dtype(data.dtype)
+    img.header.set_slope_inter(*slope_inter)
+    return img
+
+
+def save_nifti(img, path, gzip_level=DEFAULT_LEVEL, gzip_threads=None):
+    """Save a nifti image, compressing ``.nii.gz`` files with ``gzip_threads`` threads at ``gzip_level``."""
+    with open_output(path, gzip_level, gzip_threads) as fileobj:
+        img.to_file_map({"image": nib.fileholders.FileHolder(os.fspath(path), fileobj)})
+
+
+def open_nifti(path):
+    """Open a NIfTI file for random access, through an index of the gzip stream for ``.nii.gz`` files."""
+    path = os.fspath(path)
+    if path.endswith(".gz"):
+        return indexed_gzip.IndexedGzipFile(path)
+    return open(path, "rb")
+
+
+def read_first_volume(img):
+    """Read the first (x, y, z) volume of a NIfTI image loaded from a file, scaled as nibabel would scale it.
+
+    Only the bytes of that volume are read, so a ``.nii.gz`` file is decompressed up to the end of
+    its first volume rather than in full.
+    """
+    proxy = img.dataobj
+    with open_nifti(img.get_filename()) as fileobj:
+        volume = nib.volumeutils.array_from_file(
+            img.shape[:3], proxy.dtype, fileobj, proxy.offset, order=proxy.order, mmap=False
+        )
+    return nib.volumeutils.apply_read_scaling(volume, proxy.slope, proxy.inter)
+
+
+class NiftiStreamWriter:
+    """Write a NIfTI file incrementally, one volume at a time.
+
+    The header is written up front for the full ``shape``, then each call to ``write`` appends one
+    (x, y, z) volume, so only a single volume ever needs to be held in memory. ``.nii.gz`` files
+    are compressed with ``gzip_threads`` threads at ``gzip_level``. The volumes are stored as
+    ``dtype``, or as picked by ``header_dtype`` if it isn't given. As the values of later volumes
+    aren't known when the header is written, uint16 volumes stored as int16 are always shifted
+    down by 32768, with the shift stored as the intercept (see ``cast_output``).
+    """
+
+    def __init__(self, path, shape, affine, header, gzip_level=DEFAULT_LEVEL, gzip_threads=None, dtype=None):
+        self.path = os.fspath(path)
+        self.shape = tuple(shape)
+        self.num_frames = self.shape[3] if len(self.shape) > 3 else 1
+        self.frames_written = 0
+
+        # build the header for the output file
+        self.header = header.copy()
+        self.header.set_data_shape(self.shape)
+        self.header.set_data_dtype(header_dtype(header) if dtype is None else dtype)
+        self.dtype = self.header.get_data_dtype()
+        self.shift = self.dtype.kind == "i" and self.dtype.itemsize == 2
+        self.header.set_slope_inter(*((1.0, 32768.0) if self.shift else (None, None)))
+        if not np.allclose(self.header.get_best_affine(), affine):
+            self.header.set_sform(affine)
+            self.header.set_qform(affine)
+
+        # write the header and pad up to the data offset
+        self.fileobj = open_output(self.path, gzip_level, gzip_threads)
+        self.header.write_to(self.fileobj)
+        offset = self.header.get_data_offset()
+        position = self.fileobj.tell()
+        if position < offset:
+            self.fileobj.write(b"\x00" * (offset - position))
+
+    def write(self, volume):
+        """Append one (x, y, z) volume to the file."""
+        if self.frames_written >= self.num_frames:
+            raise ValueError(f"{self.path} only holds {self.num_frames} frames.")
+        if volume.shape != self.shape[:3]:
+            raise ValueError(f"Volume of shape {volume.shape} does not match {self.shape[:3]} in {self.path}.")
+        if self.shift:
+            if volume.dtype != np.uint16:
+                raise ValueError(f"Only uint16 volumes can be shifted into {self.dtype} in {self.path}.")
+            # flipping the top bit subtracts 32768 once the bits are read as int16
+            volume = np.bitwise_xor(volume, 0x8000).view(np.int16)
+        elif not np.can_cast(volume.dtype, self.dtype) and self.dtype.kind in "iu":
+            # the cast below would wrap values that don't fit
+            if volume.size and volume.max() > np.iinfo(self.dtype).max:
+                raise ValueError(f"Volume values up to {volume.max()} don't fit in {self.dtype} in {self.path}.")
+        # NIfTI stores data in Fortran order
+        self.fileobj.write(np.asarray(volume, dtype=self.dtype).tobytes(order="F"))
+        self.frames_written += 1
+
+    def close(self):
+        """Close the file, checking that every frame was written."""
+        self.fileobj.close()
+        if self.frames_written != self.num_frames:
+            raise ValueError(f"Only {self.frames_written} of {self.num_frames} frames were written to {self.path}.")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            # don't leave a partial file behind
+            self.fileobj.close()
+            os.remove(self.path)
@@ -0,0 +1,147 @@
+from itertools import product
+
+from xa30_workaround.lazy import lazy_import
+
+np = lazy_import("numpy")
+
+# largest difference between normalized volumes that still counts as a match
+TOLERANCE = 1e-5
+
+
+def normalize(data):
+    """Normalize the data to be between 0 and 1."""
+    return (data - np.min(data)) / (np.max(data) - np.min(data))
+
+
+def normalized_volume(volume):
+    """Copy a volume to float32 and normalize it in place to be between 0 and 1."""
+    # slicing reads image proxies into an array
+    volume = np.array(volume[...], dtype=np.float32)
+    volume -= volume.min()
+    volume /= volume.max()
+    return volume
+
+
+def flip_candidates(dat_norm, nifti_norm):
+    """Order the flips of dat by how well their axis projections match those of the nifti.
+
+    Flipping an axis reverses the projection onto that axis (the mean over the other two) and leaves
+    the other projections alone, so each axis can be decided on its own from a 1D profile. Axes whose
+    profile is symmetric enough that both choices fit equally well are left to the full comparison.
+    """
+    options = []
+    for axis in range(3):
+        others = tuple(a for a in range(3) if a != axis)
+        dat_profile = dat_norm.mean(axis=others)
+        nifti_profile = nifti_norm.mean(axis=others)
+        same = np.sum((dat_profile - nifti_profile) ** 2)
+        flipped = np.sum((dat_profile[::-1] - nifti_profile) ** 2)
+        if np.isclose(same, flipped):
+            options.append((False, True))
+        else:
+            options.append((flipped < same,))
+    return [tuple(axis for axis, flip in enumerate(flips) if flip) for flips in product(*options)]
+
+
+def first_volumes(dat, nifti):
+    """Normalized first echo, first frame of dat and first volume of nifti.
+
+    nifti can be the whole image (or its proxy) or just its first volume.
+    """
+    if len(nifti.shape) > 3:
+        nifti = nifti[..., 0]
+    if len(dat.shape) > 4:
+        return normalized_volume(dat[..., 0, 0]), normalized_volume(nifti)
+    return normalized_volume(dat[..., 0]), normalized_volume(nifti)
+
+
+def volumes_match(dat_norm, nifti_norm, axes, difference=None):
+    """Whether flipping the normalized dat volume by axes makes it match the normalized nifti volume."""
+    if dat_norm.shape != nifti_norm.shape:
+        return False
+    if difference is None:
+        difference = np.empty_like(dat_norm)
+    np.subtract(np.flip(dat_norm, axes), nifti_norm, out=difference)
+    np.abs(difference, out=difference)
+    # NaNs from flat volumes never match
+    return difference.max() <= TOLERANCE
+
+
+def find_orientation(dat, nifti):
+    """Find the axes of dat that need flipping to match the orientation of the nifti file.
+
+    Returns a tuple of axes that can be passed to ``np.flip``. The most likely flip is found from
+    cheap axis projections and confirmed with a single full comparison; the remaining flips are
+    only compared if that fails.
+    """
+
+    # Just try to match the first frame and first echo.
+    dat_norm, nifti_norm = first_volumes(dat, nifti)
+
+    if dat_norm.shape == nifti_norm.shape:
+        # reuse one buffer for the differences of every comparison
+        difference = np.empty_like(dat_norm)
+        candidates = flip_candidates(dat_norm, nifti_norm)
+        others = [axes for axes in [(), (0,), (1,), (2,), (0, 1), (0, 2), (1, 2), (0, 1, 2)] if axes not in candidates]
+        for axes in candidates + others:
+            if volumes_match(dat_norm, nifti_norm, axes, difference):
+                return axes
+
+    # We were unable to make the two frames line up.
+    # Most likely it is not just an orientation issue.
+    # The dat file and the nifti file appear to contain totally different data.
+    raise ValueError("Sanity check failed. The first echo, first frame of the .dat files does not match the nifti.")
+
+
+def geometry_orientation(affine, image_orientation):
+    """Derive the axes of dat that need flipping to match the nifti file from the scan geometry.
+
+    ``image_orientation`` is the DICOM ImageOrientationPatient: the row and column direction cosines
+    in the patient (LPS) frame. The .dat volumes run along the row direction, against the column
+    direction (dat_to_array flips the rows) and along the slice normal, so each axis of the nifti
+    affine is compared against these directions and flipped if it points the opposite way.
+
+    Returns a tuple of axes that can be passed to ``np.flip``, or None if flips alone can't explain
+    the nifti geometry, e.g. if its axes are permuted.
+    """
+    row = np.asarray(image_orientation[:3], dtype=float)
+    column = np.asarray(image_orientation[3:6], dtype=float)
+    dat_directions = np.stack([row, -column, np.cross(row, column)])
+
+    # nifti affines are in RAS, the DICOM directions in LPS
+    nifti_directions = (np.diag([-1.0, -1.0, 1.0]) @ np.asarray(affine)[:3, :3]).T
+    nifti_directions /= np.linalg.norm(nifti_directions, axis=1, keepdims=True)
+
+    # cosine of the angle between each nifti axis (rows) and each dat axis (columns)
+    cosines = nifti_directions @ dat_directions.T
+    if not np.array_equal(np.argmax(np.abs(cosines), axis=1), [0, 1, 2]):
+        return None
+    return tuple(axis for axis in range(3) if cosines[axis, axis] < 0)
+
+
+def resolve_orientation(dat, nifti, geometry_axes, mode="auto"):
+    """Decide which axes of dat to flip, given the flip derived from the scan geometry.
+
+    With ``mode="geometry"`` the geometry is trusted as is. With ``mode="auto"`` it is checked with
+    a single comparison of the first volumes, falling back to searching the image content if they
+    disagree. With ``mode="content"``, or without geometry, the image content is searched.
+    """
+    if geometry_axes is None or mode == "content":
+        if mode == "geometry":
+            raise ValueError("Could not derive the orientation of the .dat files from the scan geometry.")
+        return find_orientation(dat, nifti)
+    if mode == "geometry" or volumes_match(*first_volumes(dat, nifti), geometry_axes):
+        return geometry_axes
+    print("The scan geometry does not match the image content, searching the image content instead.")
+    return find_orientation(dat, nifti)
+
+
+def match_orientation(dat, nifti):
+    """Attempt to match orientation of dat file to that of nifti file.
+
+    The matching flip is returned as a view of dat.
+    """
+    axes = find_orientation(dat, nifti)
+    if not axes:
+        return dat
+    return np.flip(dat, axes)
@@ -0,0 +1,93 @@
+import os
+import threading
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+
+def write_output(path, fn, *args):
+    """Call fn(*args) to write the file at path, removing the partial file if it fails."""
+    try:
+        fn(*args)
+    except BaseException:
+        if os.path.exists(path):
+            os.remove(path)
+        raise
+
+
+class OutputQueue:
+    """Write output files on a thread pool, so the caller can move on while they are written.
+
+    Compression and file I/O release the GIL, so several files are written at once, which also
+    hides the per-file latency of network storage. At most ``max_pending`` writes are queued at a
+    time; submitting another blocks until one finishes. Queued writes hold on to their data, so
+    callers queuing the writes of several series call ``flush`` before queuing the next one, which
+    keeps a single series in the queue. The first error raised by a write is re-raised by the next
+    call to ``submit``, ``flush`` or ``close``, and the file that failed is removed.
+    """
+
+    def __init__(self, max_workers, max_pending=None):
+        self.max_pending = 2 * max_workers if max_pending is None else max_pending
+        self.pool = ThreadPoolExecutor(max_workers)
+        self.pending = set()
+        self.error = None
+
+    def collect(self, return_when=FIRST_COMPLETED):
+        """Wait for pending writes, keeping the first error."""
+        done, self.pending = wait(self.pending, return_when=return_when)
+        for future in done:
+            if future.exception() is not None and self.error is None:
+                self.error = future.exception()
+
+    def submit(self, path, fn, *args):
+        """Queue fn(*args) to write the file at path, blocking while the queue is full."""
+        while self.error is None and len(self.pending) >= self.max_pending:
+            self.collect()
+        if self.error is not None:
+            self.close()
+        self.pending.add(self.pool.submit(write_output, path, fn, *args))
+
+    def flush(self):
+        """Wait for every queued write to finish, raising the first error if there was one."""
+        if self.pending:
+            self.collect(return_when="ALL_COMPLETED")
+        if self.error is not None:
+            self.close()
+
+    def then(self, fn, *args):
+        """Call fn(*args) once every write submitted so far has finished, unless any of them failed."""
+        futures = list(self.pending)
+        remaining = [len(futures)]
+        lock = threading.Lock()
+
+        def finished(_):
+            with lock:
+                remaining[0] -= 1
+                if remaining[0]:
+                    return
+            if self.error is None and not any(f.cancelled() or f.exception() is not None for f in futures):
+                fn(*args)
+
+        if not futures:
+            if self.error is None:
+                fn(*args)
+            return
+        for future in futures:
+            future.add_done_callback(finished)
+
+    def close(self):
+        """Wait for every queued write, then raise the first error if there was one."""
+        if self.pending:
+            self.collect(return_when="ALL_COMPLETED")
+        self.pool.shutdown()
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            # writes that haven't started are dropped, the rest are left to finish
+            self.pool.shutdown(cancel_futures=True)
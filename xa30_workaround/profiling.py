@@ -0,0 +1,143 @@
+import json
+import os
+import sys
+import threading
+import time
+from contextlib import contextmanager, nullcontext
+
+# printed ahead of each structured log line, so the lines can be picked out of the rest of the output
+LOG_PREFIX = "dcmdat2niix-profile"
+
+
+def peak_rss(children=False):
+    """Peak resident set size of this process (or of its largest finished child process) so far, in bytes.
+
+    Returns None where the resource module isn't available, e.g. on Windows.
+    """
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_CHILDREN if children else resource.RUSAGE_SELF).ru_maxrss
+    # bytes on macOS, KiB elsewhere
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+def new_record(stage, series=None):
+    """An empty record of one run of a stage."""
+    return {
+        "series": None if series is None else str(series),
+        "stage": stage,
+        "seconds": 0.0,
+        "bytes_read": 0,
+        "bytes_written": 0,
+    }
+
+
+def profile_stage(profiler, stage, series=None):
+    """Time a stage with profiler, or just yield a record to fill in if profiler is None."""
+    if profiler is None:
+        return nullcontext(new_record(stage, series))
+    return profiler.stage(stage, series)
+
+
+class Profiler:
+    """Per-series, per-stage wall time, bytes read and written, and peak memory of a conversion.
+
+    Each run of a stage is added to the totals of its series and stage, so a stage that runs many
+    times (e.g. once per frame) is reported once. The peak memory of a stage is the peak RSS of the
+    process when the stage ended, so the stage that raised it is the one whose peak first jumps.
+    With ``log`` set, each run of a stage is also printed to stderr as a line of JSON.
+
+    A profiler sent to a worker process starts out empty; ``merge`` adds the worker's stages back in.
+    """
+
+    def __init__(self, log=False):
+        self.log = log
+        self.started = time.time()
+        self.stages = {}
+        self.lock = threading.Lock()
+
+    def __getstate__(self):
+        return {"log": self.log, "started": self.started}
+
+    def __setstate__(self, state):
+        self.__init__(state["log"])
+        self.started = state["started"]
+
+    @contextmanager
+    def stage(self, stage, series=None):
+        """Time the body of a with block as a run of stage, yielding its record to add byte counts to."""
+        record = new_record(stage, series)
+        start = time.perf_counter()
+        try:
+            yield record
+        finally:
+            record["seconds"] = time.perf_counter() - start
+            self.add(record)
+
+    def add(self, record):
+        """Add a run of a stage to the totals of its series and stage."""
+        record = dict(record, calls=record.get("calls", 1), peak_rss_bytes=record.get("peak_rss_bytes", peak_rss()))
+        if self.log:
+            print(f"{LOG_PREFIX} {json.dumps(record)}", file=sys.stderr, flush=True)
+        with self.lock:
+            key = (record["series"], record["stage"])
+            if key not in self.stages:
+                self.stages[key] = record
+                return
+            total = self.stages[key]
+            for field in ["seconds", "bytes_read", "bytes_written", "calls"]:
+                total[field] += record[field]
+            if record["peak_rss_bytes"] is not None:
+                total["peak_rss_bytes"] = max(total["peak_rss_bytes"] or 0, record["peak_rss_bytes"])
+
+    def records(self):
+        """Every stage total, for merging into another profiler."""
+        with self.lock:
+            return [dict(record) for record in self.stages.values()]
+
+    def merge(self, records):
+        """Add the stage totals recorded by another profiler, without logging them again."""
+        log, self.log = self.log, False
+        try:
+            for record in records:
+                self.add(record)
+        finally:
+            self.log = log
+
+    def report(self, argv=None):
+        """Summarize the stages by series and in total."""
+        # generated at build time, so imported on first use to let a source checkout import this module
+        from xa30_workaround._version import __version__
+
+        series = {}
+        totals = {}
+        for record in self.records():
+            name = "" if record["series"] is None else record["series"]
+            series.setdefault(name, {})[record["stage"]] = {
+                key: value for key, value in record.items() if key not in ("series", "stage")
+            }
+            total = totals.setdefault(
+                record["stage"], {"seconds": 0.0, "bytes_read": 0, "bytes_written": 0, "calls": 0, "series": 0}
+            )
+            for field in ["seconds", "bytes_read", "bytes_written", "calls"]:
+                total[field] += record[field]
+            total["series"] += record["series"] is not None
+        return {
+            "version": __version__,
+            "argv": argv,
+            "started": self.started,
+            "seconds": time.time() - self.started,
+            "peak_rss_bytes": peak_rss(),
+            # dcm2niix and any worker processes
+            "peak_rss_children_bytes": peak_rss(children=True),
+            "totals": totals,
+            "series": series,
+        }
+
+    def write_report(self, path, argv=None):
+        """Write the report as JSON."""
+        path = os.fspath(path)
+        with open(path, "w") as f:
+            json.dump(self.report(argv), f, indent=4)
@@ -0,0 +1,138 @@
+import mmap
+import re
+
+from xa30_workaround.lazy import lazy_import
+
+np = lazy_import("numpy")
+
+ASCCONV_BEGIN = b"### ASCCONV BEGIN"
+ASCCONV_END = b"### ASCCONV END ###"
+
+# how far past an alTE entry to look when there is no ASCCONV block around it
+SEARCH_WINDOW = 64 * 1024
+
+# how far into a file to look for the protocol. The Siemens private elements holding it, (0029,1020) in
+# classic and (0021,1019) in enhanced DICOM, sort ahead of the functional groups and the pixel data.
+HEADER_WINDOW = 16 * 1024 * 1024
+
+# values of sSliceArray.ucMode
+SLICE_MODES = {1: "ascending", 2: "descending", 4: "interleaved"}
+
+ASCCONV_LINE = re.compile(r"^\s*([A-Za-z_][\w.\[\]]*)\s*=\s*(.*?)\s*$")
+
+
+def parse_value(value):
+    """Convert an ASCCONV value to an int, float or string."""
+    if value.startswith('"'):
+        # strings are wrapped in one or two pairs of double quotes
+        return value.strip('"')
+    # drop trailing comments
+    value = value.split("#")[0].strip()
+    try:
+        if value.lower().startswith("0x"):
+            return int(value, 16)
+        return int(value)
+    except ValueError:
+        pass
+    try:
+        return float(value)
+    except ValueError:
+        return value
+
+
+def parse_ascconv(text):
+    """Parse the lines of an ASCCONV block into a flat dict of parameter name to value."""
+    parameters = {}
+    for line in text.splitlines():
+        match = ASCCONV_LINE.match(line)
+        if match is not None:
+            parameters[match.group(1)] = parse_value(match.group(2))
+    return parameters
+
+
+def parse_legacy_alte(text):
+    """Parse an alTE line followed by one "= <value>" line per echo, as found in some XA headers."""
+    values = []
+    for line in text.splitlines()[1:9]:
+        if "= \t" not in line:
+            break
+        values.append(parse_value(line.strip().split("= \t")[1]))
+    return values
+
+
+def find_protocol(data):
+    """Find the protocol text in the raw bytes of a DICOM file.
+
+    Returns the decoded text and whether it is ASCCONV, or (None, False) if there is no protocol.
+    Only the first HEADER_WINDOW bytes are searched, so the pixel data of a large file is never read,
+    and only the protocol region is decoded.
+    """
+    header_end = min(len(data), HEADER_WINDOW)
+    start = data.find(ASCCONV_BEGIN, 0, header_end)
+    if start >= 0:
+        end = data.find(ASCCONV_END, start)
+        end = start + SEARCH_WINDOW if end < 0 else end
+        return data[start:end].decode("latin-1"), True
+
+    # no ASCCONV block, so look for the echo times directly
+    index = data.find(b"alTE", 0, header_end)
+    if index < 0:
+        return None, False
+    line_start = data.rfind(b"\n", 0, index) + 1
+    line_end = data.find(b"\n", index)
+    ascconv = b"=" in data[index : line_end if line_end >= 0 else index + SEARCH_WINDOW]
+    return data[line_start : line_start + SEARCH_WINDOW].decode("latin-1"), ascconv
+
+
+def valid_echo_times(alTE):
+    """Convert alTE values in microseconds to echo times in seconds, dropping unused trailing entries."""
+    TEs = np.array(alTE, dtype=float) / 1e6
+    # only grab valid TEs
+    diff = TEs[1:] - TEs[0:-1]
+    return np.insert(TEs[1:][diff > 0], 0, TEs[0])
+
+
+def read_protocol(dicom):
+    """Read the Siemens protocol of a DICOM file.
+
+    Returns a dict with the raw ``alTE`` values (in microseconds), the valid ``echo_times`` (in
+    seconds), the number of slices, slice ordering, multiband factor, matrix and number of
+    repetitions where the protocol has them, and all of the parsed ``ascconv`` parameters. The
+    echo times are None if the protocol has no alTE field.
+    """
+    with open(dicom, "rb") as f:
+        # mmap can't map an empty file
+        if f.seek(0, 2) == 0:
+            text, ascconv = None, False
+        else:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                text, ascconv = find_protocol(data)
+
+    parameters = {}
+    alTE = []
+    if text is not None:
+        if ascconv:
+            parameters = parse_ascconv(text)
+            echoes = sorted(
+                (int(key[5:-1]), value)
+                for key, value in parameters.items()
+                if key.startswith("alTE[") and key.endswith("]")
+            )
+            alTE = [value for _, value in echoes]
+            if "lContrasts" in parameters:
+                alTE = alTE[: parameters["lContrasts"]]
+        else:
+            alTE = parse_legacy_alte(text)
+
+    slice_mode = parameters.get("sSliceArray.ucMode")
+    return {
+        "alTE": alTE,
+        "echo_times": valid_echo_times(alTE) if alTE else None,
+        "num_slices": parameters.get("sSliceArray.lSize"),
+        "slice_mode": None if slice_mode is None else SLICE_MODES.get(slice_mode, slice_mode),
+        "multiband_factor": parameters.get("sSliceAcceleration.lMultiBandFactor", 1),
+        "base_resolution": parameters.get("sKSpace.lBaseResolution"),
+        "phase_encoding_lines": parameters.get("sKSpace.lPhaseEncodingLines"),
+        "num_repetitions": parameters.get("lRepetitions"),
+        "ascconv": parameters,
+    }
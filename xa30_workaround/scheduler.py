@@ -0,0 +1,121 @@
+import io
+import os
+import sys
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from contextlib import redirect_stderr, redirect_stdout
+
+
+def available_memory():
+    """Return the memory available for new work in bytes, or None if it can't be determined."""
+    # MemAvailable counts reclaimable page cache, which matters on machines that have been busy with I/O
+    try:
+        with open("/proc/meminfo", "r") as f:
+            for line in f:
+                if line.startswith("MemAvailable:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    try:
+        return os.sysconf("SC_AVPHYS_PAGES") * os.sysconf("SC_PAGE_SIZE")
+    except (AttributeError, ValueError, OSError):
+        return None
+
+
+def capture_result(fn, *args):
+    """Run fn, capturing everything it prints.
+
+    Returns the captured output, the exception raised by fn if any, and the value it returned.
+    """
+    log = io.StringIO()
+    try:
+        with redirect_stdout(log), redirect_stderr(log):
+            result = fn(*args)
+    except Exception as error:
+        return log.getvalue(), error, None
+    return log.getvalue(), None, result
+
+
+def capture_output(fn, *args):
+    """Run fn, capturing everything it prints.
+
+    Returns the captured output and the exception raised by fn, if any.
+    """
+    log, error, _ = capture_result(fn, *args)
+    return log, error
+
+
+class SeriesScheduler:
+    """Run independent series conversions in worker processes.
+
+    A series is only started once there is a free worker and its estimated memory fits alongside the
+    series already running, though a series is always admitted if nothing else is running. The output
+    of each series is printed in one piece once it finishes, and the first error raised by any series
+    stops new series from being started and is re-raised. The values returned by the series are
+    collected in ``results``. ``drain`` waits for the series running so far while keeping the workers,
+    so one scheduler can be shared by several sessions.
+    """
+
+    def __init__(self, max_workers, memory_limit=None):
+        self.max_workers = max_workers
+        self.memory_limit = available_memory() if memory_limit is None else memory_limit
+        self.pool = ProcessPoolExecutor(max_workers)
+        self.running = {}
+        self.results = []
+        self.error = None
+
+    def memory_in_use(self):
+        """Estimated memory of the series currently running."""
+        return sum(self.running.values())
+
+    def fits(self, memory):
+        """Whether a series needing this much memory can start now."""
+        if not self.running:
+            return True
+        if len(self.running) >= self.max_workers:
+            return False
+        return self.memory_limit is None or self.memory_in_use() + memory <= self.memory_limit
+
+    def submit(self, fn, *args, memory=0):
+        """Start fn(*args) in a worker once it fits, blocking until then."""
+        while self.error is None and not self.fits(memory):
+            self.wait_one()
+        if self.error is not None:
+            self.drain()
+        self.running[self.pool.submit(capture_result, fn, *args)] = memory
+
+    def wait_one(self):
+        """Wait for at least one running series to finish and print its output."""
+        done, _ = wait(self.running, return_when=FIRST_COMPLETED)
+        for future in done:
+            del self.running[future]
+            log, error, result = future.result()
+            sys.stdout.write(log)
+            sys.stdout.flush()
+            if error is not None and self.error is None:
+                self.error = error
+            if result is not None:
+                self.results.append(result)
+
+    def drain(self):
+        """Wait for every running series, then raise the first error if there was one, ready for more series."""
+        while self.running:
+            self.wait_one()
+        error, self.error = self.error, None
+        if error is not None:
+            raise error
+
+    def close(self):
+        """Wait for every running series, then raise the first error if there was one."""
+        try:
+            self.drain()
+        finally:
+            self.pool.shutdown()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.pool.shutdown(cancel_futures=True)
@@ -4,61 +4,41 @@ from __future__ import annotations
 import sys
 import json
 import shutil
+import tempfile
+import time
+from contextlib import ExitStack, suppress
 from pathlib import Path
 import argparse
-import numpy as np
-from nibabel.nifti1 import Nifti1Image
 import os
-import pydicom
-from xa30_workaround.dicom import dicom2nifti
-from xa30_workaround.dat import dat_to_array
+from concurrent.futures import ProcessPoolExecutor
+from xa30_workaround.batch import read_sessions, session_argv
+from xa30_workaround.dicom import SeriesIndex, dcm2niix_help, iter_dicom2nifti
+from xa30_workaround.cache import HeaderCache
+from xa30_workaround.lazy import lazy_import
+from xa30_workaround.dat import DatIndex, check_dat_sizes, dat_to_array, empty_echoes, iter_dat_frames, slice_order
+from xa30_workaround.compress import DEFAULT_LEVEL, default_threads
+from xa30_workaround.manifest import Manifest, directory_fingerprint, series_fingerprint
+from xa30_workaround.nifti import (
+    OUTPUT_DTYPES,
+    NiftiStreamWriter,
+    cast_output,
+    header_dtype,
+    output_image,
+    read_first_volume,
+    save_nifti,
+)
+from xa30_workaround.output import OutputQueue
+from xa30_workaround.orientation import geometry_orientation, resolve_orientation
+from xa30_workaround.protocol import read_protocol
+from xa30_workaround.profiling import Profiler, new_record, profile_stage
+from xa30_workaround.scheduler import SeriesScheduler, capture_output
+from xa30_workaround.watch import Inbox, make_watcher
 from xa30_workaround._version import __version__ as vers
 
-
-def normalize(data):
-    """Normalize the data to be between 0 and 1."""
-    return (data - np.min(data)) / (np.max(data) - np.min(data))
-
-
-def match_orientation(dat, nifti):
-    """Attempt to match orientation of dat file to that of nifti file."""
-
-    # Just try to match the first frame and first echo.
-    if len(dat.shape) > 4:
-        dat_norm = normalize(dat[..., 0, 0].astype("f8"))
-        nifti_norm = normalize(nifti[..., 0])
-    else:
-        dat_norm = normalize(dat[..., 0].astype("f8"))
-        nifti_norm = normalize(nifti)
-
-    # Check if the orientations already match.
-    if np.all(np.isclose(dat_norm, nifti_norm)):
-        return dat
-
-    # Try flipping one of the three axes.
-    if np.all(np.isclose(np.flip(dat_norm, 0), nifti_norm)):
-        return np.flip(dat, 0)
-    if np.all(np.isclose(np.flip(dat_norm, 1), nifti_norm)):
-        return np.flip(dat, 1)
-    if np.all(np.isclose(np.flip(dat_norm, 2), nifti_norm)):
-        return np.flip(dat, 2)
-
-    # Try flipping two of the three axes.
-    if np.all(np.isclose(np.flip(dat_norm, (0, 1)), nifti_norm)):
-        return np.flip(dat, (0, 1))
-    if np.all(np.isclose(np.flip(dat_norm, (0, 2)), nifti_norm)):
-        return np.flip(dat, (0, 2))
-    if np.all(np.isclose(np.flip(dat_norm, (1, 2)), nifti_norm)):
-        return np.flip(dat, (1, 2))
-
-    # Try flipping all of the first three axes.
-    if np.all(np.isclose(np.flip(dat_norm, (0, 1, 2)), nifti_norm)):
-        return np.flip(dat, (0, 1, 2))
-
-    # We were unable to make the two frames line up.
-    # Most likely it is not just an orientation issue.
-    # The dat file and the nifti file appear to contain totally different data.
-    raise ValueError("Sanity check failed. The first echo, first frame of the .dat files does not match the nifti.")
+# loaded on first use, so that e.g. `dcmdat2niix -h` starts quickly
+nib = lazy_import("nibabel")
+np = lazy_import("numpy")
+pydicom = lazy_import("pydicom")
 
 
 def dir_path(path: str) -> Path | None:
@@ -71,39 +51,808 @@ def dir_path(path: str) -> Path | None:
         raise argparse.ArgumentTypeError(f"Directory not found: {path}")
 
 
-def main():
-    parser = argparse.ArgumentParser(description="Convert DICOM and .dat to NIFTI", add_help=False)
-    parser.add_argument("-h", "--help", action="store_true")
+def read_series_protocol(dicom, cache=None):
+    """Read the summary of the Siemens protocol in the DICOM header, as returned by read_protocol without ascconv.
+
+    The protocol is only parsed if it isn't already in the header cache.
+    """
+    entry = {} if cache is None else cache.get(dicom)
+    if "echo_times" not in entry:
+        # alTE is not a DICOM tag, it is part of the Siemens protocol in the private header
+        protocol = read_protocol(dicom)
+        entry = {key: value for key, value in protocol.items() if key != "ascconv"}
+        if protocol["echo_times"] is not None:
+            entry["echo_times"] = protocol["echo_times"].tolist()
+        if cache is not None:
+            cache.update(dicom, **entry)
+    return entry
+
+
+def read_echo_times(dicom, cache=None, protocol=None):
+    """Read the echo times (in seconds) from the alTE field of the DICOM header.
+
+    Pass ``protocol`` to reuse a summary already returned by read_series_protocol.
+    """
+    entry = read_series_protocol(dicom, cache) if protocol is None else protocol
+
+    # if TEs is None, then we could not find the alTE tag and should raise an error
+    if entry["echo_times"] is None:
+        raise ValueError(f"Could not find alTE tag in {dicom}.")
+    return np.array(entry["echo_times"])
+
+
+def dat_index_for(dicom, dat_dir, dat_indexes):
+    """Return the index of the directory holding the .dat files of a DICOM, listing each directory only once."""
+    directory = Path(dicom).parent if dat_dir is None else dat_dir
+    if directory not in dat_indexes:
+        dat_indexes[directory] = DatIndex(directory)
+    return dat_indexes[directory]
+
+
+def find_dat_files(dicom, dat_dir, cache=None, dat_index=None):
+    """Find the .dat files associated with a DICOM file, using the index of their directory if given."""
+    if dat_index is None:
+        dat_index = dat_index_for(dicom, dat_dir, {})
+    if dat_dir is None:
+        # look for .dat files that neighbor the exemplar dicom file
+        return list(dat_index.files)
+
+    # look for .dat files in the specified directory
+    # find dat files that match the Series Instance UID of the dicom
+
+    # extract Series Instance UID of this dicom file
+    # should look something like
+    # 1.3.12.2.1107.5.2.43.166158.2023072109355378899049069.0.0.0
+    # strip off the last six characters, the .0.0.0 part
+    # should then look something like
+    # 1.3.12.2.1107.5.2.43.166158.2023072109355378899049069
+    entry = {} if cache is None else cache.get(dicom)
+    if "series_uid" not in entry:
+        entry["series_uid"] = str(pydicom.dcmread(dicom, stop_before_pixels=True)[0x0020, 0x000E].value)
+        if cache is not None:
+            cache.update(dicom, series_uid=entry["series_uid"])
+    dicom_sid = entry["series_uid"][:-6]
+
+    # look for .dat files in dat_dir whose name contains the sid
+    # skip hidden files starting with a .
+    return dat_index.find(dicom_sid)
+
+
+def name_first_echo(nifti, nifti_img_path, nifti_json, suffix):
+    """Make sure the first echo has an echo label in its filename, renaming the dcm2niix output if needed.
+
+    Returns the (possibly renamed) nifti base, image and json paths, the echo prefix used in the
+    filenames, and whether the first echo should be resaved with the .dat data.
+    """
+    echo_prefix = "e"
+    # check if e1 is in the filename
+    if "e1" not in nifti.name:
+        # skip if echo1 is in filename
+        if "echo1" in nifti.name:
+            return nifti, nifti_img_path, nifti_json, "echo", False
+        # if not, then add it to the nifti name and rename the file
+        orig_img_path = nifti_img_path
+        orig_json_path = nifti_json
+        if "_ph" in nifti.name:
+            nifti = Path(str(nifti).replace("_ph", "_e1_ph"))
+        else:
+            nifti = Path(str(nifti) + "_e1")
+        nifti_img_path = nifti.with_suffix(suffix)
+        nifti_json = nifti.with_suffix(".json")
+        shutil.move(orig_img_path, nifti_img_path)
+        shutil.move(orig_json_path, nifti_json)
+    # resave the phase image with the dat data
+    return nifti, nifti_img_path, nifti_json, echo_prefix, "_ph" in nifti.name
+
+
+def echo_metadata(metadata, i, t):
+    """Make the JSON sidecar metadata for echo i with echo time t."""
+    # copy the metadata
+    metadata_copy = metadata.copy()
+    # replace the echo time
+    metadata_copy["EchoTime"] = t
+    # replace the ConversionSoftware
+    metadata_copy["ConversionSoftware"] = "dcmdat2niix"
+    # set the proper TE type in ImageTypeText
+    echo_label = f"TE{str(i + 1)}"
+    metadata_copy["ImageTypeText"] = [
+        echo_label if str(val).startswith("TE") else val for val in metadata_copy["ImageTypeText"]
+    ]
+    return metadata_copy
+
+
+def write_sidecar(path, metadata):
+    """Write a JSON sidecar."""
+    with open(path, "w") as f:
+        json.dump(metadata, f, indent=4)
+
+
+def echo_outputs(nifti, nifti_img_path, nifti_json, suffix, TEs, metadata, writer=None):
+    """Work out the image file to write for each echo, writing the JSON sidecars of the new echoes.
+
+    The sidecars are queued on ``writer`` if given. Returns a dict mapping echo index to the output image
+    path of each echo that needs writing, and a list of every file the series ends up with.
+    """
+    nifti, nifti_img_path, nifti_json, echo_prefix, resave_first = name_first_echo(
+        nifti, nifti_img_path, nifti_json, suffix
+    )
+    outputs = {0: nifti_img_path} if resave_first else {}
+    files = [nifti_img_path, nifti_json]
+
+    # loop over each echo skipping the first one
+    for i, t in enumerate(TEs[1:], start=1):
+        # substitute the echo in output_filename
+        output_base = nifti.with_name(nifti.name.replace(f"{echo_prefix}1", f"{echo_prefix}{i + 1}"))
+        outputs[i] = output_base.with_suffix(suffix)
+        # save the json file (from the base path not the nifti path)
+        output_json = output_base.with_suffix(".json")
+        if writer is None:
+            write_sidecar(output_json, echo_metadata(metadata, i, t))
+        else:
+            writer.submit(output_json, write_sidecar, output_json, echo_metadata(metadata, i, t))
+        files += [outputs[i], output_json]
+    return outputs, files
+
+
+def find_nifti_image(nifti):
+    """Find the image file written by dcm2niix for a nifti base path, returning its path and suffix."""
+    nifti_img_path = Path(nifti).with_suffix(".nii")
+    suffix = ".nii"
+    if not nifti_img_path.exists():
+        nifti_img_path = Path(nifti).with_suffix(".nii.gz")
+        suffix = ".nii.gz"
+        if not nifti_img_path.exists():
+            raise ValueError(f"Could not find nifti file {nifti_img_path}.")
+    return nifti_img_path, suffix
+
+
+def estimate_series_memory(nifti, dicom, stream=False, jobs=1, cache=None, out_dtype="header"):
+    """Estimate the peak memory in bytes needed to convert a series.
+
+    Returns 0 if the series can't be inspected, leaving the error to be raised by the conversion itself.
+    """
+    try:
+        num_echoes = read_echo_times(dicom, cache).shape[0]
+        nifti_img = nib.Nifti1Image.load(find_nifti_image(nifti)[0])
+    except (OSError, ValueError):
+        return 0
+    shape = nifti_img.shape
+    echo_bytes = int(np.prod(shape[:3])) * 2
+    frame_bytes = echo_bytes * num_echoes
+    if stream:
+        # the frames being decoded plus the oriented frame being written
+        return frame_bytes * (jobs + 2)
+    num_frames = shape[3] if len(shape) > 3 else 1
+    # the assembled series plus a copy of one echo when it is saved, and a copy of the series if it is widened
+    dtype = np.dtype(header_dtype(nifti_img.header) if out_dtype == "header" else OUTPUT_DTYPES[out_dtype])
+    cast_bytes = frame_bytes // 2 * dtype.itemsize if dtype.itemsize != 2 else 0
+    return (frame_bytes + cast_bytes + echo_bytes) * num_frames
+
+
+def series_geometry(nifti_img, metadata, mode):
+    """Derive the flip of the .dat data from the geometry in the dcm2niix output, or None to search the content."""
+    if mode == "content" or "ImageOrientationPatientDICOM" not in metadata:
+        return None
+    return geometry_orientation(nifti_img.affine, metadata["ImageOrientationPatientDICOM"])
+
+
+def series_slice_orders(num_slices, nifti_img, metadata, protocol, mode="auto"):
+    """Work out the candidate acquisition orders of the .dat slices, the most likely first.
+
+    SliceTiming in the sidecar follows the nifti slices, which dcm2niix may have stored against the
+    .dat slice direction. With ``mode="geometry"`` only the direction derived from the scan geometry
+    is used. With ``mode="auto"`` it comes first, followed by the opposite direction and the protocol
+    order, for when the orientation check fails. With ``mode="content"`` the geometry isn't used, and
+    the SliceTiming as stored comes first. Without a usable SliceTiming, the protocol order is used.
+    """
+    protocol_order = slice_order(num_slices, None, protocol.get("slice_mode"), protocol.get("multiband_factor", 1))
+    slice_timing = metadata.get("SliceTiming")
+    if slice_timing is None or len(slice_timing) != num_slices:
+        return [protocol_order]
+    reverse = False
+    if mode != "content" and "ImageOrientationPatientDICOM" in metadata:
+        axes = geometry_orientation(nifti_img.affine, metadata["ImageOrientationPatientDICOM"])
+        reverse = axes is not None and 2 in axes
+    orders = [slice_order(num_slices, slice_timing[::-1] if reverse else slice_timing)]
+    if mode == "geometry":
+        return orders
+    for order in [slice_order(num_slices, slice_timing if reverse else slice_timing[::-1]), protocol_order]:
+        if not any(np.array_equal(order, seen) for seen in orders):
+            orders.append(order)
+    return orders
+
+
+def first_matching_order(orders, attempt):
+    """Call attempt with each candidate slice order until the .dat files match the nifti, returning its result.
+
+    ``attempt`` raises ValueError if they don't match in that order, which is raised for the last order.
+    """
+    for order in orders[:-1]:
+        try:
+            return attempt(order)
+        except ValueError:
+            print("The .dat files do not match the nifti with this slice order, trying another slice order.")
+    return attempt(orders[-1])
+
+
+def conversion_options(stream, orientation, gzip_level, gzip_threads, out_dtype):
+    """The options of dcmdat2niix that change the files a series is converted into, for the manifest."""
+    return {
+        "stream": stream,
+        "orientation": orientation,
+        "gzip_level": gzip_level,
+        "gzip_threads": gzip_threads,
+        "out_dtype": out_dtype,
+    }
+
+
+def convert_series(
+    nifti,
+    dicom,
+    dat_dir=None,
+    stream=False,
+    jobs=1,
+    cache=None,
+    dat_index=None,
+    orientation="auto",
+    gzip_level=DEFAULT_LEVEL,
+    gzip_threads=None,
+    out_dtype="header",
+    manifest=None,
+    writer=None,
+    profiler=None,
+):
+    """Convert the .dat files associated with a dcm2niix output into per-echo NIFTI files.
+
+    The output files are queued on ``writer`` (an OutputQueue) if given, otherwise they are written
+    before returning. Series that ``manifest`` records as up to date are skipped, and converted
+    series are recorded in it once their files are written. The echoes are stored with the
+    ``out_dtype`` policy (see ``cast_output``). The time spent in each stage is recorded with
+    ``profiler`` if given.
+    """
+    with profile_stage(profiler, "protocol", nifti):
+        protocol = read_series_protocol(dicom, cache)
+        TEs = read_echo_times(dicom, protocol=protocol)
+
+    # load the json file of the nifti
+    nifti_json = Path(nifti).with_suffix(".json")
+    if not nifti_json.exists():
+        raise ValueError(f"Could not find json file {nifti_json}.")
+    with open(nifti_json, "r") as f:
+        metadata = json.load(f)
+
+    # load the nifti file
+    with profile_stage(profiler, "load_nifti", nifti) as record:
+        nifti_img_path, suffix = find_nifti_image(nifti)
+        nifti_img = nib.Nifti1Image.load(nifti_img_path)
+        # the image data is only read when it is needed
+        record["bytes_read"] += int(nifti_img.dataobj.offset)
+
+    # get the shape of the nifti file
+    # we want the first dimension to me the number of echos
+    # the next three dimensions should be the volume
+    # we want to ignore the number of time points
+    shape = nifti_img.shape
+    rshape = list(shape[::-1])
+    if len(rshape) <= 3:
+        # it would appear there is only one time point
+        # prepend the number of echos to the array
+        rshape.insert(0, TEs.shape[0])
+    else:
+        # it looks like the first dimension is the number of time points
+        # replace time with number of TEs
+        rshape[0] = TEs.shape[0]
+
+    # now search for .dat files
+    with profile_stage(profiler, "dat_search", nifti):
+        dat_files = find_dat_files(dicom, dat_dir, cache, dat_index)
+
+    # if no .dat files were found, then skip this nifti
+    options = conversion_options(stream, orientation, gzip_level, gzip_threads, out_dtype)
+    inputs = None if manifest is None else series_fingerprint(dicom, dat_files, options)
+    if len(dat_files) == 0:
+        print(f"Could not find any .dat files associated with {dicom}.")
+        if manifest is not None:
+            manifest.record(nifti, inputs, [])
+        return
+
+    # skip series converted by an earlier run, dropping the copy dcm2niix wrote again on this run
+    recorded = None if manifest is None else manifest.series_outputs(nifti, inputs)
+    if recorded is not None:
+        print(f"{nifti} is up to date, skipping.")
+        for path in [nifti_img_path, nifti_json]:
+            if str(path) not in recorded:
+                os.remove(path)
+        return
+
+    print(f"Found {len(dat_files)} .dat files associated with {dicom}.")
+    with profile_stage(profiler, "validate", nifti):
+        validate_dat_files(dat_files, rshape, shape, dicom)
+    orders = series_slice_orders(rshape[1], nifti_img, metadata, protocol, orientation)
+    if stream:
+        files = stream_series(
+            dat_files,
+            rshape,
+            nifti,
+            nifti_img,
+            nifti_img_path,
+            nifti_json,
+            suffix,
+            TEs,
+            metadata,
+            jobs,
+            orientation,
+            orders,
+            gzip_level,
+            gzip_threads,
+            out_dtype,
+            profiler,
+        )
+        if manifest is not None:
+            manifest.record(nifti, inputs, files)
+        return
+
+    nifti_volume = None
+    dat_files = sorted(dat_files)
+    num_echoes, num_slices, num_rows, num_cols = rshape
+    data_array = empty_echoes((num_cols, num_rows, num_slices, num_echoes, len(dat_files)))
+
+    def orient_first_frame(order):
+        """Decode the first frame into place in a slice order and find the flip matching it to the nifti.
+
+        Returns the order and the flip, or raises ValueError if it doesn't match.
+        """
+        nonlocal nifti_volume
+        with profile_stage(profiler, "decode", nifti) as record:
+            first_frame = dat_to_array(dat_files[:1], rshape, out=data_array[..., :1], order=order)
+            record["bytes_read"] += first_frame.nbytes
+        # do first echo, first frame sanity check
+        with profile_stage(profiler, "orientation", nifti) as record:
+            if nifti_volume is None:
+                nifti_volume = load_first_volume(nifti_img, record)
+            axes = resolve_orientation(
+                first_frame, nifti_volume, series_geometry(nifti_img, metadata, orientation), orientation
+            )
+        return order, axes
+
+    # convert these files to a numpy array
+    print("Converting .dat files to nifti...")
+    # each candidate slice order is only tried on the first frame, and the rest of the series decoded once
+    order, axes = first_matching_order(orders, orient_first_frame)
+    # flip the data itself rather than taking a flipped view, so that each echo stays contiguous when it is saved
+    if axes:
+        first_frame = data_array[..., 0]
+        first_frame[...] = np.flip(first_frame, axes).copy()
+    if len(dat_files) > 1:
+        with profile_stage(profiler, "decode", nifti) as record:
+            rest = dat_to_array(
+                dat_files[1:], rshape, out=data_array[..., 1:], workers=jobs, order=order, flip_axes=axes
+            )
+            record["bytes_read"] += rest.nbytes
+
+    if len(shape) <= 3:
+        # There is only one frame (time point) in the nifti.
+        data_array = np.squeeze(data_array)
+
+    # cast once for every echo, so saving them neither casts nor rescales
+    data_array, slope_inter = cast_output(data_array, out_dtype, nifti_img.header)
+
+    # save each echo, only renaming if neccessary
+    print("Saving nifti files...")
+    if writer is not None:
+        # the queued writes of the previous series hold on to its data, so only this series is queued from here
+        writer.flush()
+    outputs, files = echo_outputs(Path(nifti), nifti_img_path, nifti_json, suffix, TEs, metadata, writer)
+    for i, output_path in outputs.items():
+        if len(shape) <= 3:
+            # there is only one frame (time point)
+            echo_img = output_image(data_array[..., i], nifti_img.affine, nifti_img.header, slope_inter)
+        else:
+            # save all frames
+            echo_img = output_image(data_array[..., i, :], nifti_img.affine, nifti_img.header, slope_inter)
+        if writer is None:
+            save_echo(echo_img, output_path, gzip_level, gzip_threads, profiler, nifti)
+        else:
+            writer.submit(output_path, save_echo, echo_img, output_path, gzip_level, gzip_threads, profiler, nifti)
+
+    if manifest is not None:
+        if writer is None:
+            manifest.record(nifti, inputs, files)
+        else:
+            writer.then(manifest.record, nifti, inputs, files)
+
+
+def validate_dat_files(dat_files, rshape, shape, dicom):
+    """Check the .dat files of a series against the nifti before decoding them, reporting every problem at once.
+
+    Each file must hold exactly one frame of the (echo, slice, row, col) shape ``rshape``, and there
+    must be one file per frame of the nifti, whose shape is ``shape``.
+    """
+    problems = []
+    # check if number of frames in nifti matches number of frames in .dat files
+    if len(shape) <= 3:
+        # There is only one frame (time point) in the nifti.
+        if len(dat_files) > 1:
+            problems.append(f"There is one frame in nifti but {len(dat_files)} frames in the .dat files.")
+    elif len(dat_files) != shape[-1]:
+        problems.append(
+            f"The number of frames in the .dat files, {len(dat_files)} does not match the number of frames in the nifti, {shape[-1]}."
+        )
+    problems += check_dat_sizes(dat_files, rshape)
+    if problems:
+        raise ValueError(f"The .dat files of {dicom} can't be converted:\n" + "\n".join(problems))
+
+
+def load_first_volume(nifti_img, record):
+    """Read only the first volume of the dcm2niix output for the orientation check, adding its size to record."""
+    volume = read_first_volume(nifti_img)
+    record["bytes_read"] += volume.size * nifti_img.dataobj.dtype.itemsize
+    return volume
+
+
+def save_echo(echo_img, output_path, gzip_level, gzip_threads, profiler=None, nifti=None):
+    """Save the image of an echo, recording it as a write stage of its series with profiler."""
+    with profile_stage(profiler, "write", nifti) as record:
+        save_nifti(echo_img, output_path, gzip_level, gzip_threads)
+        record["bytes_written"] += os.path.getsize(output_path)
+
+
+def convert_series_writing(write_jobs, profiler, *args):
+    """Convert a series with convert_series, writing its output files on write_jobs threads.
+
+    Returns the stages recorded by ``profiler`` if given, for the parent process to merge.
+    """
+    with OutputQueue(write_jobs) as writer:
+        convert_series(*args, writer=writer, profiler=profiler)
+    return None if profiler is None else profiler.records()
+
+
+def stream_series(
+    dat_files,
+    rshape,
+    nifti,
+    nifti_img,
+    nifti_img_path,
+    nifti_json,
+    suffix,
+    TEs,
+    metadata,
+    jobs=1,
+    orientation="auto",
+    orders=None,
+    gzip_level=DEFAULT_LEVEL,
+    gzip_threads=None,
+    out_dtype="header",
+    profiler=None,
+):
+    """Write each echo's NIFTI file frame by frame as the .dat files are decoded, returning every file of the series.
+
+    The first frame is decoded with each of the candidate slice ``orders`` in turn, until one matches
+    the nifti. Decoding and writing are interleaved, so their times are added up over the frames and
+    recorded with ``profiler`` once the series is written.
+    """
+    shape = nifti_img.shape
+    print("Streaming .dat files to nifti...")
+    decoding = new_record("decode", nifti)
+    writing = new_record("write", nifti)
+
+    nifti_volume = None
+
+    def orient_first_frame(order):
+        """Decode the first frame in a slice order and find the flip matching it to the nifti.
+
+        Returns the frames, the first frame and its flip, or raises ValueError if it doesn't match.
+        """
+        nonlocal nifti_volume
+        frames = iter_dat_frames(dat_files, rshape, workers=jobs, order=order)
+        start = time.perf_counter()
+        first_frame = next(frames)
+        decoding["seconds"] += time.perf_counter() - start
+        # do first echo, first frame sanity check
+        with profile_stage(profiler, "orientation", nifti) as record:
+            if nifti_volume is None:
+                nifti_volume = load_first_volume(nifti_img, record)
+            try:
+                axes = resolve_orientation(
+                    first_frame if len(shape) <= 3 else first_frame[..., np.newaxis],
+                    nifti_volume,
+                    series_geometry(nifti_img, metadata, orientation),
+                    orientation,
+                )
+            except ValueError:
+                frames.close()
+                raise
+        return frames, first_frame, axes
+
+    frames, first_frame, axes = first_matching_order([None] if orders is None else orders, orient_first_frame)
+
+    outputs, files = echo_outputs(Path(nifti), nifti_img_path, nifti_json, suffix, TEs, metadata)
+    start = time.perf_counter()
+    with ExitStack() as stack:
+        writers = {
+            i: stack.enter_context(
+                NiftiStreamWriter(
+                    output_path,
+                    shape,
+                    nifti_img.affine,
+                    nifti_img.header,
+                    gzip_level,
+                    gzip_threads,
+                    OUTPUT_DTYPES[out_dtype],
+                )
+            )
+            for i, output_path in outputs.items()
+        }
+        frame = first_frame
+        while frame is not None:
+            oriented = np.flip(frame, axes)
+            for i, writer in writers.items():
+                writer.write(oriented[..., i])
+            decode_start = time.perf_counter()
+            frame = next(frames, None)
+            decoding["seconds"] += time.perf_counter() - decode_start
+            writing["seconds"] -= time.perf_counter() - decode_start
+    # the time between decoding frames, and finishing the files, is spent writing
+    writing["seconds"] += time.perf_counter() - start
+    if profiler is not None:
+        decoding["bytes_read"] = int(np.prod(rshape)) * 2 * len(dat_files)
+        writing["bytes_written"] = sum(os.path.getsize(path) for path in outputs.values())
+        profiler.add(decoding)
+        profiler.add(writing)
+    return files
+
+
+def positive_int(value: str) -> int:
+    """Validate that a string is a positive integer."""
+    try:
+        number = int(value)
+    except ValueError:
+        number = 0
+    if number < 1:
+        raise argparse.ArgumentTypeError(f"Expected a positive integer: {value}")
+    return number
+
+
+def compression_level(value: str) -> int:
+    """Validate a gzip compression level."""
+    try:
+        level = int(value)
+    except ValueError:
+        level = 0
+    if not 1 <= level <= 9:
+        raise argparse.ArgumentTypeError(f"Expected a compression level from 1 to 9: {value}")
+    return level
+
+
+def memory_size(value: str) -> int:
+    """Parse a memory size such as 512M or 16G into bytes."""
+    units = {"K": 1024, "M": 1024**2, "G": 1024**3, "T": 1024**4}
+    text = value.strip().upper().rstrip("B")
+    scale = 1
+    if text and text[-1] in units:
+        scale = units[text[-1]]
+        text = text[:-1]
+    try:
+        size = float(text) * scale
+    except ValueError:
+        size = 0
+    if size <= 0:
+        raise argparse.ArgumentTypeError(f"Expected a memory size like 512M or 16G: {value}")
+    return int(size)
+
+
+def session_series(session):
+    """Find one DICOM file per series under a session directory, keyed by Series Instance UID."""
+    return SeriesIndex(session).series()
+
+
+def session_complete(session, dat_dir=None, cache=None):
+    """Whether every DICOM series in a session directory has all of its .dat files.
+
+    A series is complete once it has a .dat file for every repetition in its protocol. Series without
+    any .dat files, or without a repetition count, don't hold the session back. The .dat files of a
+    series are found as the conversion finds them, with find_dat_files.
+    """
+    dat_indexes = {}
+    for dicom in session_series(session).values():
+        dat_files = find_dat_files(dicom, dat_dir, cache, dat_index_for(dicom, dat_dir, dat_indexes))
+        if not dat_files:
+            continue
+        repetitions = read_series_protocol(dicom, cache).get("num_repetitions")
+        if repetitions is not None and len(dat_files) < repetitions + 1:
+            return False
+    return True
+
+
+def watch_main(argv):
+    """Watch an inbox of session directories, converting each once its DICOM and .dat files are complete."""
+    parser = argparse.ArgumentParser(
+        prog="dcmdat2niix watch",
+        description="Watch an inbox of session directories (one DICOM folder per session), converting each "
+        "session once it is complete. Any other arguments are passed on to dcmdat2niix for each session.",
+    )
+    parser.add_argument("inbox", help="Directory holding one subdirectory per session.", type=dir_path)
+    parser.add_argument(
+        "--output-dir",
+        help="Directory to write each session's output to, in a subdirectory named after the session "
+        "(default: the session directory itself).",
+        type=Path,
+        dest="output_dir",
+    )
     parser.add_argument(
         "--dat-dir",
-        help="Directory containing DAT files. If not specified, look in the same directory as DICOM files by default. Note that each dat file should have, in the filename, the same Series Instance UID as the DICOM file it is associated with.",
+        help="Shared directory holding the .dat files of every session, matched by Series Instance UID.",
         type=dir_path,
         dest="dat_dir",
-        default="",
     )
+    parser.add_argument(
+        "--settle",
+        help="Seconds a session's files must stay unchanged before it is checked for completeness (default: 30).",
+        type=float,
+        default=30.0,
+    )
+    parser.add_argument(
+        "--poll-interval",
+        help="Seconds between rescans of the inbox, when inotify is unavailable or misses changes (default: 5).",
+        type=float,
+        dest="poll_interval",
+        default=5.0,
+    )
+    parser.add_argument(
+        "--watch-jobs",
+        help="Number of sessions converted at once; further complete sessions wait their turn (default: 1).",
+        type=positive_int,
+        dest="watch_jobs",
+        default=1,
+    )
+    parser.add_argument(
+        "--once", help="Exit once every session has been converted or found incomplete.", action="store_true"
+    )
+    args, convert_args = parser.parse_known_args(argv)
+    if args.dat_dir is not None:
+        convert_args += ["--dat-dir", str(args.dat_dir)]
 
-    # parse arguments
-    args, other_args = parser.parse_known_args()
+    inbox = Inbox(args.inbox, args.settle, [] if args.dat_dir is None else [args.dat_dir])
+    watcher = make_watcher(args.poll_interval)
+    running = {}
+    print(f"Watching {args.inbox} for sessions...")
+    try:
+        with ProcessPoolExecutor(args.watch_jobs) as pool:
+            while True:
+                # report the sessions that finished converting
+                for future in [future for future in running if future.done()]:
+                    session, files = running.pop(future)
+                    log, error = future.result()
+                    sys.stdout.write(log)
+                    if error is not None:
+                        print(f"Failed to convert {session}: {error!r}")
+                    # failed sessions are retried once their files change
+                    inbox.handled(session, files)
+                sys.stdout.flush()
 
-    # get help
-    if args.help:
-        print(f"dcmdat2niix Version {vers}\n")
-        print("Modified version of dcm2niix that can convert .dat files to NIFTI.")
-        print("You should put the .dat files next to the associated DICOM files.")
-        print("Or run with `--dat-dir=DATDIR` to look for .dat files in another location.")
-        print("Below is the original dcm2niix help:\n")
-        dicom2nifti("-h")
-        sys.exit(0)
+                watcher.add(args.inbox)
+                if args.dat_dir is not None:
+                    watcher.add(args.dat_dir)
+                busy = {session for session, _ in running.values()}
+                for session, files in inbox.scan():
+                    # leave complete sessions waiting while every worker is busy
+                    if session in busy or len(running) >= args.watch_jobs:
+                        continue
+                    if not session_complete(session, args.dat_dir):
+                        inbox.handled(session, files)
+                        continue
+                    session_args = list(convert_args)
+                    if args.output_dir is not None:
+                        session_args += ["-o", str(args.output_dir / Path(session).name)]
+                    print(f"Converting {session}...")
+                    running[pool.submit(capture_output, main, session_args + [session])] = (session, files)
+
+                if args.once and not running and not inbox.pending():
+                    break
+                watcher.wait()
+    finally:
+        watcher.close()
 
-    # we need verbose output to get the dicom location
-    if "-v" not in other_args:
-        idx = len(other_args) - 1
-        other_args.insert(idx, "1")
-        other_args.insert(idx, "-v")
-    else:
-        raise ValueError("Turn off verbose output (-v) as this conflicts with this script.")
 
+def batch_main(argv):
+    """Convert every session of a batch manifest in one process, sharing the workers, header cache and .dat indexes."""
+    parser = argparse.ArgumentParser(
+        prog="dcmdat2niix batch",
+        description="Convert every session listed in a manifest in one process. Any other arguments are passed "
+        "on to dcmdat2niix for every session, ahead of the session's own arguments.",
+    )
+    parser.add_argument(
+        "manifest",
+        help="CSV file (or JSON list, if named *.json) of sessions, with the columns dicom_dir, and optionally "
+        "dat_dir, out_dir and args (extra dcmdat2niix and dcm2niix arguments of the session).",
+        type=Path,
+    )
+    parser.add_argument(
+        "--summary",
+        help="Write the outcome of each session, its time and any error to this JSON file.",
+        type=Path,
+    )
+    batch_args, common_args = parser.parse_known_args(argv)
+
+    # check the arguments of every session before converting any of them
+    sessions = []
+    for session in read_sessions(batch_args.manifest):
+        argv = session_argv(session, common_args)
+        args, other_args = parse_args(argv)
+        sessions.append((session, argv, args, other_args))
+
+    # the worker pool, header cache and .dat indexes are set up from the common arguments and shared
+    args, _ = parse_args(common_args)
+    summary = []
+    with ExitStack() as stack:
+        cache_dir = args.cache_dir
+        if cache_dir is None:
+            # still share the headers between the sessions of this batch
+            cache_dir = stack.enter_context(tempfile.TemporaryDirectory(prefix="dcmdat2niix-cache-"))
+        cache = HeaderCache(cache_dir, args.cache_size)
+        scheduler = None
+        if args.series_jobs > 1:
+            scheduler = stack.enter_context(SeriesScheduler(args.series_jobs, args.max_memory))
+        dat_indexes = {}
+
+        for session, argv, session_args, other_args in sessions:
+            print(f"Converting {session['dicom_dir']}...")
+            outcome = {
+                "dicom_dir": str(session["dicom_dir"]),
+                "out_dir": None if session["out_dir"] is None else str(session["out_dir"]),
+                "status": "converted",
+                "error": None,
+            }
+            start = time.perf_counter()
+            try:
+                run_session(session_args, other_args, argv, cache=cache, dat_indexes=dat_indexes, scheduler=scheduler)
+            except Exception as error:
+                print(f"Failed to convert {session['dicom_dir']}: {error!r}")
+                outcome.update(status="failed", error=repr(error))
+                if scheduler is not None:
+                    # let the series the session had already started finish, without blaming the next session
+                    with suppress(Exception):
+                        scheduler.drain()
+            outcome["seconds"] = time.perf_counter() - start
+            summary.append(outcome)
+
+    failed = [outcome for outcome in summary if outcome["status"] == "failed"]
+    print(f"Converted {len(summary) - len(failed)} of {len(summary)} sessions.")
+    for outcome in failed:
+        print(f"Failed: {outcome['dicom_dir']}: {outcome['error']}")
+    if batch_args.summary is not None:
+        with open(batch_args.summary, "w") as f:
+            json.dump(summary, f, indent=4)
+    if failed:
+        sys.exit(1)
+
+
+def profile_dcm2niix(pairs, profiler):
+    """Yield the (nifti, dicom) pairs from dcm2niix, recording the wait for each as its dcm2niix stage."""
+    pairs = iter(pairs)
+    while True:
+        record = new_record("dcm2niix")
+        start = time.perf_counter()
+        pair = next(pairs, None)
+        record["seconds"] = time.perf_counter() - start
+        if pair is not None:
+            record["series"] = str(pair[0])
+        profiler.add(record)
+        if pair is None:
+            return
+        yield pair
+
+
+def convert_session(args, other_args, profiler=None, cache=None, dat_indexes=None, scheduler=None):
+    """Run dcm2niix on a session, converting the .dat files of each series it writes.
+
+    A header ``cache``, the ``dat_indexes`` of the .dat directories and a ``scheduler`` (a
+    SeriesScheduler for ``--series-jobs``) can be shared between sessions, otherwise they are made
+    for this session alone.
+    """
     # dicom dir
+    input_dir = Path(other_args[-1])
+    output_dir = input_dir
     if "-o" in other_args:
         # get the index of the -o argument
         o_index = other_args.index("-o")
@@ -111,177 +860,262 @@ def main():
         output_dir = Path(other_args[o_index + 1])
         output_dir.mkdir(parents=True, exist_ok=True)
 
-    # run dcm2niix
-    dicoms_nii_map = dicom2nifti(*other_args)
-
-    # loop over each nifti file
-    for nifti in dicoms_nii_map:
-        # get the associated dicom file
-        dicom = dicoms_nii_map[nifti]
-
-        # search for alTE tag in dicom file header (this is not a DICOM tag so we need to search by text)
-        TEs = None
-        with open(dicom, "rb") as f:
-            # search for alTE and get the 8 next lines after
-            lines = f.readlines()
-            for i, line in enumerate(lines):
-                try:
-                    line = line.decode("utf-8")
-                except UnicodeDecodeError:
-                    continue
-                if "alTE" in line:
-                    TEs = np.array(
-                        [float(l.decode("utf-8").strip().split("= \t")[1]) / 1e6 for l in lines[i + 1 : i + 9]]
+    # manifest of the series already converted into the output directory
+    manifest = None
+    run_arguments = None
+    run_inputs = None
+    if output_dir.is_dir():
+        manifest = Manifest(output_dir)
+        if args.force:
+            # forget earlier runs, recording this one from scratch
+            manifest.clear()
+        run_arguments = {
+            "dcm2niix": other_args,
+            "options": conversion_options(
+                args.stream, args.orientation, args.gzip_level, args.gzip_threads, args.out_dtype
+            ),
+        }
+        run_inputs = directory_fingerprint(input_dir, args.dat_dir)
+        if manifest.run_up_to_date(run_arguments, run_inputs):
+            print("Every series is up to date.")
+            print("Done.")
+            return
+    converted = []
+
+    # cache of parsed DICOM headers, shared between runs
+    if cache is None and args.cache_dir is not None:
+        cache = HeaderCache(args.cache_dir, args.cache_size)
+
+    # indexes of the directories holding .dat files, each listed only once
+    if dat_indexes is None:
+        dat_indexes = {}
+
+    # run dcm2niix, converting each nifti file as soon as dcm2niix has written it
+    dicoms_nii_pairs = iter_dicom2nifti(*other_args)
+    if profiler is not None:
+        dicoms_nii_pairs = profile_dcm2niix(dicoms_nii_pairs, profiler)
+    if args.series_jobs > 1 or scheduler is not None:
+        shared = scheduler is not None
+        if not shared:
+            scheduler = SeriesScheduler(args.series_jobs, args.max_memory)
+        try:
+            with ExitStack() as stack:
+                if not shared:
+                    stack.enter_context(scheduler)
+                for nifti, dicom in dicoms_nii_pairs:
+                    converted.append(nifti)
+                    with profile_stage(profiler, "dat_search", nifti):
+                        dat_index = dat_index_for(dicom, args.dat_dir, dat_indexes)
+                    series = (
+                        nifti,
+                        dicom,
+                        args.dat_dir,
+                        args.stream,
+                        args.jobs,
+                        cache,
+                        dat_index,
+                        args.orientation,
+                        args.gzip_level,
+                        args.gzip_threads,
+                        args.out_dtype,
+                        manifest,
                     )
-                    # only grab valid TEs
-                    diff = TEs[1:] - TEs[0:-1]
-                    TEs = np.insert(TEs[1:][diff > 0], 0, TEs[0])
-                    break
+                    memory = estimate_series_memory(nifti, dicom, args.stream, args.jobs, cache, args.out_dtype)
+                    scheduler.submit(convert_series_writing, args.write_jobs, profiler, *series, memory=memory)
+                if shared:
+                    # leave the workers running for the next session
+                    scheduler.drain()
+        finally:
+            # the stages recorded in the worker processes
+            results, scheduler.results = scheduler.results, []
+            if profiler is not None:
+                for records in results:
+                    profiler.merge(records)
+    else:
+        # the outputs of each series are written while the next one is converted
+        with OutputQueue(args.write_jobs) as writer:
+            for nifti, dicom in dicoms_nii_pairs:
+                converted.append(nifti)
+                with profile_stage(profiler, "dat_search", nifti):
+                    dat_index = dat_index_for(dicom, args.dat_dir, dat_indexes)
+                convert_series(
+                    nifti,
+                    dicom,
+                    args.dat_dir,
+                    args.stream,
+                    args.jobs,
+                    cache,
+                    dat_index,
+                    args.orientation,
+                    args.gzip_level,
+                    args.gzip_threads,
+                    args.out_dtype,
+                    manifest,
+                    writer,
+                    profiler,
+                )
+    if manifest is not None:
+        manifest.record_run(run_arguments, run_inputs, converted)
+    print("Done.")
+
+
+def parse_args(argv):
+    """Split argv into the options of dcmdat2niix and the arguments passed on to dcm2niix."""
+    parser = argparse.ArgumentParser(description="Convert DICOM and .dat to NIFTI", add_help=False)
+    parser.add_argument("-h", "--help", action="store_true")
+    parser.add_argument(
+        "--dat-dir",
+        help="Directory containing DAT files. If not specified, look in the same directory as DICOM files by default. Note that each dat file should have, in the filename, the same Series Instance UID as the DICOM file it is associated with.",
+        type=dir_path,
+        dest="dat_dir",
+        default="",
+    )
+    parser.add_argument(
+        "--stream",
+        help="Write each echo frame by frame as the .dat files are decoded, instead of assembling the series in memory.",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--series-jobs",
+        help="Number of series converted concurrently in worker processes (default: 1).",
+        type=positive_int,
+        dest="series_jobs",
+        default=1,
+    )
+    parser.add_argument(
+        "--max-memory",
+        help="Memory budget for concurrent series, e.g. 16G (default: the memory available at startup).",
+        type=memory_size,
+        dest="max_memory",
+        default=None,
+    )
+    parser.add_argument(
+        "--cache-dir",
+        help="Directory for a cache of parsed DICOM headers, so that reruns can skip parsing them again.",
+        type=Path,
+        dest="cache_dir",
+        default=None,
+    )
+    parser.add_argument(
+        "--cache-size",
+        help="Maximum number of DICOM headers kept in the cache (default: 10000).",
+        type=positive_int,
+        dest="cache_size",
+        default=10000,
+    )
+    parser.add_argument(
+        "--orientation",
+        help="How to orient the .dat data: from the scan geometry (geometry), by searching the image content "
+        "(content), or from the geometry checked against the content (auto, the default).",
+        choices=["auto", "geometry", "content"],
+        default="auto",
+    )
+    parser.add_argument(
+        "--gzip-level",
+        help=f"Compression level (1-9) for .nii.gz outputs (default: {DEFAULT_LEVEL}).",
+        type=compression_level,
+        dest="gzip_level",
+        default=DEFAULT_LEVEL,
+    )
+    parser.add_argument(
+        "--gzip-threads",
+        help="Number of threads compressing each .nii.gz output, using pigz if it is installed "
+        "(default: the available CPUs divided by --write-jobs times --series-jobs).",
+        type=positive_int,
+        dest="gzip_threads",
+    )
+    parser.add_argument(
+        "--out-dtype",
+        help="How to store the echoes: as the dtype of the dcm2niix output, like the first echo (header, the default), "
+        "as the uint16 .dat data (native), as int16 (int16), or as float32. int16 data is shifted into range with an "
+        "intercept if needed.",
+        choices=list(OUTPUT_DTYPES),
+        dest="out_dtype",
+        default="header",
+    )
+    parser.add_argument(
+        "--write-jobs",
+        help="Number of output files written concurrently, while the next series is converted (default: 4).",
+        type=positive_int,
+        dest="write_jobs",
+        default=4,
+    )
+    parser.add_argument(
+        "--force",
+        help="Convert every series, even those recorded as up to date in the manifest of the output directory.",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--profile-report",
+        help="Write the wall time, bytes read and written, and peak memory of each stage of each series to this JSON file.",
+        type=Path,
+        dest="profile_report",
+    )
+    parser.add_argument(
+        "--profile-log",
+        help="Print each stage of each series to stderr as a line of JSON as it finishes.",
+        action="store_true",
+        dest="profile_log",
+    )
+    parser.add_argument(
+        "--jobs",
+        help="Number of threads used to decode .dat files concurrently (default: 1).",
+        type=positive_int,
+        default=1,
+    )
 
-        # if TEs is None, then we could not find the alTE tag and should raise an error
-        if TEs is None:
-            raise ValueError(f"Could not find alTE tag in {dicom}.")
+    args, other_args = parser.parse_known_args(argv)
+    if args.gzip_threads is None:
+        # every output being written at once compresses on its share of the CPUs
+        args.gzip_threads = default_threads(args.write_jobs * args.series_jobs)
+    return args, other_args
 
-        # load the json file of the nifti
-        nifti_json = Path(nifti).with_suffix(".json")
-        if not nifti_json.exists():
-            raise ValueError(f"Could not find json file {nifti_json}.")
-        with open(nifti_json, "r") as f:
-            metadata = json.load(f)
 
-        # load the nifti file
-        nifti_img_path = Path(nifti).with_suffix(".nii")
-        suffix = ".nii"
-        if not nifti_img_path.exists():
-            nifti_img_path = Path(nifti).with_suffix(".nii.gz")
-            suffix = ".nii.gz"
-            if not nifti_img_path.exists():
-                raise ValueError(f"Could not find nifti file {nifti_img_path}.")
-        nifti_img = Nifti1Image.load(nifti_img_path)
-
-        # get the shape of the nifti file
-        # we want the first dimension to me the number of echos
-        # the next three dimensions should be the volume
-        # we want to ignore the number of time points
-        shape = nifti_img.shape
-        rshape = list(shape[::-1])
-        if len(rshape) <= 3:
-            # it would appear there is only one time point
-            # prepend the number of echos to the array
-            rshape.insert(0, TEs.shape[0])
-        else:
-            # it looks like the first dimension is the number of time points
-            # replace time with number of TEs
-            rshape[0] = TEs.shape[0]
-
-        # now search for .dat files
-        if args.dat_dir is None:
-            # look for .dat files that neighbor the exemplar dicom file
-            dat_files = list(dicom.parent.glob("*.dat"))
-        else:
-            # look for .dat files in the specified directory
-            # find dat files that match the Series Instance UID of the dicom
-
-            # extract Series Instance UID of this dicom file
-            # should look something like
-            # 1.3.12.2.1107.5.2.43.166158.2023072109355378899049069.0.0.0
-            # strip off the last six characters, the .0.0.0 part
-            # should then look something like
-            # 1.3.12.2.1107.5.2.43.166158.2023072109355378899049069
-            dicom_sid = pydicom.dcmread(dicom)[0x0020, 0x000E].value[:-6]
-            print(dicom_sid)
-
-            # look for .dat files in dat_dir whose name contains the sid
-            # skip hidden files starting with a .
-            dat_files = list(args.dat_dir.glob(f"[!.]*{dicom_sid}*.dat"))
-
-        # if no .dat files were found, then skip this nifti
-        if len(dat_files) == 0:
-            print(f"Could not find any .dat files associated with {dicom}.")
-            continue
+def run_session(args, other_args, argv, **shared):
+    """Convert a session with convert_session, profiling it if asked to."""
+    profiler = Profiler(log=args.profile_log) if args.profile_report or args.profile_log else None
+    try:
+        convert_session(args, other_args, profiler, **shared)
+    finally:
+        if profiler is not None and args.profile_report is not None:
+            profiler.write_report(args.profile_report, argv)
 
-        # convert these files to a numpy array
-        print(f"Found {len(dat_files)} .dat files associated with {dicom}.")
-        print("Converting .dat files to nifti...")
-        data_array = dat_to_array(dat_files, rshape)
 
-        # check if number of frames in nifti matches number of frames in .dat files
-        if len(shape) <= 3:
-            # There is only one frame (time point) in the nifti.
-            if data_array.shape[-1] > 1:
-                raise ValueError(f"There is one frame in nifti but {data_array.shape[-1]} frames in the .dat files.")
-            data_array = np.squeeze(data_array)
-        else:
-            if data_array.shape[-1] != shape[-1]:
-                raise ValueError(
-                    f"The number of frames in the .dat files, {data_array.shape[-1]} does not match the number of frames in the nifti, {shape[-1]}."
-                )
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else list(argv)
+    if argv[:1] == ["watch"]:
+        watch_main(argv[1:])
+        return
+    if argv[:1] == ["batch"]:
+        batch_main(argv[1:])
+        return
 
-        # do first echo, first frame sanity check
-        data_array = match_orientation(data_array, nifti_img.dataobj)
-
-        # loop over each echo skipping the first one
-        # only renaming if neccessary
-        print("Saving nifti files...")
-        nifti = Path(nifti)
-        echo_prefix = "e"
-        for i, t in enumerate(TEs):
-            if i == 0:
-                # check if e1 is in the filename
-                if "e1" not in nifti.name:
-                    # skip if echo1 is in filename
-                    if "echo1" in nifti.name:
-                        echo_prefix = "echo"
-                        continue
-                    # if not, then add it to the nifti name and rename the file
-                    orig_img_path = nifti_img_path
-                    orig_json_path = nifti_json
-                    if "_ph" in nifti.name:
-                        nifti = Path(str(nifti).replace("_ph", "_e1_ph"))
-                    else:
-                        nifti = Path(str(nifti) + "_e1")
-                    nifti_img_path = nifti.with_suffix(suffix)
-                    nifti_json = nifti.with_suffix(".json")
-                    shutil.move(orig_img_path, nifti_img_path)
-                    shutil.move(orig_json_path, nifti_json)
-                # TODO: remove later if fixed
-                # resave the phase image with the dat data
-                if "_ph" in nifti.name:
-                    if len(shape) <= 3:
-                        # there is only one frame (time point)
-                        Nifti1Image(data_array[..., 0], nifti_img.affine, nifti_img.header).to_filename(nifti_img_path)
-                    else:
-                        # save all frames
-                        Nifti1Image(data_array[..., 0, :], nifti_img.affine, nifti_img.header).to_filename(
-                            nifti_img_path
-                        )
-                continue
-            # substitute the echo in output_filename
-            output_base = Path(str(nifti).replace(f"{echo_prefix}1", f"{echo_prefix}{i + 1}"))
-            # copy the metadata
-            metadata_copy = metadata.copy()
-            # replace the echo time
-            metadata_copy["EchoTime"] = t
-            # replace the ConversionSoftware
-            metadata_copy["ConversionSoftware"] = "dcmdat2niix"
-            # set the proper TE type in ImageTypeText
-            echo_label = f"TE{str(i + 1)}"
-            metadata_copy["ImageTypeText"] = [
-                echo_label if str(val).startswith("TE") else val for val in metadata_copy["ImageTypeText"]
-            ]
-            # save the nifti file
-            output_path = output_base.with_suffix(suffix)
-            if len(shape) <= 3:
-                # there is only one frame (time point)
-                Nifti1Image(data_array[..., i], nifti_img.affine, nifti_img.header).to_filename(output_path)
-            else:
-                # save all frames
-                Nifti1Image(data_array[..., i, :], nifti_img.affine, nifti_img.header).to_filename(output_path)
-            # save the json file (from the base path not the nifti path)
-            output_json = output_base.with_suffix(".json")
-            with open(output_json, "w") as f:
-                json.dump(metadata_copy, f, indent=4)
-    print("Done.")
+    # parse arguments
+    args, other_args = parse_args(argv)
+
+    # get help
+    if args.help:
+        print(f"dcmdat2niix Version {vers}\n")
+        print("Modified version of dcm2niix that can convert .dat files to NIFTI.")
+        print("You should put the .dat files next to the associated DICOM files.")
+        print("Or run with `--dat-dir=DATDIR` to look for .dat files in another location.")
+        print("Run with `--stream` to keep memory use bounded to a single frame on large series.")
+        print("Run with `--jobs=N` to decode .dat files on N threads.")
+        print("Run with `--series-jobs=N` to convert up to N series at once, within `--max-memory`.")
+        print("Run with `--cache-dir=CACHEDIR` to cache parsed DICOM headers between runs.")
+        print("Run with `--orientation=geometry` to orient .dat data from the scan geometry alone.")
+        print("Run with `--gzip-threads=N` and `--gzip-level=L` to control compression of .nii.gz outputs.")
+        print("Run with `--write-jobs=N` to write up to N output files at once.")
+        print("Run with `--out-dtype=int16` or `--out-dtype=float32` to store the echoes as int16 or float32.")
+        print("Run with `--force` to convert every series again, even if an earlier run converted it.")
+        print("Run with `--profile-report=REPORT.json` to record where the time and memory of each series went.")
+        print("Run `dcmdat2niix watch INBOX` to convert sessions as their files arrive (see `dcmdat2niix watch -h`).")
+        print("Run `dcmdat2niix batch MANIFEST` to convert many sessions in one process (see `dcmdat2niix batch -h`).")
+        print("Below is the original dcm2niix help:\n")
+        print(dcm2niix_help(), end="")
+        sys.exit(0)
+
+    run_session(args, other_args, argv)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,173 @@
+import ctypes
+import ctypes.util
+import os
+import select
+import time
+
+from xa30_workaround.dat import DatIndex
+from xa30_workaround.dicom import SeriesIndex
+from xa30_workaround.manifest import MANIFEST_NAME, OUTPUT_SUFFIXES
+
+# inotify flags, from <sys/inotify.h>
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+WATCH_MASK = IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE | IN_DELETE
+
+
+class PollingWatcher:
+    """Wait a fixed interval between scans of the watched directories."""
+
+    def __init__(self, interval):
+        self.interval = interval
+
+    def add(self, directory):
+        """Nothing to do, every directory is rescanned anyway."""
+
+    def wait(self):
+        """Sleep for the polling interval."""
+        time.sleep(self.interval)
+
+    def close(self):
+        pass
+
+
+class InotifyWatcher:
+    """Wait for changes under the watched directories with Linux inotify, called through ctypes.
+
+    ``wait`` returns as soon as anything changes, or after ``interval`` seconds at the latest, so
+    that changes inotify can't see (e.g. made by another host on a network mount) are still picked
+    up by the next scan.
+    """
+
+    def __init__(self, interval):
+        self.interval = interval
+        self.libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        self.fd = self.libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno))
+        self.watched = set()
+
+    def add(self, directory):
+        """Watch a directory and every directory below it that isn't watched yet."""
+        for root, _, _ in os.walk(directory):
+            if root in self.watched:
+                continue
+            if self.libc.inotify_add_watch(self.fd, os.fsencode(root), WATCH_MASK) < 0:
+                errno = ctypes.get_errno()
+                raise OSError(errno, os.strerror(errno), root)
+            self.watched.add(root)
+
+    def wait(self):
+        """Block until something changes or the interval passes."""
+        ready, _, _ = select.select([self.fd], [], [], self.interval)
+        if ready:
+            # the directories are rescanned anyway, so the events themselves don't matter
+            try:
+                while os.read(self.fd, 64 * 1024):
+                    pass
+            except BlockingIOError:
+                pass
+
+    def close(self):
+        os.close(self.fd)
+
+
+def make_watcher(interval):
+    """Watch with inotify where it is available, falling back to polling every interval seconds."""
+    try:
+        return InotifyWatcher(interval)
+    except (OSError, AttributeError, TypeError):
+        return PollingWatcher(interval)
+
+
+def fingerprint(files, path):
+    """Add the size and modification time of the file at path to files, unless it has gone."""
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return
+    files[os.fspath(path)] = (stat.st_size, stat.st_mtime_ns)
+
+
+def snapshot(*directories):
+    """Map every input file under the directories to its size and modification time."""
+    files = {}
+    for directory in directories:
+        for root, _, names in os.walk(directory):
+            for name in names:
+                if name == MANIFEST_NAME or name.endswith(OUTPUT_SUFFIXES):
+                    continue
+                fingerprint(files, os.path.join(root, name))
+    return files
+
+
+class Inbox:
+    """Track the session directories in an inbox until their files settle.
+
+    Each subdirectory of the inbox is a session. A session has settled once its files haven't
+    changed for ``settle`` seconds. Its files include the .dat files of its own series in
+    ``shared_dirs`` (e.g. a common .dat directory), but not those of other sessions. A settled
+    session is reported by ``scan`` until it is marked handled, and again whenever its files
+    change after that.
+    """
+
+    def __init__(self, inbox, settle, shared_dirs=()):
+        self.inbox = inbox
+        self.settle = settle
+        self.shared_dirs = list(shared_dirs)
+        # session -> (files, time they were first seen, files when last handled)
+        self.sessions = {}
+        # session -> (its own files, the Series Instance UIDs of its DICOM files)
+        self.series_uids = {}
+
+    def shared_files(self, session, files, dat_indexes):
+        """Map the .dat files of a session's series in the shared directories to their size and modification time.
+
+        The DICOM headers of a session are only read again when its own files change.
+        """
+        own_files, uids = self.series_uids.get(session, (None, []))
+        if own_files != files:
+            uids = list(SeriesIndex(session).series())
+            self.series_uids[session] = (files, uids)
+        shared = {}
+        for uid in uids:
+            for dat_index in dat_indexes:
+                # the .dat filenames hold the Series Instance UID without its .0.0.0 suffix
+                for path in dat_index.find(uid[:-6]):
+                    fingerprint(shared, path)
+        return shared
+
+    def scan(self, now=None):
+        """Rescan every session, returning the settled sessions that haven't been handled with their files."""
+        now = time.monotonic() if now is None else now
+        settled = []
+        # each shared directory is listed once per scan, however many sessions there are
+        dat_indexes = [DatIndex(directory) for directory in self.shared_dirs]
+        for entry in sorted(os.scandir(self.inbox), key=lambda entry: entry.name):
+            if not entry.is_dir() or entry.name.startswith("."):
+                continue
+            files = snapshot(entry.path)
+            if dat_indexes:
+                files.update(self.shared_files(entry.path, files, dat_indexes))
+            previous, since, handled = self.sessions.get(entry.path, (None, now, None))
+            if files != previous:
+                since = now
+            self.sessions[entry.path] = (files, since, handled)
+            if files and files != handled and now - since >= self.settle:
+                settled.append((entry.path, files))
+        return settled
+
+    def handled(self, session, files):
+        """Mark a session as handled with these files."""
+        current, since, _ = self.sessions[session]
+        self.sessions[session] = (current, since, files)
+
+    def pending(self):
+        """Whether any session has files that haven't been handled yet, settled or not."""
+        return any(files and files != handled for files, _, handled in self.sessions.values())